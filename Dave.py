@@ -2,27 +2,100 @@
 demo_app.py
 """
 import os
+import time
 import streamlit as st
-from openai import OpenAI
+import perf
+from dataset_profile import DATASET_PROFILE_ENABLED
+from local_executor import CODE_EXECUTION_BACKEND, RUN_PYTHON_TOOL, dataset_instructions
+from openai_client import OPENAI_STREAM_TIMEOUT, get_openai_client
 from utils import (
     delete_files,
     delete_thread,
     EventHandler,
+    get_answer_cache,
+    get_cleanup_worker,
+    get_code_executor,
+    get_dataset_profile,
+    get_local_frame,
+    get_local_frame_fingerprint,
+    get_session_transcript,
+    get_thread_pool,
     moderation_endpoint,
     is_nsfw,
-    # is_not_question,
+    is_not_question,
     render_custom_css,
     render_download_files,
-    retrieve_messages_from_thread,
-    retrieve_assistant_created_files
+    render_recorded_download_files,
+    replay_answer,
+    RecordingEventHandler,
+    retrieve_assistant_created_files,
+    submit_tool_outputs
     )
+from guardrails import run_guardrails
+from verdict_cache import get_verdict_cache
+
+GUARDRAIL_CHECKS = {
+    "moderation": moderation_endpoint,
+    "nsfw": is_nsfw,
+    "not_question": is_not_question,
+}
+# Checks run on each question, concurrently
+ENABLED_GUARDRAILS = ["moderation"]
+# Local copy of the CSV dataset uploaded as FILE_ID, which the API does not allow to download: needed
+# to run the assistant's code locally, and to start the threads with the profile of the dataset
+DATASET_PATH = os.environ.get("DATASET_PATH")
+
+# First Streamlit command, ahead of the spinners of the cached resources below
+st.set_page_config(page_title="DAVE",
+                   page_icon="🕵️")
 
-# Initialise the OpenAI client, and retrieve the assistant
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+# Get the process-wide OpenAI client, and retrieve the assistant
+client = get_openai_client()
 assistant = client.beta.assistants.retrieve(st.secrets["ASSISTANT_ID"])
 
-st.set_page_config(page_title="DAVE",
-                   page_icon="🕵️")
+# The dataset, read once per process, if there is a local copy
+dataset = None
+if DATASET_PATH:
+    try:
+        dataset = get_local_frame(DATASET_PATH)
+    except Exception as e:
+        print(f"Failed to read the local dataset: \t {e}")
+
+# Run the assistant's code locally, against the dataset loaded once per process, or in the code interpreter
+if CODE_EXECUTION_BACKEND == "local":
+    if dataset is None:
+        st.error("Running the code locally needs a local copy of the dataset: set DATASET_PATH.")
+        st.stop()
+    code_executor = get_code_executor()
+    code_executor.load(st.secrets["FILE_ID"], dataset)
+    # Threads need no file attached, and the run offers `run_python` in place of the code interpreter
+    thread_file_id = ""
+    run_params = {"tools": [RUN_PYTHON_TOOL], "additional_instructions": dataset_instructions(dataset)}
+else:
+    code_executor = None
+    thread_file_id = st.secrets["FILE_ID"]
+    run_params = {"tool_choice": {"type": "code_interpreter"}}
+
+# Start each thread with the profile of the dataset, computed once per file, so that the
+# assistant does not spend tool calls exploring the data; without a local copy, threads start without it
+dataset_profile = ""
+if DATASET_PROFILE_ENABLED and dataset is not None:
+    dataset_profile = get_dataset_profile(st.secrets["FILE_ID"], dataset)
+
+# Keep threads with the file attached ready for the next questions
+thread_pool = get_thread_pool()
+thread_pool.prewarm(thread_file_id, dataset_profile)
+
+# Answers already given about this dataset, keyed on the content the code runs against: the local
+# copy when the code runs locally, which may change while FILE_ID stays the same, else the uploaded file
+if CODE_EXECUTION_BACKEND == "local":
+    answer_key = get_local_frame_fingerprint(DATASET_PATH)
+else:
+    answer_key = st.secrets["FILE_ID"]
+answer_cache = get_answer_cache(answer_key)
+
+# Tag the spans of this run with the session id
+perf.begin_session(st.session_state)
 
 # Apply custom CSS
 render_custom_css()
@@ -31,15 +104,6 @@ render_custom_css()
 if "file_uploaded" not in st.session_state:
     st.session_state.file_uploaded = False
 
-if "assistant_text" not in st.session_state:
-    st.session_state.assistant_text = [""]
-
-if "code_input" not in st.session_state:
-    st.session_state.code_input = []
-
-if "code_output" not in st.session_state:
-    st.session_state.code_output = []
-
 if "disabled" not in st.session_state:
     st.session_state.disabled = False
 
@@ -55,58 +119,124 @@ if qn_btn.button("Ask DAVE"):
     text_box.empty()
     qn_btn.empty()
 
-    if moderation_endpoint(question):
-        st.warning("Your question has been flagged. Refresh page to try again.")
+    question_start = time.perf_counter()
+    perf.begin_question()
+
+    @perf.timed("prepare_thread")
+    def prepare_thread(question, file_id):
+        """
+        Take a thread with the file attached from the pool, and add the question, while the checks run
+        """
+        # Each question gets its own thread, as the thread is deleted once answered
+        with perf.span("thread_acquire") as span:
+            thread_id, pooled = thread_pool.acquire(file_id, dataset_profile)
+            span.set(pooled=pooled)
+
+        with perf.span("message_create"):
+            message = client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=question
+            )
+        return thread_id, message.id
+
+    def cancel_thread(prepared):
+        """
+        Undo `prepare_thread` when the question is flagged
+        """
+        thread_id, _ = prepared
+        delete_thread(thread_id)
+
+    # Replay the answer if the question was already answered about this dataset
+    cached_answer = answer_cache.get(answer_key, question)
+
+    # Run the enabled checks concurrently, preparing the thread in the meantime unless the answer is cached
+    with perf.span("guardrails") as span:
+        guardrails = run_guardrails(
+            question,
+            checks={name: GUARDRAIL_CHECKS[name] for name in ENABLED_GUARDRAILS},
+            speculative=None if cached_answer is not None else lambda file_id=thread_file_id: prepare_thread(question, file_id),
+            cancel=cancel_thread,
+        )
+        span.set(flagged_by=guardrails.flagged_by, timed_out=guardrails.timed_out)
+    print(f"Guardrails: \t {guardrails.timings} (timed out: {guardrails.timed_out})")
+    print(f"Verdict cache: \t {get_verdict_cache().stats()}")
+    print(f"Thread pool: \t {thread_pool.stats()}")
+
+    if guardrails.flagged:
+        if guardrails.unchecked:
+            st.warning("Your question could not be checked. Refresh page to try again.")
+        elif guardrails.flagged_by == "not_question":
+            st.warning("Please ask a question. Refresh page to try again.")
+        else:
+            st.warning("Your question has been flagged. Refresh page to try again.")
         st.stop()
 
-    # if is_not_question(question):
-    #     st.warning("Please ask a question. Refresh page to try again.")
-    #     client.beta.threads.delete(st.session_state.thread_id)
-    #     st.stop()
-
-    # Create a new thread
-    if "thread_id" not in st.session_state:
-        thread = client.beta.threads.create()
-        st.session_state.thread_id = thread.id
+    # Keep the question and the answer in the transcript of the session
+    transcript = get_session_transcript()
+    transcript.begin_turn("user")
+    transcript.add("text", question)
+    st.success(f"**> 🤔 User:** {question}")
+    transcript.begin_turn("assistant")
+
+    if cached_answer is not None:
+        with perf.span("answer_replay", events=len(cached_answer.events)):
+            replay_answer(cached_answer, EventHandler())
+            st.toast("DAVE has finished analysing the data", icon="🕵️")
+            st.session_state.download_files, st.session_state.download_file_names = render_recorded_download_files(cached_answer)
+        print(f"Answer cache: \t {answer_cache.stats()}")
+
+    else:
+        # Keep the thread of this question
+        if guardrails.speculative_error is not None:
+            st.error(f"Failed to prepare the thread: {guardrails.speculative_error}")
+            st.stop()
+        st.session_state.thread_id, _ = guardrails.speculative_result
+        transcript.bind(thread_id=st.session_state.thread_id)
         print(st.session_state.thread_id)
 
-    # Update the thread to attach the file
-    client.beta.threads.update(
-            thread_id=st.session_state.thread_id,
-            tool_resources={"code_interpreter": {"file_ids": [st.secrets["FILE_ID"]]}}
-            )
-
-    if "text_boxes" not in st.session_state:
-        st.session_state.text_boxes = []
-        
-    client.beta.threads.messages.create(
-        thread_id=st.session_state.thread_id,
-        role="user",
-        content=question
-    )
-
-    st.session_state.text_boxes.append(st.empty())
-    st.session_state.text_boxes[-1].success(f"**> 🤔 User:** {question}")
-
-    with client.beta.threads.runs.stream(thread_id=st.session_state.thread_id,
-                                          assistant_id=assistant.id,
-                                          tool_choice={"type": "code_interpreter"},
-                                          event_handler=EventHandler(),
-                                          temperature=0) as stream:
-        stream.until_done()
-        st.toast("DAVE has finished analysing the data", icon="🕵️")
-
-    # Prepare the files for download
-    with st.spinner("Preparing the files for download..."):
-        # Retrieve the messages by the Assistant from the thread
-        assistant_messages = retrieve_messages_from_thread(st.session_state.thread_id)
-        # For each assistant message, retrieve the file(s) created by the Assistant
-        st.session_state.assistant_created_file_ids = retrieve_assistant_created_files(assistant_messages)
-        # Download these files
-        st.session_state.download_files, st.session_state.download_file_names = render_download_files(st.session_state.assistant_created_file_ids)
-
-    # Clean-up
-    # Delete the file(s) created by the Assistant
-    delete_files(st.session_state.assistant_created_file_ids)
-    # Delete the thread
-    delete_thread(st.session_state.thread_id)
\ No newline at end of file
+        run_start = time.perf_counter()
+        event_handler = RecordingEventHandler(code_executor, st.secrets["FILE_ID"], dataset)
+        with perf.span("run_stream"):
+            with client.beta.threads.runs.stream(thread_id=st.session_state.thread_id,
+                                                 assistant_id=assistant.id,
+                                                 event_handler=event_handler,
+                                                 temperature=0,
+                                                 timeout=OPENAI_STREAM_TIMEOUT,
+                                                 **run_params) as stream:
+                print(f"Time to run start: \t {time.perf_counter() - question_start:.2f}s")
+                perf.event("run_start")
+                stream.until_done()
+            # Stream on while the run waits for the outputs of the code run locally
+            final_event_handler = submit_tool_outputs(event_handler)
+            st.toast("DAVE has finished analysing the data", icon="🕵️")
+
+        # Prepare the files for download
+        with st.spinner("Preparing the files for download..."):
+            # Retrieve the file(s) created by the Assistant, in a single scan of the thread of this question
+            st.session_state.assistant_created_file_ids, _ = retrieve_assistant_created_files(st.session_state.thread_id)
+            # Download these files
+            st.session_state.download_files, st.session_state.download_file_names = render_download_files(st.session_state.assistant_created_file_ids)
+
+        # Record the answer, with its files, if the run completed
+        answer = event_handler.answer
+        if final_event_handler.current_run is not None and final_event_handler.current_run.status == "completed" \
+                and len(st.session_state.download_files) == len(st.session_state.assistant_created_file_ids):
+            answer.downloads = [[answer.add_blob(file), file_name] for file, file_name
+                                in zip(st.session_state.download_files, st.session_state.download_file_names)]
+            answer.run_seconds = time.perf_counter() - run_start
+            answer_cache.put(answer_key, question, answer)
+        print(f"Answer cache: \t {answer_cache.stats()}")
+        if code_executor is not None:
+            print(f"Code executor: \t {code_executor.stats()}")
+
+        # Clean-up, handed to the background worker
+        # Delete the file(s) created by the Assistant
+        delete_files(st.session_state.assistant_created_file_ids)
+        # Delete the thread
+        delete_thread(st.session_state.thread_id)
+        print(f"Cleanup worker: \t {get_cleanup_worker().metrics()}")
+    print(f"Transcript: \t {transcript.stats()}")
+
+# Spans of the latest question, when enabled
+perf.render_perf_panel(st.sidebar, st.session_state)
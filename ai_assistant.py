@@ -1,10 +1,71 @@
-import io
-import base64
+import os
+
 import streamlit as st
-import pandas as pd
-import openai
 from openai import AssistantEventHandler
-from PIL import Image
+import perf
+from attachment_tracker import ArtifactCache, AttachmentTracker
+from dataset_profile import DATASET_PROFILE_ENABLED
+from dataset_export import export_frame, loader_stub
+from transcript import TRANSCRIPT_PAGE_TURNS
+from local_executor import CODE_EXECUTION_BACKEND, RUN_PYTHON_TOOL, dataset_instructions
+from openai_client import OPENAI_STREAM_TIMEOUT, get_openai_client
+from upload_cache import DatasetUploadCache, frame_fingerprint
+from utils import (
+    RenderScheduler,
+    delete_files,
+    get_code_executor,
+    get_dataset_profile,
+    get_session_transcript,
+    session_key,
+    get_thread_pool,
+    read_file_content,
+    retrieve_assistant_created_files,
+    retrieve_file_name,
+    run_function_call,
+    submit_tool_outputs
+    )
+
+# Config: one of `csv`, `parquet` or `feather`
+DATASET_EXPORT_FORMAT = os.environ.get("DATASET_EXPORT_FORMAT", "csv")
+
+
+def upload_dataset(df_filtered) -> str:
+    """
+    Export the dataframe in the configured format, upload it and return the file id
+    """
+    data_buffer, _ = export_frame(df_filtered, DATASET_EXPORT_FORMAT)
+
+    # Upload the exported file as binary data
+    file = get_openai_client().files.create(
+        file=data_buffer,
+        purpose='assistants'
+    )
+    return file.id
+
+
+@st.cache_resource
+def get_upload_cache() -> DatasetUploadCache:
+    """
+    Process-wide cache of the dataset uploaded to the assistant
+    """
+    return DatasetUploadCache(upload_fn=upload_dataset,
+                              delete_fn=lambda file_id: delete_files([file_id]))
+
+
+@st.cache_resource
+def get_artifact_cache() -> ArtifactCache:
+    """
+    Process-wide cache of the decoded attachments of the assistant, keyed by file id
+    """
+    return ArtifactCache()
+
+
+def fetch_attachment(file_id: str) -> tuple[str, bytes]:
+    """
+    Download an attachment, returning its base name and its content
+    """
+    return retrieve_file_name(file_id), read_file_content(file_id)
+
 
 def ai_assistant_tab(df_filtered):
     # Custom CSS to make the input bar sticky
@@ -30,63 +91,99 @@ def ai_assistant_tab(df_filtered):
     st.write("Ask questions about your data, and the assistant will analyze it using Python code.")
 
 
-    # Initialize OpenAI client using Streamlit secrets
+    # Get the process-wide OpenAI client, and the assistant id from Streamlit secrets
     try:
-        openai_api_key = st.secrets["OPENAI_API_KEY"]
+        client = get_openai_client()
         assistant_id = st.secrets["OPENAI_ASSISTANT_ID"]
     except KeyError as e:
         st.error(f"Missing secret: {e}")
         st.stop()
 
 
-    openai.api_key = openai_api_key
-
     try:
-        assistant = openai.Assistant.retrieve(assistant_id)
+        assistant = client.beta.assistants.retrieve(assistant_id)
     except Exception as e:
         st.error(f"Failed to retrieve assistant: {e}")
         st.stop()
 
 
-    # Convert dataframe to a CSV file using io.BytesIO
-    csv_buffer = io.BytesIO()
-    df_filtered.to_csv(csv_buffer, index=False)
-    csv_buffer.seek(0)  # Reset buffer position to the start
-
-
-    # Upload the CSV file as binary data
-    try:
-        file = openai.File.create(
-            file=csv_buffer,
-            purpose='assistants'
-        )
-    except Exception as e:
-        st.error(f"Failed to upload file: {e}")
-        st.stop()
-
-
-    # Update the assistant to include the file
-    try:
-        openai.Assistant.update(
-            assistant_id,
-            tool_resources={
-                "code_interpreter": {
-                    "file_ids": [file.id]
-                }
-            }
-        )
-    except Exception as e:
-        st.error(f"Failed to update assistant with file resources: {e}")
-        st.stop()
-
-
-    # Initialize session state variables
-    if 'chat_history' not in st.session_state:
-        st.session_state.chat_history = []
+    if CODE_EXECUTION_BACKEND == "local":
+        # Run the assistant's code in the local workers, against the filtered data: nothing to upload
+        code_executor = get_code_executor()
+        dataset_key = frame_fingerprint(df_filtered)
+        code_executor.load(dataset_key, df_filtered)
+        file_id = ""
+        run_params = {"tools": [RUN_PYTHON_TOOL], "additional_instructions": dataset_instructions(df_filtered)}
+    else:
+        code_executor = None
+        dataset_key = None
+        run_params = {"additional_instructions": loader_stub(DATASET_EXPORT_FORMAT)}
+
+        # Upload the dataset, reusing the previous upload if the filtered data is unchanged
+        upload_cache = get_upload_cache()
+        try:
+            with perf.span("dataset_upload", rows=len(df_filtered)) as span:
+                file_id, cache_hit = upload_cache.get_or_upload(df_filtered, DATASET_EXPORT_FORMAT,
+                                                                owner=session_key())
+                span.set(cache_hit=cache_hit)
+        except Exception as e:
+            st.error(f"Failed to upload file: {e}")
+            st.stop()
+        print(f"Dataset upload cache: \t {upload_cache.stats()}")
+
+        # Update the assistant to include the file, unless it already does: a failed update is
+        # retried on the next rerun, and another session pointing it at its own dataset is undone
+        code_interpreter = assistant.tool_resources.code_interpreter if assistant.tool_resources else None
+        if code_interpreter is None or code_interpreter.file_ids != [file_id]:
+            try:
+                with perf.span("assistant_update"):
+                    client.beta.assistants.update(
+                        assistant_id,
+                        tool_resources={
+                            "code_interpreter": {
+                                "file_ids": [file_id]
+                            }
+                        }
+                    )
+            except Exception as e:
+                st.error(f"Failed to update assistant with file resources: {e}")
+                st.stop()
+
+    # Profile of the dataset, computed once per dataset: keyed by the fingerprint of the data, or
+    # by the id of its upload, which always refers to the same content
+    dataset_profile = ""
+    if DATASET_PROFILE_ENABLED:
+        dataset_profile = get_dataset_profile(dataset_key or file_id, df_filtered)
+
+    # Keep threads with the profile of this dataset ready for the next sessions. The dataset is not
+    # attached to the threads: they keep it across filter changes, so they read the assistant's file
+    thread_pool = get_thread_pool()
+    if st.session_state.get("prewarmed_profile") != dataset_profile:
+        thread_pool.prewarm("", dataset_profile)
+        st.session_state.prewarmed_profile = dataset_profile
+
+
+    # Initialize session state variables; the transcript of a reconnected session is restored from local disk
+    transcript = get_session_transcript()
+    if 'attachment_tracker' not in st.session_state:
+        # Attachments already handled in the thread of this session
+        st.session_state.attachment_tracker = AttachmentTracker(list_fn=retrieve_assistant_created_files,
+                                                                fetch_fn=fetch_attachment,
+                                                                cache=get_artifact_cache())
+    if 'thread_id' not in st.session_state and transcript.thread_id is not None:
+        # A restored session goes on in its thread, its earlier attachments are in the transcript
+        st.session_state.thread_id = transcript.thread_id
+        st.session_state.attachment_tracker.resume(transcript.thread_id, transcript.cursor)
     if 'thread_id' not in st.session_state:
         try:
-            thread = openai.Thread.create()
-            st.session_state.thread_id = thread.id
+            # Taken from the pool of threads created ahead, with the profile of the dataset
+            with perf.span("thread_acquire") as span:
+                thread_id, pooled = thread_pool.acquire("", dataset_profile)
+                span.set(pooled=pooled)
+            st.session_state.thread_id = thread_id
+            st.session_state.dataset_profile = dataset_profile
+            transcript.bind(thread_id=thread_id)
+            print(f"Thread pool: \t {thread_pool.stats()}")
         except Exception as e:
             st.error(f"Failed to create thread: {e}")
             st.stop()
@@ -96,29 +193,41 @@ def ai_assistant_tab(df_filtered):
     chat_container = st.container()
 
 
-    # Display chat history in the container
+    # Display the latest turns of the transcript in the container, a page more on request, loading
+    # the images and tables by reference
+    if 'history_turns' not in st.session_state:
+        st.session_state.history_turns = TRANSCRIPT_PAGE_TURNS
     with chat_container:
-        for message in st.session_state.chat_history:
-            if message['role'] == 'user':
+        history_start = max(0, len(transcript) - st.session_state.history_turns)
+        if history_start > 0 and st.button("Show earlier messages"):
+            st.session_state.history_turns += TRANSCRIPT_PAGE_TURNS
+            history_start = max(0, len(transcript) - st.session_state.history_turns)
+        for turn in transcript.turns(history_start):
+            if turn.role == 'user':
                 with st.chat_message("user"):
-                    st.write(message['content'])
+                    st.write(turn.text())
             else:
                 with st.chat_message("assistant"):
-                    if 'content' in message:
-                        st.write(message['content'], unsafe_allow_html=True)
-                    if 'image' in message:
-                        st.image(message['image'], use_column_width=True)
-                    if 'code' in message:
+                    tables = "".join(transcript.blob_store.get(digest).decode("utf-8") for digest in turn.blobs("markdown"))
+                    st.write(turn.text() + tables, unsafe_allow_html=True)
+                    images = [transcript.blob_store.get(digest) for digest in turn.blobs("image")]
+                    if images:
+                        st.image(images, use_column_width=True)
+                    code = turn.text("code")
+                    if code:
                         with st.expander("💻 Code", expanded=False):
-                            st.code(message['code'], language='python')
-                    if 'output' in message:
-                        st.write(f"**Output:**\n```python\n{message['output']}\n```")
+                            st.code(code, language='python')
+                    output = turn.text("output")
+                    if output:
+                        st.write(f"**Output:**\n```python\n{output}\n```")
 
 
     # User input
     if prompt := st.chat_input("Enter your question about the data"):
-        # Add user message to chat history
-        st.session_state.chat_history.append({'role': 'user', 'content': prompt})
+        perf.begin_question()
+        # Add user message to the transcript
+        transcript.begin_turn("user")
+        transcript.add("text", prompt)
 
 
         # Display the user's message immediately
@@ -127,13 +236,22 @@ def ai_assistant_tab(df_filtered):
                 st.write(prompt)
 
 
-        # Create a new message in the thread
+        # Create a new message in the thread, after the profile of the dataset if the filters changed it
         try:
-            openai.ThreadMessage.create(
-                thread_id=st.session_state.thread_id,
-                role="user",
-                content=prompt
-            )
+            if dataset_profile and dataset_profile != st.session_state.get("dataset_profile"):
+                with perf.span("profile_message_create"):
+                    client.beta.threads.messages.create(
+                        thread_id=st.session_state.thread_id,
+                        role="user",
+                        content=dataset_profile
+                    )
+                st.session_state.dataset_profile = dataset_profile
+            with perf.span("message_create"):
+                client.beta.threads.messages.create(
+                    thread_id=st.session_state.thread_id,
+                    role="user",
+                    content=prompt
+                )
         except Exception as e:
             st.error(f"Failed to create message in thread: {e}")
             st.stop()
@@ -141,28 +259,59 @@ def ai_assistant_tab(df_filtered):
 
         # Define the custom event handler
         class RealTimeCodeEventHandler(AssistantEventHandler):
-            def __init__(self, chat_container):
+            def __init__(self, chat_container, code_executor=None, dataset_key=None, dataset=None):
                 super().__init__()
-                self.assistant_message = ""
                 self.chat_container = chat_container
+                # The text since the last code, rendered in place
+                self.text_placeholder = None
+                self.text_segment = ""
                 self.code_expander = None
                 self.code_placeholder = None
                 self.output_placeholder = None
+                self.code_input = ""
+                self.code_output = ""
+                self.render_scheduler = RenderScheduler()
+                self.first_token = True
+                self.code_executor = code_executor
+                self.dataset_key = dataset_key
+                self.dataset = dataset
+                self.tool_outputs = []
+                # The answer is written to the current turn of the transcript as it streams, so that
+                # a session which disconnects mid-answer keeps what was streamed so far
+                self.transcript = get_session_transcript()
 
             def on_text_delta(self, delta, snapshot, **kwargs):
                 """
                 Handles text deltas from the assistant.
                 """
-                if delta and delta.get('value'):
-                    self.assistant_message += delta['value']
-                    self.chat_container.markdown(self.assistant_message)
+                if self.first_token:
+                    perf.event("first_token")
+                    self.first_token = False
+                if delta and delta.value:
+                    if self.text_placeholder is None:
+                        self.text_placeholder = self.chat_container.empty()
+                        self.text_segment = ""
+                    self.transcript.extend("text", delta.value)
+                    self.text_segment += delta.value
+                    self.render_scheduler.update(self.text_placeholder, "markdown",
+                                                 self.text_segment, len(delta.value))
+
+            def on_text_done(self, text):
+                """
+                Handles the completion of a text, rendering any pending delta.
+                """
+                self.render_scheduler.flush()
 
             def on_tool_call_created(self, tool_call):
                 """
                 Handles the creation of a tool call (e.g., code interpreter).
                 """
-                tool_type = tool_call.get('type', 'unknown')
-                if tool_type == 'code_interpreter':
+                if tool_call.type in ('code_interpreter', 'function'):
+                    self.render_scheduler.flush()
+                    # The text after the code goes below it
+                    self.text_placeholder = None
+                    # Start the code of this tool call in the transcript, saving the answer so far
+                    self.transcript.add("code", "")
                     # Initialize code expander and placeholder
                     self.code_expander = self.chat_container.expander("💻 Code", expanded=True)
                     self.code_placeholder = self.code_expander.empty()
@@ -175,79 +324,94 @@ def ai_assistant_tab(df_filtered):
                 if not delta:
                     return
 
-                tool_type = delta.get('type', 'unknown')
-                if tool_type == 'code_interpreter':
-                    code_interpreter = delta.get('code_interpreter', {})
-                    code_input = code_interpreter.get('input', '')
-                    code_outputs = code_interpreter.get('outputs', [])
+                if delta.type == 'code_interpreter' and delta.code_interpreter:
+                    code_input = delta.code_interpreter.input or ''
+                    code_outputs = delta.code_interpreter.outputs or []
 
                     if code_input and self.code_placeholder:
-                        self.code_placeholder.code(code_input, language='python')
+                        self.transcript.extend("code", code_input)
+                        self.code_input += code_input
+                        self.render_scheduler.update(self.code_placeholder, "code", self.code_input, len(code_input))
 
                     for output in code_outputs:
-                        if output.get('type') == 'logs' and self.output_placeholder:
-                            self.output_placeholder.write(f"**Output:**\n```python\n{output.get('logs')}\n```")
+                        if output.type == 'logs' and self.output_placeholder:
+                            self.render_scheduler.flush()
+                            self.code_output += output.logs or ''
+                            self.transcript.extend("output", output.logs or '')
+                            self.output_placeholder.write(f"**Output:**\n```python\n{self.code_output}\n```")
 
             def on_tool_call_done(self, tool_call):
                 """
-                Handles the completion of a tool call.
+                Handles the completion of a tool call, running a function call locally.
+                """
+                if tool_call.type == 'function':
+                    self.tool_outputs.append(run_function_call(self, tool_call, self.code_executor, self.dataset_key,
+                                                               self.dataset))
+                self.render_scheduler.flush()
+
+            def render_image(self, image_data_bytes, img_name):
+                """
+                Displays a figure of the code run locally.
                 """
-                pass  # You can perform any cleanup or final updates here if necessary
+                self.transcript.add_blob("image", image_data_bytes)
+                self.code_expander.image(image_data_bytes, use_column_width=True)
 
+            def on_end(self):
+                """
+                Handles the end of the stream, rendering any pending delta.
+                """
+                self.render_scheduler.flush()
+                self.transcript.save()
+                # The run waits for the outputs of the code run locally, and continues in another stream
+                if self.current_run is not None and self.current_run.status == "requires_action":
+                    return
+                print(f"Render scheduler: \t {self.render_scheduler.stats()}")
+                perf.event("stream_end", **self.render_scheduler.stats())
 
-        # Instantiate the custom event handler
-        event_handler = RealTimeCodeEventHandler(chat_container)
+
+        # Instantiate the custom event handler, writing the answer to a new turn of the transcript
+        transcript.begin_turn("assistant")
+        event_handler = RealTimeCodeEventHandler(chat_container, code_executor, dataset_key, df_filtered)
 
 
         # Run the assistant
         try:
-            run = openai.ThreadRun.create(
-                thread_id=st.session_state.thread_id,
-                assistant_id=assistant_id,
-                event_handler=event_handler,
-                temperature=0
-            )
-            run.stream_until_done()
+            with perf.span("run_stream"), client.beta.threads.runs.stream(
+                    thread_id=st.session_state.thread_id,
+                    assistant_id=assistant_id,
+                    event_handler=event_handler,
+                    temperature=0,
+                    timeout=OPENAI_STREAM_TIMEOUT,
+                    **run_params
+            ) as stream:
+                stream.until_done()
+            # Stream on while the run waits for the outputs of the code run locally
+            event_handler = submit_tool_outputs(event_handler)
         except Exception as e:
             st.error(f"Failed to run assistant stream: {e}")
             st.stop()
+        finally:
+            # Keep what was streamed, however the stream ended
+            transcript.save()
+        if code_executor is not None:
+            print(f"Code executor: \t {code_executor.stats()}")
 
 
-        # Add assistant's message and code to chat history
-        st.session_state.chat_history.append({
-            'role': 'assistant',
-            'content': event_handler.assistant_message,
-            'code': event_handler.code_placeholder.code if event_handler.code_placeholder else "",
-            'output': event_handler.output_placeholder.text if event_handler.output_placeholder else ""
-        })
-
-
-        # Handle any files generated by the assistant
+        # Handle the files generated by the assistant for this question, scanning only the new messages
         try:
-            messages = openai.ThreadMessage.list(thread_id=st.session_state.thread_id)
-            for message in messages.data:
-                if message.role == 'assistant' and hasattr(message, 'attachments') and message.attachments:
-                    for attachment in message.attachments:
-                        if attachment.object == 'file':
-                            file_id = attachment.file_id
-                            # Download the file
-                            file_content = openai.File.download(file_id).read()
-                            # Check the file type and update chat history accordingly
-                            if attachment.filename.endswith(('.png', '.jpg', '.jpeg')):
-                                # Convert image bytes to displayable format
-                                image = Image.open(io.BytesIO(file_content))
-                                buffered = io.BytesIO()
-                                image.save(buffered, format="PNG")
-                                img_bytes = buffered.getvalue()
-                                # Append image to chat history
-                                st.session_state.chat_history[-1]['image'] = img_bytes
-                            elif attachment.filename.endswith('.csv'):
-                                # Read CSV into a dataframe and append to chat history
-                                df = pd.read_csv(io.BytesIO(file_content))
-                                st.session_state.chat_history[-1]['content'] += f"\n\n{df.to_html(index=False, escape=False)}"
-                            else:
-                                # Handle other file types as download buttons
-                                st.session_state.chat_history[-1]['content'] += f"\n\n[Download {attachment.filename}](data:file/{attachment.filename.split('.')[-1]};base64,{base64.b64encode(file_content).decode()})"
+            with perf.span("attachments") as span:
+                artifacts = st.session_state.attachment_tracker.collect(st.session_state.thread_id)
+                span.set(attachments=len(artifacts))
+                # Images, and tables or download links for the other file types, which follow the answer
+                for artifact in artifacts:
+                    if artifact.kind == "image":
+                        transcript.add_blob("image", artifact.data)
+                    else:
+                        transcript.add_blob("markdown", artifact.data.encode("utf-8"))
+                # Scanned up to here, for a restored session
+                transcript.bind(cursor=st.session_state.attachment_tracker.cursor(st.session_state.thread_id))
+            print(f"Attachment tracker: \t {st.session_state.attachment_tracker.stats()}")
+            print(f"Transcript: \t {transcript.stats()}")
         except Exception as e:
             st.error(f"Failed to handle assistant's attachments: {e}")
             st.stop()
@@ -0,0 +1,177 @@
+"""
+answer_cache.py
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from verdict_cache import normalize_text
+
+# Config
+ANSWER_CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH", ".answer_cache.sqlite3")
+ANSWER_CACHE_MAX_BYTES = int(os.environ.get("ANSWER_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+
+class RecordedAnswer:
+    """
+    The events of an assistant run, as recorded by `utils.RecordingEventHandler`, and the
+    files offered for download, with the binary payloads they refer to by index
+    """
+    __slots__ = ("events", "downloads", "blobs", "run_seconds")
+
+    def __init__(self,
+                 events: Optional[list] = None,
+                 downloads: Optional[list] = None,
+                 blobs: Optional[list[bytes]] = None,
+                 run_seconds: float = 0.0):
+        """
+        Args:
+        - events (list): `[kind, payload]` pairs, replayed in order
+        - downloads (list): `[blob index, file name]` pairs of the files offered for download
+        - blobs (list[bytes]): Binary payloads (images, files), referenced by their index
+        - run_seconds (float): Duration of the original run, reported as saved on each replay
+        """
+        self.events = events if events is not None else []
+        self.downloads = downloads if downloads is not None else []
+        self.blobs = blobs if blobs is not None else []
+        self.run_seconds = run_seconds
+
+    def add_blob(self, data: bytes) -> int:
+        """
+        Store a binary payload, returning the index the events refer to it by
+        """
+        self.blobs.append(data)
+        return len(self.blobs) - 1
+
+    def pack(self) -> bytes:
+        """
+        Serialise as a length-prefixed JSON header followed by the blobs
+        """
+        header = json.dumps({"events": self.events,
+                             "downloads": self.downloads,
+                             "blob_sizes": [len(blob) for blob in self.blobs],
+                             "run_seconds": self.run_seconds}).encode("utf-8")
+        return len(header).to_bytes(4, "big") + header + b"".join(self.blobs)
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "RecordedAnswer":
+        header_size = int.from_bytes(data[:4], "big")
+        header = json.loads(data[4:4 + header_size])
+        blobs = []
+        offset = 4 + header_size
+        for size in header["blob_sizes"]:
+            blobs.append(data[offset:offset + size])
+            offset += size
+        return cls(header["events"], header["downloads"], blobs, header["run_seconds"])
+
+
+class AnswerCache:
+    """
+    Cache of recorded answers in a SQLite database, keyed by dataset hash and normalised
+    question. Bounded by the total size of the answers, evicting the least recently used.
+
+    A new version of the dataset has a new hash, so its questions miss the cache; the
+    answers of the other versions are deleted with `invalidate`.
+    """
+    def __init__(self, db_path: str = ANSWER_CACHE_PATH, max_bytes: int = ANSWER_CACHE_MAX_BYTES):
+        """
+        Args:
+        - db_path (str): Path of the SQLite database, or ":memory:"
+        - max_bytes (int): Total size of the answers above which the least recently used are evicted
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS answers ("
+                         "key TEXT PRIMARY KEY, dataset TEXT, question TEXT, "
+                         "payload BLOB, size INTEGER, used_at REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS answers_used_at ON answers (used_at)")
+        self._db.commit()
+
+    @staticmethod
+    def key(dataset_hash: str, question: str) -> str:
+        """
+        Cache key of a question asked about a dataset
+        """
+        digest = hashlib.sha256(normalize_text(question).encode("utf-8")).hexdigest()
+        return f"{dataset_hash}:{digest}"
+
+    def get(self, dataset_hash: str, question: str) -> Optional[RecordedAnswer]:
+        """
+        Return the recorded answer to the question, or None
+        """
+        key = self.key(dataset_hash, question)
+        with self._lock:
+            row = self._db.execute("SELECT payload FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE answers SET used_at = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        answer = RecordedAnswer.unpack(row[0])
+        with self._lock:
+            self.hits += 1
+            self.saved_seconds += answer.run_seconds
+        return answer
+
+    def put(self, dataset_hash: str, question: str, answer: RecordedAnswer) -> None:
+        """
+        Store the recorded answer, evicting the least recently used answers above the size bound
+        """
+        payload = answer.pack()
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                             (self.key(dataset_hash, question), dataset_hash, normalize_text(question),
+                              payload, len(payload), time.time()))
+            self._evict()
+            self._db.commit()
+
+    def invalidate(self, keep_dataset_hash: Optional[str] = None) -> int:
+        """
+        Delete the answers about every dataset but `keep_dataset_hash` (all of them if None)
+
+        Returns:
+        - int: The number of answers deleted
+        """
+        with self._lock:
+            if keep_dataset_hash is None:
+                cursor = self._db.execute("DELETE FROM answers")
+            else:
+                cursor = self._db.execute("DELETE FROM answers WHERE dataset != ?", (keep_dataset_hash,))
+            self._db.commit()
+            return cursor.rowcount
+
+    def stats(self) -> dict:
+        """
+        Return the hit rate, the run time saved by the replays, and the size of the cache
+        """
+        with self._lock:
+            entries, size_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "saved_seconds": self.saved_seconds,
+                "entries": entries,
+                "size_bytes": size_bytes,
+            }
+
+    def _evict(self) -> None:
+        size_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+        if size_bytes <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM answers ORDER BY used_at").fetchall():
+            self._db.execute("DELETE FROM answers WHERE key = ?", (key,))
+            size_bytes -= size
+            if size_bytes <= self.max_bytes:
+                break
@@ -5,14 +5,32 @@ import plotly.graph_objects as go
 
 import streamlit as st
 import pandas as pd
+import functools
+import io
 import os
 
 # Import the AI Assistant tab content
 from ai_assistant import ai_assistant_tab
+from data_loader import SnapshotLoader, make_source
+from dashboard import (
+    compute_activity,
+    compute_cohort_retention,
+    compute_overview,
+    compute_segmentation,
+    filter_countries,
+    )
+from figure_cache import FigureCache
+from kpi_cube import KpiCube
+import perf
+from schema import MARKETPLACES, SCHEMA_VERSION, normalize_frame
+from tab_registry import TabRegistry, TabResultCache
 
 # Set the page configuration
 st.set_page_config(page_title="Client Management Dashboard", layout="wide")
 
+# Tag the spans of this run with the session id
+perf.begin_session(st.session_state)
+
 # Title of the dashboard
 st.title("Client Management Data Dashboard")
 
@@ -21,134 +39,143 @@ openai_api_key = st.secrets["OPENAI_API_KEY"]
 openai_assistant_id = st.secrets["OPENAI_ASSISTANT_ID"]
 sheet_url = st.secrets["SHEET_URL"]
 
-# Function to load data from Google Sheets
-@st.cache_data(ttl=3600)  # Cache data for 1 hour
+# Loader keeping a local snapshot of the Google Sheet, revalidated in the background every hour.
+# The snapshot is normalised to compact dtypes once, when the sheet is parsed.
+@st.cache_resource
+def get_data_loader(url):
+    return SnapshotLoader(make_source(url),
+                          max_age_seconds=3600,
+                          parse=lambda data: normalize_frame(pd.read_csv(io.BytesIO(data))),
+                          version=f"schema-{SCHEMA_VERSION}")
+
+# Function to load data from Google Sheets, with the version of the data it is, which keys the caches of its results
 def load_data(url):
     try:
-        df = pd.read_csv(url)
-        return df
+        # Shared by every session: the page only reads from it
+        with perf.span("load_data"):
+            df, data_version = get_data_loader(url).get()
+        return df, data_version
     except Exception as e:
         st.error(f"Error loading data: {e}")
-        return None
+        return None, None
+
+# Per-country KPI aggregates, built once per version of the data
+@st.cache_resource(max_entries=2)
+def get_kpi_cube(content_hash, _df):
+    with perf.span("kpi_cube_build", rows=len(_df)):
+        return KpiCube(_df)
+
+# Memoized results of the dashboard tabs, shared by every session
+@st.cache_resource
+def get_tab_result_cache():
+    return TabResultCache()
+
+# Serialised figures, shared by every session
+@st.cache_resource
+def get_figure_cache():
+    return FigureCache()
+
+# Cohort retention rates, one line per retention stage
+def cohort_retention_figure(cohort_data):
+    fig_cohort_retention = go.Figure()
+    fig_cohort_retention.add_trace(go.Scatter(x=cohort_data['cohort_month'],
+                                            y=cohort_data['connected_rate'], mode='lines+markers', name='Connected Rate'))
+    fig_cohort_retention.add_trace(go.Scatter(x=cohort_data['cohort_month'],
+                                            y=cohort_data['active_rate'], mode='lines+markers', name='Active Rate'))
+    fig_cohort_retention.add_trace(go.Scatter(x=cohort_data['cohort_month'],
+                                            y=cohort_data['paid_rate'], mode='lines+markers', name='Paid Rate'))
+    return fig_cohort_retention
 
 # Load data from the Google Sheet
 if sheet_url:
-    df = load_data(sheet_url)
+    df, data_version = load_data(sheet_url)
 else:
     st.error("Please provide the Google Sheet URL in the Streamlit secrets.")
 
 
 if df is not None:
-    # Convert 'trial_date' to datetime
-    df['trial_date'] = pd.to_datetime(df['trial_date'], errors='coerce')
-
-    # Handle missing values in marketplace columns
-    marketplaces = ['amazon', 'ebay', 'shopify', 'other_marketplace', 'other_webstore']
-    df[marketplaces] = df[marketplaces].fillna(0).astype(float)
-
     # Sidebar filters
     st.sidebar.header("Filter Data")
     countries = st.sidebar.multiselect(
         "Select Countries",
-        options=df['country'].dropna().unique(),
-        default=df['country'].dropna().unique()
+        options=df['country'].dropna().unique().tolist(),
+        default=df['country'].dropna().unique().tolist()
     )
 
-    # Filter the data based on selections
-    df_filtered = df[df['country'].isin(countries)]
-
-    # Create tabs (insert 'AI Assistant' in the second position)
-    tabs = st.tabs([
-        "Overview",
-        "AI Assistant",
-        "Client Segmentation",
-        "Activity and Usage",
-        "Cohort Retention Analysis"
-    ])
+    # Tabs are only computed when selected, and memoized by data version and filters
+    tab_registry = TabRegistry(get_tab_result_cache())
+    figure_cache = get_figure_cache()
+    filter_state = (data_version, tuple(sorted(countries)))
 
     # --- Overview Tab ---
-    with tabs[0]:
+    @tab_registry.register("Overview", inputs=("df_filtered", "kpi_cube", "countries"), compute=compute_overview)
+    def render_overview(results):
         st.header("Key Metrics (KPIs)")
         col1, col2, col3, col4 = st.columns(4)
+        kpis = results["kpis"]
 
         # Total Clients
-        total_clients = df_filtered['client_id'].nunique()
-        col1.metric("Total Clients", total_clients)
+        col1.metric("Total Clients", kpis["total_clients"])
 
         # Active vs Inactive Clients
-        active_clients = df_filtered[df_filtered['active'] == 1]['client_id'].nunique()
-        inactive_clients = total_clients - active_clients
-        col2.metric("Active Clients", active_clients)
-        col2.metric("Inactive Clients", inactive_clients)
+        col2.metric("Active Clients", kpis["active_clients"])
+        col2.metric("Inactive Clients", kpis["inactive_clients"])
 
         # Conversion Rate (Trial to Paid)
-        converted_clients = df_filtered[(df_filtered['trial_date'].notna()) & (df_filtered['paid'] == 1)]['client_id'].nunique()
-        trial_clients = df_filtered[df_filtered['trial_date'].notna()]['client_id'].nunique()
-        if trial_clients > 0:
-            conversion_rate = (converted_clients / trial_clients) * 100
-        else:
-            conversion_rate = 0
-        col3.metric("Conversion Rate", f"{conversion_rate:.2f}%")
+        col3.metric("Conversion Rate", f"{kpis['conversion_rate']:.2f}%")
 
         # Marketplace Connections
-        marketplace_connections = df_filtered[marketplaces].gt(0).any(axis=1).sum()
-        marketplace_percentage = (marketplace_connections / total_clients) * 100 if total_clients > 0 else 0
-        col4.metric("Marketplace Connections", f"{marketplace_percentage:.2f}%")
+        col4.metric("Marketplace Connections", f"{kpis['marketplace_percentage']:.2f}%")
 
         # Time-Based Trends
         st.header("Time-Based Trends")
 
         # Trial Signup Trend Over Time
         st.subheader("Trial Signup Trend Over Time")
-        trial_trend = df_filtered[df_filtered['trial_date'].notna()].copy()
-        trial_trend['trial_month'] = trial_trend['trial_date'].dt.to_period('M').dt.to_timestamp()
-        trial_counts = trial_trend.groupby('trial_month')['client_id'].nunique().reset_index()
-        fig_trial_trend = px.line(
-            trial_counts,
+        fig_trial_trend = figure_cache.figure(
+            "trial_trend",
+            px.line,
+            results["trial_counts"],
+            layout=dict(xaxis_title='Month', yaxis_title='Number of Signups'),
             x='trial_month',
             y='client_id',
             title='New Trial Signups Over Time',
             markers=True
         )
-        fig_trial_trend.update_layout(xaxis_title='Month', yaxis_title='Number of Signups')
         st.plotly_chart(fig_trial_trend, use_container_width=True)
 
         # Conversion Rate Over Time
         st.subheader("Conversion Rate Over Time")
-        conversion_data = trial_trend.copy()
-        conversion_data['converted'] = conversion_data['paid']
-        conversion_rate_over_time = conversion_data.groupby('trial_month').agg(
-            trial_clients=('client_id', 'nunique'),
-            converted_clients=('converted', 'sum')
-        ).reset_index()
-        conversion_rate_over_time['conversion_rate'] = (
-            conversion_rate_over_time['converted_clients'] / conversion_rate_over_time['trial_clients']
-        ) * 100
-        fig_conversion_rate = px.line(
-            conversion_rate_over_time,
+        fig_conversion_rate = figure_cache.figure(
+            "conversion_rate",
+            px.line,
+            results["conversion_rate_over_time"],
+            layout=dict(xaxis_title='Month', yaxis_title='Conversion Rate (%)'),
             x='trial_month',
             y='conversion_rate',
             title='Conversion Rate Over Time',
             markers=True
         )
-        fig_conversion_rate.update_layout(xaxis_title='Month', yaxis_title='Conversion Rate (%)')
         st.plotly_chart(fig_conversion_rate, use_container_width=True)
 
     # --- AI Assistant Tab ---
-    with tabs[1]:
+    # Not memoized: it uploads the data and streams answers
+    @tab_registry.register("AI Assistant", inputs=("df_filtered",))
+    def render_ai_assistant(df_filtered):
         # Call the function from ai_assistant.py
         ai_assistant_tab(df_filtered)
 
     # --- Client Segmentation Tab ---
-    with tabs[2]:
+    @tab_registry.register("Client Segmentation", inputs=("df_filtered",), compute=compute_segmentation)
+    def render_segmentation(results):
         st.header("Client Segmentation")
 
         # Country Distribution
         st.subheader("Country Distribution")
-        country_distribution = df_filtered['country'].value_counts().reset_index()
-        country_distribution.columns = ['Country', 'Number of Clients']
-        fig_country = px.pie(
-            country_distribution,
+        fig_country = figure_cache.figure(
+            "country_distribution",
+            px.pie,
+            results["country_distribution"],
             values='Number of Clients',
             names='Country',
             title='Clients by Country',
@@ -158,11 +185,11 @@ if df is not None:
 
         # Signup Source Analysis
         st.subheader("Signup Source Analysis")
-        if 'click_source' in df_filtered.columns:
-            click_source_counts = df_filtered['click_source'].value_counts().reset_index()
-            click_source_counts.columns = ['Click Source', 'Number of Clients']
-            fig_click_source = px.pie(
-                click_source_counts,
+        if results["click_source_counts"] is not None:
+            fig_click_source = figure_cache.figure(
+                "click_source",
+                px.pie,
+                results["click_source_counts"],
                 values='Number of Clients',
                 names='Click Source',
                 title='Clients by Signup Source',
@@ -173,22 +200,16 @@ if df is not None:
             st.write("The 'click_source' column is not available in the data.")
 
     # --- Activity and Usage Tab ---
-    with tabs[3]:
+    @tab_registry.register("Activity and Usage", inputs=("df_filtered", "marketplaces"), compute=compute_activity)
+    def render_activity(results):
         st.header("Activity and Usage")
 
         # Client Activation Rates by Marketplace
         st.subheader("Client Activation Rates by Marketplace")
-        activation_data = df_filtered.copy()
-        activation_data['active_status'] = activation_data['active'].map({1: 'Active', 0: 'Inactive'})
-        marketplace_activation = activation_data.groupby('active_status')[marketplaces].sum().reset_index()
-        marketplace_activation = pd.melt(
-            marketplace_activation,
-            id_vars='active_status',
-            var_name='Marketplace',
-            value_name='Connections'
-        )
-        fig_activation = px.bar(
-            marketplace_activation,
+        fig_activation = figure_cache.figure(
+            "marketplace_activation",
+            px.bar,
+            results["marketplace_activation"],
             x='Marketplace',
             y='Connections',
             color='active_status',
@@ -199,11 +220,10 @@ if df is not None:
 
         # Mobile vs. Desktop Signup
         st.subheader("Mobile vs. Desktop Signup")
-        signup_method_counts = df_filtered['mobile_signup'].value_counts().reset_index()
-        signup_method_counts.columns = ['mobile_signup', 'count']
-        signup_method_counts['Signup Method'] = signup_method_counts['mobile_signup'].map({1: 'Mobile', 0: 'Desktop'})
-        fig_signup_method = px.pie(
-            signup_method_counts,
+        fig_signup_method = figure_cache.figure(
+            "signup_method",
+            px.pie,
+            results["signup_method_counts"],
             values='count',
             names='Signup Method',
             title='Mobile vs. Desktop Signup',
@@ -213,54 +233,49 @@ if df is not None:
 
         # Top Performing Marketplaces
         st.subheader("Top Performing Marketplaces")
-        marketplace_totals = df_filtered[marketplaces].sum().reset_index()
-        marketplace_totals.columns = ['Marketplace', 'Total Connections']
-        fig_marketplace = px.bar(
-            marketplace_totals,
+        fig_marketplace = figure_cache.figure(
+            "marketplace_totals",
+            px.bar,
+            results["marketplace_totals"],
+            layout=dict(xaxis_title='Marketplace', yaxis_title='Total Connections'),
             x='Marketplace',
             y='Total Connections',
             title='Total Marketplace Connections',
             color='Total Connections',
             color_continuous_scale='Blues'
         )
-        fig_marketplace.update_layout(xaxis_title='Marketplace', yaxis_title='Total Connections')
         st.plotly_chart(fig_marketplace, use_container_width=True)
 
-
     # --- Cohort Retention Analysis Tab ---
-    with tabs[4]:
+    @tab_registry.register("Cohort Retention Analysis", inputs=("df_filtered",), compute=compute_cohort_retention)
+    def render_cohort_retention(results):
         st.header("Cohort Retention Analysis")
-
-        # Convert 'trial_date' to datetime and group by cohort month
-        df_filtered['trial_month'] = df_filtered['trial_date'].dt.to_period('M')
-        cohort_data = df_filtered.groupby('trial_month').agg(
-            total_users=('client_id', 'size'),
-            connected=('connected', 'sum'),
-            active=('active', 'sum'),
-            paid=('paid', 'sum')
-        ).reset_index()
-
-        cohort_data['connected_rate'] = cohort_data['connected'] / cohort_data['total_users'] * 100
-        cohort_data['active_rate'] = cohort_data['active'] / cohort_data['total_users'] * 100
-        cohort_data['paid_rate'] = cohort_data['paid'] / cohort_data['total_users'] * 100
-
-        fig_cohort_retention = go.Figure()
-        fig_cohort_retention.add_trace(go.Scatter(x=cohort_data['trial_month'].astype(str),
-                                                y=cohort_data['connected_rate'], mode='lines+markers', name='Connected Rate'))
-        fig_cohort_retention.add_trace(go.Scatter(x=cohort_data['trial_month'].astype(str),
-                                                y=cohort_data['active_rate'], mode='lines+markers', name='Active Rate'))
-        fig_cohort_retention.add_trace(go.Scatter(x=cohort_data['trial_month'].astype(str),
-                                                y=cohort_data['paid_rate'], mode='lines+markers', name='Paid Rate'))
-
-        fig_cohort_retention.update_layout(
-            title="Cohort Retention Analysis",
-            xaxis_title="Cohort Month",
-            yaxis_title="Retention Rate (%)",
-            legend_title="Retention Stage"
+        fig_cohort_retention = figure_cache.figure(
+            "cohort_retention",
+            cohort_retention_figure,
+            results["cohort_data"],
+            layout=dict(
+                title="Cohort Retention Analysis",
+                xaxis_title="Cohort Month",
+                yaxis_title="Retention Rate (%)",
+                legend_title="Retention Stage"
+            )
         )
 
         # Display the plot
         st.plotly_chart(fig_cohort_retention, use_container_width=True)
 
+    # Inputs of the tabs, only evaluated when the selected tab needs them
+    tab_registry.render_selected({
+        "df_filtered": functools.cache(lambda: filter_countries(df, countries)),
+        "kpi_cube": lambda: get_kpi_cube(data_version, df),
+        "countries": lambda: countries,
+        "marketplaces": lambda: MARKETPLACES,
+    }, filter_state)
+    print(f"Figure cache: \t {figure_cache.stats()}")
+
+    # Spans of this run, or of the latest question asked to the assistant, when enabled
+    perf.render_perf_panel(st.sidebar, st.session_state)
+
 else:
     st.write("Please upload a CSV file to begin.")
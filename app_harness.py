@@ -0,0 +1,266 @@
+"""
+app_harness.py
+
+Drives the apps through Streamlit's AppTest against the local fake OpenAI server, and
+reports the cost of rendering each streamed delta and the wall time of each question, e.g.
+`python app_harness.py dave --chars 20000 --delta-ms 1`, or `python app_harness.py assistant --local`
+to run the code in the local code executor. `--explore-steps 3 --no-profile` measures the tool
+calls the dataset profile saves, and `python app_harness.py restore --repeat 50` the restore of a
+long conversation from the transcript database.
+
+Every event of the run stream is timed from the moment the SDK dispatches it until the
+handler callbacks (and the Streamlit updates they make) return.
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+import dataset_profile
+from fake_openai import FakeOpenAIServer, FakeTiming, synthetic_script
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# The script AppTest runs for the AI assistant tab, which is not an app of its own
+ASSISTANT_TAB_SCRIPT = """
+from schema import normalize_frame
+from synthetic_data import generate_clients
+from ai_assistant import ai_assistant_tab
+
+ai_assistant_tab(normalize_frame(generate_clients({n_clients})))
+"""
+
+
+class EventTimer:
+    """
+    Times the dispatch of each run stream event to the handler
+    """
+    def __init__(self):
+        self.seconds: dict[str, list[float]] = {}
+        self.first_event_at = None
+        self.first_delta_at = None
+
+    def install(self):
+        from openai import AssistantEventHandler
+
+        emit = AssistantEventHandler._emit_sse_event
+        timer = self
+
+        def timed_emit(handler, event):
+            start = time.perf_counter()
+            if timer.first_event_at is None:
+                timer.first_event_at = start
+            if timer.first_delta_at is None and event.event == "thread.message.delta":
+                timer.first_delta_at = start
+            try:
+                return emit(handler, event)
+            finally:
+                timer.seconds.setdefault(event.event, []).append(time.perf_counter() - start)
+
+        AssistantEventHandler._emit_sse_event = timed_emit
+
+    def reset(self):
+        self.seconds = {}
+        self.first_event_at = None
+        self.first_delta_at = None
+
+    def report(self, question_start: float) -> dict:
+        deltas = sorted(self.seconds.get("thread.message.delta", []) + self.seconds.get("thread.run.step.delta", []))
+        handler_seconds = sum(sum(seconds) for seconds in self.seconds.values())
+        return {
+            "events": {event: len(seconds) for event, seconds in self.seconds.items()},
+            "deltas": len(deltas),
+            "delta_mean_ms": statistics.fmean(deltas) * 1e3 if deltas else 0.0,
+            "delta_p50_ms": deltas[len(deltas) // 2] * 1e3 if deltas else 0.0,
+            "delta_p95_ms": deltas[int(len(deltas) * 0.95)] * 1e3 if deltas else 0.0,
+            "delta_max_ms": deltas[-1] * 1e3 if deltas else 0.0,
+            "handler_seconds": handler_seconds,
+            "tool_calls": len(self.seconds.get("thread.run.step.created", [])),
+            "first_delta_seconds": self.first_delta_at - question_start if self.first_delta_at else None,
+        }
+
+
+def run_question(app, timer: EventTimer, ask) -> dict:
+    """
+    Ask a question through `ask(app)`, and report its wall time and the cost of its events
+    """
+    timer.reset()
+    start = time.perf_counter()
+    app = ask(app)
+    wall_seconds = time.perf_counter() - start
+    if app.exception:
+        raise RuntimeError(f"The app failed: {app.exception[0].message}")
+    return {"wall_seconds": wall_seconds, **timer.report(start)}
+
+
+def run_dave(server: FakeOpenAIServer, timer: EventTimer, question: str, repeat: int, timeout: float,
+             n_clients: int) -> list[dict]:
+    """
+    Ask the demo app the same question `repeat` times, each in a new session as the app takes
+    one question per session; the repeats replay the answer cache
+    """
+    from streamlit.testing.v1 import AppTest
+
+    from synthetic_data import generate_clients
+
+    dataset = generate_clients(n_clients).to_csv(index=False).encode("utf-8")
+    file_id = server.add_file("dataset.csv", dataset, "assistants")["id"]
+    # The app reads its local copy, the API does not allow to download the upload
+    os.environ["DATASET_PATH"] = os.path.join(tempfile.mkdtemp(prefix="app_harness_"), "dataset.csv")
+    with open(os.environ["DATASET_PATH"], "wb") as f:
+        f.write(dataset)
+
+    def ask(app):
+        app.text_area[0].input(question)
+        return app.button[0].click().run()
+
+    results = []
+    for _ in range(repeat):
+        app = AppTest.from_file(os.path.join(APP_DIR, "Dave.py"), default_timeout=timeout)
+        app.secrets["ASSISTANT_ID"] = "asst_fake"
+        app.secrets["FILE_ID"] = file_id
+        app.secrets["OPENAI_API_KEY"] = "sk-fake"
+        app.run()
+        results.append(run_question(app, timer, ask))
+    return results
+
+
+def assistant_tab_app(script_path: str, session_id: str, timeout: float):
+    """
+    A session of the AI assistant tab, opened at the URL of the conversation
+    """
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(script_path, default_timeout=timeout)
+    app.secrets["OPENAI_ASSISTANT_ID"] = "asst_fake"
+    app.secrets["OPENAI_API_KEY"] = "sk-fake"
+    app.query_params["session"] = session_id
+    return app
+
+
+def run_assistant_tab(server: FakeOpenAIServer, timer: EventTimer, question: str, repeat: int, timeout: float,
+                      n_clients: int, restore: bool = False) -> list[dict]:
+    """
+    Ask the AI assistant tab `repeat` questions in the same session, so in the same thread; then,
+    if `restore`, reconnect to the conversation in a new session, and report the restore
+    """
+    script_path = os.path.join(tempfile.mkdtemp(prefix="app_harness_"), "assistant_tab.py")
+    with open(script_path, "w") as f:
+        f.write(ASSISTANT_TAB_SCRIPT.format(n_clients=n_clients))
+    session_id = uuid.uuid4().hex
+    app = assistant_tab_app(script_path, session_id, timeout)
+    app.run()
+
+    results = []
+    for _ in range(repeat):
+        results.append(run_question(app, timer, lambda app: app.chat_input[0].set_value(question).run()))
+
+    if restore:
+        app = assistant_tab_app(script_path, session_id, timeout)
+        requests = server.requests.copy()
+        start = time.perf_counter()
+        app.run()
+        wall_seconds = time.perf_counter() - start
+        if app.exception:
+            raise RuntimeError(f"The app failed: {app.exception[0].message}")
+        results.append({"wall_seconds": wall_seconds, "restored_messages": len(app.chat_message),
+                        "restore_requests": dict(server.requests - requests)})
+    return results
+
+
+def run_restore(server: FakeOpenAIServer, timer: EventTimer, question: str, repeat: int, timeout: float,
+                n_clients: int) -> list[dict]:
+    return run_assistant_tab(server, timer, question, repeat, timeout, n_clients, restore=True)
+
+
+def print_results(name: str, results: list[dict], requests: Counter):
+    print(f"{name}:")
+    for i, result in enumerate(results, 1):
+        if "restored_messages" in result:
+            print(f"  restore: wall {result['wall_seconds']:.3f}s, {result['restored_messages']} messages shown, "
+                  f"requests {result['restore_requests']}")
+            continue
+        first_delta = result["first_delta_seconds"]
+        print(f"  question {i}: wall {result['wall_seconds']:.3f}s, "
+              f"first delta {f'{first_delta:.3f}s' if first_delta is not None else '-'}, "
+              f"{result['deltas']} deltas, per delta mean {result['delta_mean_ms']:.3f}ms "
+              f"p50 {result['delta_p50_ms']:.3f}ms p95 {result['delta_p95_ms']:.3f}ms "
+              f"max {result['delta_max_ms']:.3f}ms, handler total {result['handler_seconds']:.3f}s, "
+              f"{result['tool_calls']} tool calls")
+    print(f"  requests: {dict(sorted(requests.items()))}")
+
+
+APPS = {
+    "dave": run_dave,
+    "assistant": run_assistant_tab,
+    "restore": run_restore,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help=f"Apps to drive, among {', '.join(APPS)}")
+    parser.add_argument("--question", default="How did the conversion rate evolve by month?")
+    parser.add_argument("--repeat", type=int, default=2, help="Questions asked in the same session")
+    parser.add_argument("--chars", type=int, default=2_000, help="Characters of each text part of the answer")
+    parser.add_argument("--code-steps", type=int, default=1, help="Code interpreter calls of the answer")
+    parser.add_argument("--delta-chars", type=int, default=4, help="Characters per streamed delta")
+    parser.add_argument("--delta-ms", type=float, default=0.0, help="Delay between streamed deltas")
+    parser.add_argument("--first-event-ms", type=float, default=0.0, help="Delay before the first event of a run")
+    parser.add_argument("--step-ms", type=float, default=0.0, help="Delay before each message or tool call")
+    parser.add_argument("--explore-steps", type=int, default=0,
+                        help="Calls exploring the data ahead of the answer, skipped when the thread has the profile")
+    parser.add_argument("--no-profile", action="store_true", help="Start the threads without the dataset profile")
+    parser.add_argument("--clients", type=int, default=1_000, help="Rows of the dataset")
+    parser.add_argument("--local", action="store_true",
+                        help="Run the code in the local code executor, through function calls")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Timeout of each AppTest run, in seconds")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    unknown = set(args.names) - set(APPS)
+    if unknown:
+        parser.error(f"unknown apps: {', '.join(sorted(unknown))}")
+
+    timing = FakeTiming(first_event_ms=args.first_event_ms, step_ms=args.step_ms,
+                        delta_ms=args.delta_ms, delta_chars=args.delta_chars)
+    script = synthetic_script(n_chars=args.chars, n_code_steps=args.code_steps, function_calls=args.local,
+                              n_explore_steps=args.explore_steps)
+    report = {}
+    with FakeOpenAIServer(script, timing) as server:
+        # Point the apps at the fake server, and keep their caches and files out of the repository
+        work_dir = tempfile.mkdtemp(prefix="app_harness_")
+        os.environ.update({
+            "OPENAI_BASE_URL": server.base_url,
+            "OPENAI_API_KEY": "sk-fake",
+            "ANSWER_CACHE_PATH": os.path.join(work_dir, "answer_cache.sqlite3"),
+            "CLEANUP_LEDGER_PATH": os.path.join(work_dir, "cleanup_ledger.json"),
+            "SNAPSHOT_DIR": os.path.join(work_dir, "snapshots"),
+            "TRANSCRIPT_DIR": os.path.join(work_dir, "transcripts"),
+            "CODE_EXECUTION_BACKEND": "local" if args.local else "remote",
+        })
+        # Read by the apps when they import it, after the fake server did
+        dataset_profile.DATASET_PROFILE_ENABLED = not args.no_profile
+        # The apps read the key from the secrets when they import `utils`
+        os.makedirs(os.path.join(work_dir, ".streamlit"))
+        with open(os.path.join(work_dir, ".streamlit", "secrets.toml"), "w") as f:
+            f.write('OPENAI_API_KEY = "sk-fake"\n')
+        os.chdir(work_dir)
+        # Imported ahead of the scripts, so that its deprecation warnings are not the first Streamlit call
+        import utils  # noqa: F401
+
+        timer = EventTimer()
+        timer.install()
+        for name in args.names or list(APPS):
+            server.requests.clear()
+            results = APPS[name](server, timer, args.question, args.repeat, args.timeout, args.clients)
+            print_results(name, results, server.requests)
+            report[name] = results
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"args": vars(args), "results": report}, f, indent=2)
+        print(f"Results written to {output}")
@@ -0,0 +1,247 @@
+"""
+attachment_tracker.py
+"""
+import base64
+import contextvars
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+import pandas as pd
+from PIL import Image
+
+# Config
+ATTACHMENT_WORKERS = 8
+# Decoded attachments kept in memory, across sessions
+ARTIFACT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class Artifact:
+    """
+    An attachment of the assistant, decoded for display: a PNG image, or markdown (an HTML table
+    for a CSV file, a download link otherwise) appended to the answer
+    """
+    __slots__ = ("file_id", "file_name", "kind", "data")
+
+    def __init__(self, file_id: str, file_name: str, kind: str, data):
+        """
+        Args:
+        - file_id (str): The id of the file
+        - file_name (str): The base name of the file
+        - kind (str): `image`, `table` or `file`
+        - data (bytes | str): The PNG bytes of an image, or the markdown of a table or file
+        """
+        self.file_id = file_id
+        self.file_name = file_name
+        self.kind = kind
+        self.data = data
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+def decode_attachment(file_id: str, file_name: str, content: bytes) -> Artifact:
+    """
+    Decode an attachment for display
+
+    Args:
+    - file_id (str): The id of the file
+    - file_name (str): The base name of the file
+    - content (bytes): The content of the file
+
+    Returns:
+    - Artifact: The decoded attachment
+    """
+    if file_name.endswith(('.png', '.jpg', '.jpeg')):
+        # Convert image bytes to displayable format
+        image = Image.open(io.BytesIO(content))
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG")
+        return Artifact(file_id, file_name, "image", buffered.getvalue())
+    if file_name.endswith('.csv'):
+        df = pd.read_csv(io.BytesIO(content))
+        return Artifact(file_id, file_name, "table", f"\n\n{df.to_html(index=False, escape=False)}")
+    # Other file types as download links
+    return Artifact(file_id, file_name, "file",
+                    f"\n\n[Download {file_name}](data:file/{file_name.split('.')[-1]};base64,"
+                    f"{base64.b64encode(content).decode()})")
+
+
+class ArtifactCache:
+    """
+    Process-wide LRU cache of the decoded attachments, keyed by file id, bounded in bytes.
+    A file id always refers to the same content.
+    """
+    def __init__(self, max_bytes: int = ARTIFACT_CACHE_MAX_BYTES):
+        """
+        Args:
+        - max_bytes (int): Total size of the artifacts kept before evicting
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._entries: "OrderedDict[str, Artifact]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_id: str) -> Optional[Artifact]:
+        with self._lock:
+            artifact = self._entries.get(file_id)
+            if artifact is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(file_id)
+            self.hits += 1
+            return artifact
+
+    def put(self, artifact: Artifact) -> None:
+        with self._lock:
+            previous = self._entries.pop(artifact.file_id, None)
+            if previous is not None:
+                self._bytes -= previous.size
+            self._entries[artifact.file_id] = artifact
+            self._bytes += artifact.size
+            # Keep at least the latest artifact, however large
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Return the hit rate and the size of the cache
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+class AttachmentTracker:
+    """
+    Tracks the attachments of the assistant already handled in each thread, so that each question
+    only scans the messages created since the previous one, and only fetches the new attachments.
+
+    Per thread, the tracker keeps the id of the last message scanned, the file ids handled, and the
+    file ids which failed to download, retried on the next scan. New attachments are fetched and
+    decoded concurrently, through the artifact cache.
+    """
+    def __init__(self,
+                 list_fn: Callable[[str, Optional[str]], Tuple[list[str], Optional[str]]],
+                 fetch_fn: Callable[[str], Tuple[str, bytes]],
+                 cache: ArtifactCache,
+                 max_workers: int = ATTACHMENT_WORKERS):
+        """
+        Args:
+        - list_fn (Callable): Lists the file ids attached to the assistant messages of a thread created
+          after a message id (or all of them for None), and returns them with the id of the last message
+        - fetch_fn (Callable): Downloads a file, and returns its base name and its content
+        - cache (ArtifactCache): The decoded attachments, shared across the sessions
+        - max_workers (int): Number of attachments fetched at once
+        """
+        self.list_fn = list_fn
+        self.fetch_fn = fetch_fn
+        self.cache = cache
+        self.max_workers = max_workers
+        self.scans = 0
+        self.fetched = 0
+        self.failed = 0
+        # thread id -> id of the last message scanned
+        self._cursors: dict[str, Optional[str]] = {}
+        # thread id -> file ids handled
+        self._processed: dict[str, set[str]] = {}
+        # thread id -> file ids to retry
+        self._pending: dict[str, list[str]] = {}
+
+    def collect(self, thread_id: str) -> list[Artifact]:
+        """
+        Fetch and decode the attachments of the thread which were not handled yet
+
+        Args:
+        - thread_id (str): The id of the thread
+
+        Returns:
+        - list[Artifact]: The new attachments, in the order of the messages; the ones which failed
+          to download are left out, and retried on the next call
+        """
+        file_ids, cursor = self.list_fn(thread_id, self._cursors.get(thread_id))
+        self.scans += 1
+        self._cursors[thread_id] = cursor
+        processed = self._processed.setdefault(thread_id, set())
+        new_file_ids = [file_id for file_id in dict.fromkeys(self._pending.pop(thread_id, []) + file_ids)
+                        if file_id not in processed]
+        if not new_file_ids:
+            return []
+
+        # Fetch the attachments not cached yet at once, in copies of this context for the spans
+        artifacts = {file_id: self.cache.get(file_id) for file_id in new_file_ids}
+        missing = [file_id for file_id, artifact in artifacts.items() if artifact is None]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as executor:
+                futures = {file_id: executor.submit(contextvars.copy_context().run, self._fetch, file_id)
+                           for file_id in missing}
+            for file_id, future in futures.items():
+                try:
+                    artifacts[file_id] = future.result()
+                    self.fetched += 1
+                except Exception as e:
+                    print(f"Failed to fetch attachment: \t {file_id} ({e})")
+                    self.failed += 1
+                    self._pending.setdefault(thread_id, []).append(file_id)
+
+        collected = []
+        for file_id in new_file_ids:
+            artifact = artifacts.get(file_id)
+            if artifact is not None:
+                processed.add(file_id)
+                collected.append(artifact)
+        return collected
+
+    def cursor(self, thread_id: str) -> Optional[str]:
+        """
+        Return the id of the last message scanned in the thread, or None
+        """
+        return self._cursors.get(thread_id)
+
+    def resume(self, thread_id: str, cursor: Optional[str]) -> None:
+        """
+        Resume the scans of a thread after a message, e.g. for a restored session whose earlier
+        attachments are already in its transcript
+        """
+        self._cursors[thread_id] = cursor
+
+    def forget(self, thread_id: str) -> None:
+        """
+        Drop the state of a thread, e.g. once deleted
+        """
+        self._cursors.pop(thread_id, None)
+        self._processed.pop(thread_id, None)
+        self._pending.pop(thread_id, None)
+
+    def stats(self) -> dict:
+        """
+        Return the number of scans, and of attachments fetched and failed
+        """
+        return {
+            "scans": self.scans,
+            "fetched": self.fetched,
+            "failed": self.failed,
+            "threads": len(self._cursors),
+            "cache": self.cache.stats(),
+        }
+
+    def _fetch(self, file_id: str) -> Artifact:
+        file_name, content = self.fetch_fn(file_id)
+        artifact = decode_attachment(file_id, file_name, content)
+        self.cache.put(artifact)
+        return artifact
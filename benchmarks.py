@@ -0,0 +1,573 @@
+"""
+benchmarks.py
+
+Run with `python benchmarks.py <name>` (or without arguments to run everything but the suite).
+
+The suite times the dashboard on synthetic sheets, and can be compared across commits:
+`python benchmarks.py suite --sizes 10000 1000000 --output before.json`, then
+`python benchmarks.py suite --sizes 10000 1000000 --baseline before.json`.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+# Benchmarks never reach the API, but importing `utils` requires a key in the secrets, which
+# Streamlit looks up in the working directory it is imported from
+_secrets_dir = tempfile.mkdtemp(prefix="benchmarks_")
+os.makedirs(os.path.join(_secrets_dir, ".streamlit"))
+with open(os.path.join(_secrets_dir, ".streamlit", "secrets.toml"), "w") as _f:
+    _f.write('OPENAI_API_KEY = "sk-benchmark"\n')
+_cwd = os.getcwd()
+os.chdir(_secrets_dir)
+import streamlit  # noqa: E402,F401
+os.chdir(_cwd)
+
+from dataset_export import EXPORT_FORMATS, export_frame
+from dashboard import (
+    compute_activity,
+    compute_cohort_retention,
+    compute_overview,
+    compute_segmentation,
+    filter_countries,
+    )
+from kpi_cube import KpiCube, filtered_kpis
+from openai_client import build_openai_client
+from schema import memory_footprint, normalize_frame
+from synthetic_data import generate_clients
+from transcript import BlobStore, Transcript
+import utils
+from utils import StreamingLinkStripper, remove_links, retrieve_assistant_created_files
+
+
+def bench_export(n_rows: int = 200_000, repeat: int = 3) -> dict:
+    """
+    Compare bytes uploaded and serialisation time of each export format
+    """
+    df = generate_clients(n_rows)
+    df["trial_date"] = pd.to_datetime(df["trial_date"])
+    results = {}
+    for export_format in EXPORT_FORMATS:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            buffer, _ = export_frame(df, export_format)
+            timings.append(time.perf_counter() - start)
+        results[export_format] = {
+            "bytes": buffer.getbuffer().nbytes,
+            "seconds": min(timings),
+        }
+
+    baseline = results["csv"]
+    print(f"Export of {n_rows:,} rows")
+    for export_format, result in results.items():
+        print(f"{export_format:>8}: {result['bytes'] / 1e6:8.2f} MB "
+              f"({result['bytes'] / baseline['bytes']:5.1%} of csv) "
+              f"{result['seconds'] * 1e3:8.1f} ms "
+              f"({result['seconds'] / baseline['seconds']:5.1%} of csv)")
+    return results
+
+
+def synthetic_answer(n_chars: int, seed: int = 0) -> list[str]:
+    """
+    Build a streamed markdown answer, split into token-sized deltas
+    """
+    rng = np.random.default_rng(seed)
+    fragments = [
+        "The conversion rate ", "rose by 4.2% ", "in March. ", "\n\n", "- Top market: UK ",
+        "[chart](sandbox:/mnt/data/chart.png)", "\n", "1. Amazon ", "connections grew\n",
+        "See [the file](sandbox:/mnt/data/out.csv) for details. ", "| month | rate |\n",
+    ]
+    text = ""
+    while len(text) < n_chars:
+        text += fragments[rng.integers(len(fragments))]
+    deltas = []
+    position = 0
+    while position < len(text):
+        size = int(rng.integers(1, 8))
+        deltas.append(text[position:position + size])
+        position += size
+    return deltas
+
+
+def bench_link_stripper(sizes: tuple = (2_000, 10_000, 20_000)) -> dict:
+    """
+    Compare re-running `remove_links` per delta against `StreamingLinkStripper`
+    """
+    results = {}
+    for n_chars in sizes:
+        deltas = synthetic_answer(n_chars)
+
+        start = time.perf_counter()
+        text = ""
+        for delta in deltas:
+            text = remove_links(text + delta)
+        rescan_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        stripper = StreamingLinkStripper()
+        for delta in deltas:
+            stripper.feed(delta)
+            stripper.text
+        stripper.flush()
+        streaming_seconds = time.perf_counter() - start
+
+        assert stripper.text == remove_links("".join(deltas))
+        results[n_chars] = {"deltas": len(deltas),
+                            "rescan_seconds": rescan_seconds,
+                            "streaming_seconds": streaming_seconds}
+        print(f"{n_chars:>8,} chars / {len(deltas):>6,} deltas: "
+              f"rescan {rescan_seconds * 1e3:9.1f} ms, streaming {streaming_seconds * 1e3:9.1f} ms")
+    return results
+
+
+class FakeMessagesClient:
+    """
+    Local stand-in for `client.beta.threads.messages`, counting the API calls
+    """
+    def __init__(self, n_messages: int, files_per_message: int = 1):
+        self.calls = {"list": 0, "retrieve": 0}
+        self.messages = [
+            SimpleNamespace(
+                id=f"msg_{i:05d}",
+                role="assistant" if i % 2 else "user",
+                attachments=[SimpleNamespace(file_id=f"file_{i:05d}_{j}") for j in range(files_per_message)] if i % 2 else [],
+            )
+            for i in range(n_messages)
+        ]
+        self.beta = SimpleNamespace(threads=SimpleNamespace(messages=self))
+
+    def list(self, thread_id, order="desc", after=None, limit=20):
+        """
+        Return the first page; iterating it fetches the next pages, like the SDK cursor pages
+        """
+        self.calls["list"] += 1
+        messages = self.messages if order == "asc" else self.messages[::-1]
+        start = 0
+        if after is not None:
+            start = [message.id for message in messages].index(after) + 1
+        page = messages[start:start + limit]
+
+        def iterate():
+            yield from page
+            if start + limit < len(messages) and page:
+                yield from self.list(thread_id, order=order, after=page[-1].id, limit=limit)
+        return iterate()
+
+    def retrieve(self, message_id, thread_id):
+        self.calls["retrieve"] += 1
+        return next(message for message in self.messages if message.id == message_id)
+
+
+def bench_attachment_scan(n_messages: int = 250) -> dict:
+    """
+    Count the API calls made when scanning a thread for assistant-created files, in full and
+    after a cursor; the tracker itself is tested in `tests/test_attachment_tracker.py`
+    """
+    fake_client = FakeMessagesClient(n_messages)
+    real_client, utils.client = utils.client, fake_client
+    try:
+        _, cursor = retrieve_assistant_created_files("thread_fake")
+        full_scan_calls = dict(fake_client.calls)
+
+        # New messages after the cursor: only these are examined
+        fake_client.calls = {"list": 0, "retrieve": 0}
+        fake_client.messages += [SimpleNamespace(id="msg_new", role="assistant",
+                                                 attachments=[SimpleNamespace(file_id="file_new")])]
+        retrieve_assistant_created_files("thread_fake", after=cursor)
+        incremental_calls = dict(fake_client.calls)
+    finally:
+        utils.client = real_client
+
+    print(f"{n_messages} messages: {full_scan_calls['list']} list calls, "
+          f"{full_scan_calls['retrieve']} retrieve calls (previously 1 list + {n_messages // 2} retrieve); "
+          f"{incremental_calls['list']} list call for a new message after the cursor")
+    return {"messages": n_messages, "calls": full_scan_calls, "incremental_calls": incremental_calls}
+
+
+def bench_transcript(n_questions: int = 300, memory_bytes: int = 256 * 1024,
+                     blob_cache_bytes: int = 8 * 1024 * 1024) -> dict:
+    """
+    Compare the memory held by a long conversation kept as dicts in the session state, with inline
+    image bytes and HTML tables, against the transcript store
+    """
+    table = pd.DataFrame(np.random.default_rng(0).normal(size=(150, 6))).to_html(index=False)
+    text = "".join(synthetic_answer(3_000))
+
+    def conversation():
+        for question in range(n_questions):
+            answer = f"{text} ({question})"
+            code = f"df.groupby('month')['rate'].mean()  # {question}\n" * 12
+            output = "month\n2024-01    3.1\n2024-02    4.2\n" * 30
+            # Every figure and table of the conversation is different
+            image = question.to_bytes(4, "big") + os.urandom(60_000)
+            yield f"Question {question}?", answer, code, output, image, f"<!-- {question} -->{table}"
+
+    def held_bytes(build) -> tuple:
+        tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            kept = build()
+            seconds = time.perf_counter() - start
+            held, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return kept, {"held_bytes": held, "peak_bytes": peak, "seconds": seconds}
+
+    def chat_history():
+        history = []
+        for prompt, answer, code, output, image, table_html in conversation():
+            history.append({'role': 'user', 'content': prompt})
+            history.append({'role': 'assistant', 'content': answer + table_html, 'code': code, 'output': output,
+                            'image': [image]})
+        return history
+
+    directory = tempfile.mkdtemp(prefix="transcript_bench_")
+
+    def transcript_store():
+        transcript = Transcript(BlobStore(os.path.join(directory, "blobs"), max_bytes=blob_cache_bytes),
+                                memory_bytes=memory_bytes, directory=directory)
+        for prompt, answer, code, output, image, table_html in conversation():
+            transcript.begin_turn("user")
+            transcript.add("text", prompt)
+            transcript.begin_turn("assistant")
+            transcript.add("text", answer)
+            transcript.add("code", code)
+            transcript.add("output", output)
+            transcript.add_blob("image", image)
+            transcript.add_blob("markdown", table_html.encode("utf-8"))
+        return transcript
+
+    _, before = held_bytes(chat_history)
+    transcript, after = held_bytes(transcript_store)
+    # A rerun renders the whole conversation, reading the spilled turns back
+    start = time.perf_counter()
+    turns = sum(1 for _ in transcript.turns())
+    after["render_seconds"] = time.perf_counter() - start
+    stats = transcript.stats()
+    transcript.close()
+
+    print(f"{n_questions} questions: session state {before['held_bytes'] / 1e6:.1f} MB held in "
+          f"{before['seconds']:.2f}s -> transcript {after['held_bytes'] / 1e6:.1f} MB held "
+          f"(peak {after['peak_bytes'] / 1e6:.1f} MB, blob cache {blob_cache_bytes / 1e6:.1f} MB) in "
+          f"{after['seconds']:.2f}s; {stats['spilled']}/{turns} turns spilled, "
+          f"read back in {after['render_seconds'] * 1e3:.0f} ms")
+    return {"questions": n_questions, "session_state": before, "transcript": after, "stats": stats}
+
+
+def bench_kpi_cube(n_rows: int = 300_000, n_subsets: int = 20) -> dict:
+    """
+    Compare the time per filter change of the KPI cube and of the pandas KPIs; their values are
+    cross-checked in `tests/test_kpi_cube.py`
+    """
+    rng = np.random.default_rng(1)
+    df = generate_clients(n_rows)
+    # Some clients appear under several countries, some rows have no trial or no country
+    df.loc[rng.choice(n_rows, n_rows // 10, replace=False), "client_id"] = rng.integers(0, n_rows // 20, n_rows // 10)
+    df.loc[rng.choice(n_rows, n_rows // 20, replace=False), "trial_date"] = None
+    df.loc[rng.choice(n_rows, n_rows // 100, replace=False), "country"] = None
+    df["trial_date"] = pd.to_datetime(df["trial_date"])
+
+    start = time.perf_counter()
+    cube = KpiCube(df)
+    build_seconds = time.perf_counter() - start
+
+    all_countries = df["country"].dropna().unique()
+    cube_seconds = pandas_seconds = 0.0
+    for _ in range(n_subsets):
+        countries = list(rng.choice(all_countries, rng.integers(0, len(all_countries) + 1), replace=False))
+
+        start = time.perf_counter()
+        filtered_kpis(df[df["country"].isin(countries)])
+        pandas_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        cube.kpis(countries)
+        cube_seconds += time.perf_counter() - start
+
+    print(f"KPIs over {n_rows:,} rows, {n_subsets} country subsets: "
+          f"build {build_seconds * 1e3:.1f} ms, pandas {pandas_seconds / n_subsets * 1e3:.2f} ms/filter, "
+          f"cube {cube_seconds / n_subsets * 1e3:.2f} ms/filter")
+    return {"build_seconds": build_seconds,
+            "pandas_seconds_per_filter": pandas_seconds / n_subsets,
+            "cube_seconds_per_filter": cube_seconds / n_subsets}
+
+
+def bench_normalize(n_rows: int = 1_000_000) -> dict:
+    """
+    Report the memory footprint of the sheet before and after normalisation
+    """
+    df = generate_clients(n_rows)
+    before = memory_footprint(df)
+    start = time.perf_counter()
+    normalized = normalize_frame(df)
+    seconds = time.perf_counter() - start
+    after = memory_footprint(normalized)
+    print(f"Normalise {n_rows:,} rows: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB "
+          f"({after / before:.1%}) in {seconds * 1e3:.0f} ms")
+    return {"bytes_before": before, "bytes_after": after, "seconds": seconds}
+
+
+# Rows of the synthetic sheets of the suite; pass `--sizes 10000 1000000 10000000` for the largest
+SUITE_SIZES = (10_000, 1_000_000)
+
+# The computed tabs of the dashboard, as (inputs, compute) pairs
+DASHBOARD_TABS = {
+    "Overview": (("df_filtered", "kpi_cube", "countries"), compute_overview),
+    "Client Segmentation": (("df_filtered",), compute_segmentation),
+    "Activity and Usage": (("df_filtered",), compute_activity),
+    "Cohort Retention Analysis": (("df_filtered",), compute_cohort_retention),
+}
+
+
+def bench_lazy_tabs(n_rows: int = 500_000) -> dict:
+    """
+    Compare, per rerun, computing every tab (as with `st.tabs`) against computing only the
+    selected tab through the tab result cache
+    """
+    from tab_registry import Tab, TabResultCache
+
+    df = normalize_frame(generate_clients(n_rows))
+    kpi_cube = KpiCube(df)
+    all_countries = df["country"].dropna().unique().tolist()
+    tabs = {name: Tab(name, render=None, compute=compute, inputs=inputs)
+            for name, (inputs, compute) in DASHBOARD_TABS.items()}
+
+    # A session: browse the tabs, change the filter, browse again
+    reruns = [(name, all_countries) for name in tabs] + [(name, all_countries[:2]) for name in tabs] \
+        + [(name, all_countries) for name in tabs]
+
+    result_cache = TabResultCache()
+    eager_seconds, lazy_seconds = [], []
+    for selected, countries in reruns:
+        providers = {
+            "df_filtered": lambda countries=countries: filter_countries(df, countries),
+            "kpi_cube": lambda: kpi_cube,
+            "countries": lambda countries=countries: countries,
+        }
+        start = time.perf_counter()
+        df_filtered = filter_countries(df, countries)
+        for tab in tabs.values():
+            inputs = {"df_filtered": df_filtered, "kpi_cube": kpi_cube, "countries": countries}
+            tab.compute(**{name: inputs[name] for name in tab.inputs})
+        eager_seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        result_cache.get_or_compute(tabs[selected], providers, ("v1", tuple(sorted(countries))))
+        lazy_seconds.append(time.perf_counter() - start)
+
+    print(f"Tabs over {n_rows:,} rows, {len(reruns)} reruns:")
+    for (selected, countries), eager, lazy in zip(reruns, eager_seconds, lazy_seconds):
+        print(f"  {selected:<26} {len(countries)} countries: all tabs {eager * 1e3:8.1f} ms, "
+              f"selected tab {lazy * 1e3:8.1f} ms")
+    print(f"  total: all tabs {sum(eager_seconds):.2f} s, selected tab {sum(lazy_seconds):.2f} s "
+          f"({result_cache.hits} cached)")
+    return {"eager_seconds": eager_seconds, "lazy_seconds": lazy_seconds}
+
+
+class ModelsHandler(BaseHTTPRequestHandler):
+    """
+    Answers `GET /v1/models` with an empty list, keeping the connection alive
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = b'{"object": "list", "data": []}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_client(n_requests: int = 200) -> dict:
+    """
+    Compare the round-trip latency of a client built per request (cold connections) against
+    the shared client (warm connections).
+
+    Runs against a local server unless `OPENAI_BASE_URL` is set; over the internet the
+    cold connections also pay for DNS and the TLS handshake.
+    """
+    base_url = os.environ.get("OPENAI_BASE_URL")
+    server = None
+    if base_url is None:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ModelsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    api_key = os.environ.get("OPENAI_API_KEY", "sk-benchmark")
+
+    try:
+        cold_seconds = []
+        for _ in range(n_requests):
+            start = time.perf_counter()
+            with build_openai_client(api_key, base_url=base_url) as client:
+                client.models.list()
+            cold_seconds.append(time.perf_counter() - start)
+
+        warm_seconds = []
+        with build_openai_client(api_key, base_url=base_url) as client:
+            client.models.list()
+            for _ in range(n_requests):
+                start = time.perf_counter()
+                client.models.list()
+                warm_seconds.append(time.perf_counter() - start)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    results = {"base_url": base_url,
+               "cold_median_seconds": float(np.median(cold_seconds)),
+               "warm_median_seconds": float(np.median(warm_seconds))}
+    print(f"{n_requests} requests to {base_url}: "
+          f"cold {results['cold_median_seconds'] * 1e3:.2f} ms, "
+          f"warm {results['warm_median_seconds'] * 1e3:.2f} ms (median round trip)")
+    return results
+
+
+def measure(fn, repeat: int = 3) -> tuple:
+    """
+    Time `fn` (best of `repeat`), then run it once more under tracemalloc for its peak memory
+
+    Returns:
+    - Any: The result of `fn`
+    - dict: `seconds` and `peak_bytes`
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+
+    # Traced separately, as tracing slows the allocations down
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {"seconds": min(timings), "peak_bytes": peak_bytes}
+
+
+def git_commit() -> str:
+    """
+    Return the short hash of the checked out commit, or "unknown" outside a git checkout
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_suite(sizes: tuple = SUITE_SIZES, output: str = None, baseline: str = None) -> dict:
+    """
+    Time each stage of the dashboard, and each tab's aggregations, on synthetic sheets of
+    increasing size, independently of Streamlit
+
+    Args:
+    - sizes (tuple): Numbers of rows of the synthetic sheets
+    - output (str): Path of the JSON results, for comparison with later runs
+    - baseline (str): Path of the JSON results of an earlier run to compare against
+    """
+    results = {}
+    for n_rows in sizes:
+        # Larger sheets are too slow to time more than once
+        repeat = 3 if n_rows <= 1_000_000 else 1
+        raw = generate_clients(n_rows, shared_client_fraction=0.05)
+        stages = {}
+        df, stages["normalize"] = measure(lambda: normalize_frame(raw), repeat)
+        del raw
+        kpi_cube, stages["kpi_cube"] = measure(lambda: KpiCube(df), repeat)
+        # Countries by number of clients: every country selected, then the two largest only
+        all_countries = df["country"].value_counts().index.tolist()
+
+        for label, countries in (("all", all_countries), ("subset", all_countries[:2])):
+            df_filtered, stages[f"filter[{label}]"] = measure(lambda: filter_countries(df, countries), repeat)
+            inputs = {"df_filtered": df_filtered, "kpi_cube": kpi_cube, "countries": countries}
+            for tab, (tab_inputs, compute) in DASHBOARD_TABS.items():
+                _, stages[f"{tab}[{label}]"] = measure(
+                    lambda: compute(**{name: inputs[name] for name in tab_inputs}), repeat)
+        results[str(n_rows)] = stages
+
+        print(f"Dashboard over {n_rows:,} rows:")
+        for stage, result in stages.items():
+            print(f"  {stage:<34} {result['seconds'] * 1e3:10.1f} ms {result['peak_bytes'] / 1e6:10.1f} MB peak")
+
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output}")
+    if baseline:
+        compare_results(baseline, report)
+    return report
+
+
+def compare_results(baseline: str, report: dict):
+    """
+    Print the time and peak memory of each stage relative to an earlier run
+    """
+    with open(baseline) as f:
+        previous = json.load(f)
+    print(f"Compared to {previous['commit']} ({previous['created']}):")
+    for n_rows, stages in report["results"].items():
+        previous_stages = previous["results"].get(n_rows, {})
+        for stage, result in stages.items():
+            if stage not in previous_stages:
+                continue
+            before = previous_stages[stage]
+            print(f"  {int(n_rows):>12,} {stage:<34} "
+                  f"time {result['seconds'] / max(before['seconds'], 1e-9):7.2f}x "
+                  f"peak {result['peak_bytes'] / max(before['peak_bytes'], 1):7.2f}x")
+
+
+BENCHMARKS = {
+    "export": bench_export,
+    "links": bench_link_stripper,
+    "attachments": bench_attachment_scan,
+    "transcript": bench_transcript,
+    "kpis": bench_kpi_cube,
+    "normalize": bench_normalize,
+    "tabs": bench_lazy_tabs,
+    "client": bench_client,
+    "suite": bench_suite,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help=f"Benchmarks to run, among {', '.join(BENCHMARKS)}")
+    parser.add_argument("--sizes", nargs="+", type=int, default=SUITE_SIZES,
+                        help="Rows of the synthetic sheets of the suite, e.g. 10000 1000000 10000000")
+    parser.add_argument("--output", help="Write the suite results to this JSON file")
+    parser.add_argument("--baseline", help="Compare the suite results to this JSON file")
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    for name in args.names or [name for name in BENCHMARKS if name != "suite"]:
+        if name == "suite":
+            bench_suite(tuple(args.sizes), args.output, args.baseline)
+        else:
+            BENCHMARKS[name]()
@@ -0,0 +1,182 @@
+"""
+cleanup.py
+"""
+import heapq
+import json
+import os
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+# Config
+CLEANUP_LEDGER_PATH = os.environ.get("CLEANUP_LEDGER_PATH", ".cleanup_ledger.json")
+CLEANUP_BATCH_SIZE = 20
+CLEANUP_MAX_ATTEMPTS = 6
+CLEANUP_BACKOFF_SECONDS = 1.0
+
+
+class CleanupWorker:
+    """
+    Background worker deleting files and threads.
+
+    Deletions are queued and processed in batches by a daemon thread. Failed deletions
+    are retried with exponential backoff. Pending deletions are kept in a JSON ledger,
+    so that they are resumed after a restart.
+    """
+    def __init__(self,
+                 deleters: dict[str, Callable[[str], object]],
+                 ledger_path: Optional[str] = CLEANUP_LEDGER_PATH,
+                 batch_size: int = CLEANUP_BATCH_SIZE,
+                 max_attempts: int = CLEANUP_MAX_ATTEMPTS,
+                 backoff_seconds: float = CLEANUP_BACKOFF_SECONDS):
+        """
+        Args:
+        - deleters (dict): Delete function for each kind of resource, e.g. `{"file": client.files.delete}`
+        - ledger_path (str): Path of the ledger of pending deletions, or None to keep it in memory only
+        - batch_size (int): Maximum number of deletions processed before the ledger is saved
+        - max_attempts (int): Number of attempts before a deletion is given up
+        - backoff_seconds (float): Delay before the first retry, doubled on each attempt
+        """
+        self.deleters = deleters
+        self.ledger_path = ledger_path
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.deleted = 0
+        self.failures = 0
+        self.retries = 0
+        self._queue: "queue.Queue[tuple[str, str, int]]" = queue.Queue()
+        self._delayed: list[tuple[float, str, str, int]] = []
+        self._pending: set[tuple[str, str]] = set()
+        self._lock = threading.Lock()
+
+        # Resume the deletions left over by a previous process
+        for kind, resource_id in self._load_ledger():
+            self._pending.add((kind, resource_id))
+            self._queue.put((kind, resource_id, 0))
+
+        self._thread = threading.Thread(target=self._run, name="cleanup-worker", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, kind: str, resource_id: str) -> None:
+        """
+        Schedule the deletion of a resource
+
+        Args:
+        - kind (str): The kind of resource, a key of `deleters`
+        - resource_id (str): The id of the resource to delete
+        """
+        if kind not in self.deleters:
+            raise ValueError(f"Unknown resource kind: {kind}")
+        with self._lock:
+            if (kind, resource_id) in self._pending:
+                return
+            self._pending.add((kind, resource_id))
+            self._save_ledger()
+        self._queue.put((kind, resource_id, 0))
+
+    def metrics(self) -> dict:
+        """
+        Return the queue depth and deletion counters
+        """
+        return {
+            "queue_depth": self._queue.qsize() + len(self._delayed),
+            "pending": len(self._pending),
+            "deleted": self.deleted,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
+
+    def join(self, timeout: float = 10.0) -> bool:
+        """
+        Wait until no deletion is pending
+
+        Returns:
+        - bool: True if all deletions completed within the timeout
+        """
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self._pending
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._next_item()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            completed = []
+            for kind, resource_id, attempt in batch:
+                if self._delete(kind, resource_id, attempt):
+                    completed.append((kind, resource_id))
+
+            if completed:
+                with self._lock:
+                    self._pending.difference_update(completed)
+                    self._save_ledger()
+
+    def _next_item(self) -> tuple[str, str, int]:
+        """
+        Block until a queued deletion, or a retry whose backoff has elapsed, is available
+        """
+        while True:
+            if self._delayed and self._delayed[0][0] <= time.monotonic():
+                _, kind, resource_id, attempt = heapq.heappop(self._delayed)
+                return kind, resource_id, attempt
+            timeout = max(0.0, self._delayed[0][0] - time.monotonic()) if self._delayed else None
+            try:
+                return self._queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+
+    def _delete(self, kind: str, resource_id: str, attempt: int) -> bool:
+        """
+        Attempt a deletion, scheduling a retry if it fails
+
+        Returns:
+        - bool: True if the resource no longer needs deleting
+        """
+        try:
+            self.deleters[kind](resource_id)
+            self.deleted += 1
+            print(f"Deleted {kind}: \t {resource_id}")
+            return True
+        except Exception as e:
+            # Already deleted
+            if getattr(e, "status_code", None) == 404:
+                return True
+            if attempt + 1 >= self.max_attempts:
+                self.failures += 1
+                print(f"Giving up deleting {kind} {resource_id}: {e}")
+                return True
+            self.retries += 1
+            retry_at = time.monotonic() + self.backoff_seconds * 2 ** attempt
+            heapq.heappush(self._delayed, (retry_at, kind, resource_id, attempt + 1))
+            return False
+
+    def _load_ledger(self) -> list[tuple[str, str]]:
+        if not self.ledger_path or not os.path.exists(self.ledger_path):
+            return []
+        try:
+            with open(self.ledger_path, encoding="utf-8") as file:
+                return [(kind, resource_id) for kind, resource_id in json.load(file)
+                        if kind in self.deleters]
+        except (OSError, ValueError) as e:
+            print(f"Failed to read cleanup ledger {self.ledger_path}: {e}")
+            return []
+
+    def _save_ledger(self) -> None:
+        if not self.ledger_path:
+            return
+        # Write to a temporary file first, so a crash never leaves a truncated ledger
+        temp_path = f"{self.ledger_path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(sorted(self._pending), file)
+            os.replace(temp_path, self.ledger_path)
+        except OSError as e:
+            print(f"Failed to write cleanup ledger {self.ledger_path}: {e}")
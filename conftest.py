@@ -0,0 +1,5 @@
+"""
+conftest.py
+
+Lets the tests under `tests/` import the modules of the repository, e.g. `python -m pytest tests`
+"""
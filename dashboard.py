@@ -0,0 +1,115 @@
+"""
+dashboard.py
+
+Aggregations behind each dashboard tab, independent of Streamlit
+"""
+import pandas as pd
+
+from kpi_cube import KpiCube
+from schema import MARKETPLACES
+
+
+def filter_countries(df: pd.DataFrame, countries: list) -> pd.DataFrame:
+    """
+    Filter the data based on the selected countries
+    """
+    return df[df['country'].isin(countries)]
+
+
+def compute_overview(df_filtered: pd.DataFrame, kpi_cube: KpiCube, countries: list) -> dict:
+    """
+    Aggregates of the Overview tab
+    """
+    # KPIs for the selected countries, combined from the per-country cube
+    kpis = kpi_cube.kpis(countries)
+
+    # Trial Signup Trend Over Time
+    trial_trend = df_filtered[df_filtered['trial_date'].notna()]
+    trial_counts = trial_trend.groupby('trial_month')['client_id'].nunique().reset_index()
+
+    # Conversion Rate Over Time
+    conversion_rate_over_time = trial_trend.groupby('trial_month').agg(
+        trial_clients=('client_id', 'nunique'),
+        converted_clients=('paid', 'sum')
+    ).reset_index()
+    conversion_rate_over_time['conversion_rate'] = (
+        conversion_rate_over_time['converted_clients'] / conversion_rate_over_time['trial_clients']
+    ) * 100
+
+    return {
+        "kpis": kpis,
+        "trial_counts": trial_counts,
+        "conversion_rate_over_time": conversion_rate_over_time,
+    }
+
+
+def compute_segmentation(df_filtered: pd.DataFrame) -> dict:
+    """
+    Aggregates of the Client Segmentation tab
+    """
+    # Country Distribution, dropping the unselected countries still listed as categories
+    country_distribution = df_filtered['country'].value_counts()
+    country_distribution = country_distribution[country_distribution > 0].reset_index()
+    country_distribution.columns = ['Country', 'Number of Clients']
+
+    # Signup Source Analysis
+    click_source_counts = None
+    if 'click_source' in df_filtered.columns:
+        click_source_counts = df_filtered['click_source'].value_counts()
+        click_source_counts = click_source_counts[click_source_counts > 0].reset_index()
+        click_source_counts.columns = ['Click Source', 'Number of Clients']
+
+    return {
+        "country_distribution": country_distribution,
+        "click_source_counts": click_source_counts,
+    }
+
+
+def compute_activity(df_filtered: pd.DataFrame, marketplaces: list[str] = MARKETPLACES) -> dict:
+    """
+    Aggregates of the Activity and Usage tab
+    """
+    # Client Activation Rates by Marketplace
+    active_status = df_filtered['active'].map({1: 'Active', 0: 'Inactive'}).rename('active_status')
+    marketplace_activation = df_filtered.groupby(active_status)[marketplaces].sum().reset_index()
+    marketplace_activation = pd.melt(
+        marketplace_activation,
+        id_vars='active_status',
+        var_name='Marketplace',
+        value_name='Connections'
+    )
+
+    # Mobile vs. Desktop Signup
+    signup_method_counts = df_filtered['mobile_signup'].value_counts().reset_index()
+    signup_method_counts.columns = ['mobile_signup', 'count']
+    signup_method_counts['Signup Method'] = signup_method_counts['mobile_signup'].map({1: 'Mobile', 0: 'Desktop'})
+
+    # Top Performing Marketplaces
+    marketplace_totals = df_filtered[marketplaces].sum().reset_index()
+    marketplace_totals.columns = ['Marketplace', 'Total Connections']
+
+    return {
+        "marketplace_activation": marketplace_activation,
+        "signup_method_counts": signup_method_counts,
+        "marketplace_totals": marketplace_totals,
+    }
+
+
+def compute_cohort_retention(df_filtered: pd.DataFrame) -> dict:
+    """
+    Aggregates of the Cohort Retention Analysis tab
+    """
+    # Group by cohort month
+    cohort_data = df_filtered.groupby('trial_month').agg(
+        total_users=('client_id', 'size'),
+        connected=('connected', 'sum'),
+        active=('active', 'sum'),
+        paid=('paid', 'sum')
+    ).reset_index()
+
+    cohort_data['connected_rate'] = cohort_data['connected'] / cohort_data['total_users'] * 100
+    cohort_data['active_rate'] = cohort_data['active'] / cohort_data['total_users'] * 100
+    cohort_data['paid_rate'] = cohort_data['paid'] / cohort_data['total_users'] * 100
+    cohort_data['cohort_month'] = cohort_data['trial_month'].dt.strftime('%Y-%m')
+
+    return {"cohort_data": cohort_data}
@@ -0,0 +1,250 @@
+"""
+data_loader.py
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Callable, Optional, Tuple
+
+import pandas as pd
+
+# Config
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", ".snapshots")
+SNAPSHOT_MAX_AGE_SECONDS = 3600
+HTTP_TIMEOUT_SECONDS = 30
+
+
+class HttpSource:
+    """
+    Dataset served over HTTP, revalidated with ETag / Last-Modified
+    """
+    def __init__(self, url: str, timeout: float = HTTP_TIMEOUT_SECONDS):
+        self.url = url
+        self.timeout = timeout
+
+    @property
+    def key(self) -> str:
+        return self.url
+
+    def fetch(self, validators: dict) -> Optional[Tuple[bytes, dict]]:
+        """
+        Fetch the dataset, unless it is unchanged since the validators were issued
+
+        Args:
+        - validators (dict): The `etag` and `last_modified` of the previous fetch
+
+        Returns:
+        - (bytes, dict): The raw dataset and its new validators, or None if not modified
+        """
+        request = urllib.request.Request(self.url)
+        if validators.get("etag"):
+            request.add_header("If-None-Match", validators["etag"])
+        if validators.get("last_modified"):
+            request.add_header("If-Modified-Since", validators["last_modified"])
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.read(), {"etag": response.headers.get("ETag"),
+                                         "last_modified": response.headers.get("Last-Modified")}
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+
+
+class FileSource:
+    """
+    Dataset stored in a local file, revalidated with its size and modification time
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    @property
+    def key(self) -> str:
+        return os.path.abspath(self.path)
+
+    def fetch(self, validators: dict) -> Optional[Tuple[bytes, dict]]:
+        """
+        Read the dataset, unless the file is unchanged since the validators were issued
+
+        Args:
+        - validators (dict): The `mtime` of the previous read
+
+        Returns:
+        - (bytes, dict): The raw dataset and its new validators, or None if not modified
+        """
+        stat = os.stat(self.path)
+        mtime = f"{stat.st_mtime_ns}:{stat.st_size}"
+        if validators.get("mtime") == mtime:
+            return None
+        with open(self.path, "rb") as file:
+            return file.read(), {"mtime": mtime}
+
+
+def make_source(location: str):
+    """
+    Build the source for a URL or a local path
+    """
+    if location.startswith(("http://", "https://")):
+        return HttpSource(location)
+    return FileSource(location)
+
+
+class SnapshotLoader:
+    """
+    Serves a dataset from a local Parquet snapshot, revalidating it in the background.
+
+    Only the very first load (without any snapshot on disk) waits for the source.
+    Afterwards, once the snapshot is older than `max_age_seconds`, the stale frame is
+    returned immediately while a background thread revalidates it against the source.
+    The frame is only re-parsed when the content hash of the source has changed.
+
+    The frame and its content hash are swapped together, and `get` returns both at once, so that
+    the caches keyed by the hash never pair it with the frame of another version.
+    """
+    def __init__(self,
+                 source,
+                 snapshot_dir: str = SNAPSHOT_DIR,
+                 max_age_seconds: float = SNAPSHOT_MAX_AGE_SECONDS,
+                 parse: Callable[[bytes], pd.DataFrame] = lambda data: pd.read_csv(io.BytesIO(data)),
+                 version: str = ""):
+        """
+        Args:
+        - source: Object with a `key` and a `fetch(validators)` method, e.g. `HttpSource` or `FileSource`
+        - snapshot_dir (str): Directory where the snapshots are stored
+        - max_age_seconds (float): Age after which the snapshot is revalidated
+        - parse (Callable): Parses the raw dataset into a dataframe
+        - version (str): Version of `parse`; snapshots parsed by another version are not reused
+        """
+        self.source = source
+        self.max_age_seconds = max_age_seconds
+        self.parse = parse
+        name = hashlib.sha256(f"{source.key}\x1f{version}".encode("utf-8")).hexdigest()[:16]
+        self.snapshot_path = os.path.join(snapshot_dir, f"{name}.parquet")
+        self.meta_path = os.path.join(snapshot_dir, f"{name}.json")
+        self.df: Optional[pd.DataFrame] = None
+        self.meta: dict = {}
+        self.refreshes = 0
+        self.last_error: Optional[Exception] = None
+        self._lock = threading.Lock()
+        # Held by the first load, so that concurrent first loads fetch the source once
+        self._first_load_lock = threading.Lock()
+        self._refreshing = False
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+    @property
+    def content_hash(self) -> Optional[str]:
+        """
+        Hash of the raw dataset the frame was parsed from
+        """
+        with self._lock:
+            return self.meta.get("content_hash")
+
+    def get(self) -> Tuple[pd.DataFrame, str]:
+        """
+        Return the dataset, starting a background revalidation if the snapshot is stale
+
+        Returns:
+        - pd.DataFrame: The dataset
+        - str: The hash of the raw dataset it was parsed from, e.g. to key the caches of its results
+        """
+        with self._lock:
+            if self.df is None:
+                self._load_snapshot()
+            df, meta = self.df, self.meta
+        if df is None:
+            # No snapshot yet: this load has to wait for the source, once for all the callers
+            with self._first_load_lock:
+                with self._lock:
+                    df, meta = self.df, self.meta
+                if df is None:
+                    self.refresh()
+                    with self._lock:
+                        df, meta = self.df, self.meta
+        elif time.time() - meta.get("checked_at", 0) > self.max_age_seconds:
+            self.refresh_in_background()
+        return df, meta["content_hash"]
+
+    def refresh_in_background(self) -> None:
+        """
+        Revalidate the snapshot in a background thread, unless a revalidation is already running
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, name="snapshot-refresh", daemon=True).start()
+
+    def refresh(self) -> bool:
+        """
+        Revalidate the snapshot against the source
+
+        Returns:
+        - bool: True if the dataset changed
+        """
+        with self._lock:
+            df, previous = self.df, self.meta
+        fetched = self.source.fetch(previous.get("validators", {}) if df is not None else {})
+        meta = dict(previous, checked_at=time.time())
+        changed = False
+        if fetched is not None:
+            data, validators = fetched
+            meta["validators"] = validators
+            content_hash = hashlib.sha256(data).hexdigest()
+            # The source may not support validators: compare the content itself
+            if content_hash != previous.get("content_hash") or df is None:
+                df = self.parse(data)
+                meta["content_hash"] = content_hash
+                self._write_snapshot(df)
+                changed = True
+        # The frame and its metadata are swapped together
+        with self._lock:
+            self.df, self.meta = df, meta
+            self.refreshes += 1
+        self._write_meta(meta)
+        return changed
+
+    def _background_refresh(self) -> None:
+        try:
+            if self.refresh():
+                print(f"Refreshed snapshot: \t {self.snapshot_path}")
+            self.last_error = None
+        except Exception as e:
+            # Keep serving the stale snapshot
+            self.last_error = e
+            print(f"Failed to refresh snapshot {self.snapshot_path}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _load_snapshot(self) -> None:
+        if not (os.path.exists(self.snapshot_path) and os.path.exists(self.meta_path)):
+            return
+        try:
+            with open(self.meta_path, encoding="utf-8") as file:
+                self.meta = json.load(file)
+            self.df = pd.read_parquet(self.snapshot_path)
+        except (OSError, ValueError) as e:
+            print(f"Failed to read snapshot {self.snapshot_path}: {e}")
+            self.meta = {}
+            self.df = None
+
+    def _write_snapshot(self, df: pd.DataFrame) -> None:
+        try:
+            df.to_parquet(f"{self.snapshot_path}.tmp", index=False)
+            os.replace(f"{self.snapshot_path}.tmp", self.snapshot_path)
+        except Exception as e:
+            # Columns with mixed types cannot be stored as Parquet; keep the frame in memory only,
+            # and drop any older snapshot so that it is not served after a restart
+            print(f"Failed to write snapshot {self.snapshot_path}: {e}")
+            if os.path.exists(self.snapshot_path):
+                os.remove(self.snapshot_path)
+
+    def _write_meta(self, meta: dict) -> None:
+        with open(f"{self.meta_path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+        os.replace(f"{self.meta_path}.tmp", self.meta_path)
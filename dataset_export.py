@@ -0,0 +1,96 @@
+"""
+dataset_export.py
+"""
+import io
+from typing import Tuple
+
+import pandas as pd
+
+# Config
+EXPORT_FORMATS = ("csv", "parquet", "feather")
+FLAG_COLUMNS = ["active", "paid", "connected", "mobile_signup"]
+CATEGORY_COLUMNS = ["country", "click_source"]
+DATE_COLUMNS = ["trial_date"]
+
+
+def downcast_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcast the dataframe to compact dtypes before export
+
+    Args:
+    - df (pd.DataFrame): The dataframe to downcast
+
+    Returns:
+    - pd.DataFrame: A downcast copy of the dataframe
+    """
+    df = df.copy()
+    for column in FLAG_COLUMNS:
+        if column in df.columns:
+            flags = pd.to_numeric(df[column], errors="coerce")
+            # Use the nullable integer type only when there are missing flags
+            df[column] = flags.astype("Int8" if flags.isna().any() else "int8")
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+    for column in DATE_COLUMNS:
+        if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column], errors="coerce")
+    for column in df.select_dtypes(include="float64").columns:
+        df[column] = df[column].astype("float32")
+    return df
+
+
+def export_frame(df: pd.DataFrame, export_format: str = "csv") -> Tuple[io.BytesIO, str]:
+    """
+    Serialise the dataframe for upload to the code interpreter
+
+    Args:
+    - df (pd.DataFrame): The dataframe to export
+    - export_format (str): One of `csv`, `parquet` or `feather`
+
+    Returns:
+    - io.BytesIO: Buffer positioned at the start of the serialised data
+    - str: The file name to upload the buffer as
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {export_format}")
+
+    buffer = io.BytesIO()
+    if export_format == "csv":
+        df.to_csv(buffer, index=False)
+    elif export_format == "parquet":
+        downcast_frame(df).to_parquet(buffer, index=False)
+    else:
+        downcast_frame(df).reset_index(drop=True).to_feather(buffer)
+    buffer.seek(0)  # Reset buffer position to the start
+
+    file_name = f"data.{export_format}"
+    # The upload uses the buffer name to infer the file type
+    buffer.name = file_name
+    return buffer, file_name
+
+
+def loader_stub(export_format: str = "csv") -> str:
+    """
+    Instructions telling the assistant how to load the uploaded dataset
+
+    Args:
+    - export_format (str): The format the dataset was exported as
+
+    Returns:
+    - str: Instructions containing a short loader snippet
+    """
+    reader = {
+        "csv": "pd.read_csv(path)",
+        "parquet": "pd.read_parquet(path)",
+        "feather": "pd.read_feather(path)",
+    }[export_format]
+    return (
+        f"The dataset is attached as a {export_format} file. Load it with:\n"
+        "```python\n"
+        "import glob\n"
+        "import pandas as pd\n"
+        "path = sorted(glob.glob('/mnt/data/*'))[0]\n"
+        f"df = {reader}\n"
+        "```"
+    )
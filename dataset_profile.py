@@ -0,0 +1,132 @@
+"""
+dataset_profile.py
+
+Compact summary of a dataset (dtypes, null rates, cardinalities, top values, date ranges and
+numeric quantiles), given to the assistant ahead of the questions so that it does not spend
+code interpreter turns on `df.head()`, `df.info()` and `value_counts()` to learn the schema.
+"""
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# Config
+DATASET_PROFILE_ENABLED = os.environ.get("DATASET_PROFILE", "1") == "1"
+# Numeric columns with at most this many distinct values get their top values rather than quantiles
+PROFILE_MAX_CATEGORIES = 50
+PROFILE_TOP_VALUES = 5
+# Columns beyond this are only listed, to keep the profile compact
+PROFILE_MAX_COLUMNS = 60
+# Distinct values sampled to tell whether a text column holds dates
+PROFILE_DATE_SAMPLE = 1_000
+PROFILE_QUANTILES = [0.0, 0.25, 0.5, 0.75, 1.0]
+# First line of the profile, by which a thread holding it can be recognised
+PROFILE_HEADER = "Dataset profile"
+
+
+def _parse_dates(values: pd.Index) -> Optional[pd.Index]:
+    """
+    Parse the distinct values of a text column as ISO 8601 dates, or return None if they are not dates
+    """
+    sample = values[:PROFILE_DATE_SAMPLE]
+    if len(sample) == 0 or not all(isinstance(value, str) for value in sample):
+        return None
+    try:
+        pd.to_datetime(sample, format="ISO8601")
+    except (ValueError, TypeError, OverflowError):
+        return None
+    return pd.to_datetime(values, format="ISO8601", errors="coerce")
+
+
+def profile_column(series: pd.Series) -> dict:
+    """
+    Profile a column from a single hash pass over its values: every statistic is then computed
+    from the distinct values and their counts, e.g. the quantiles from the cumulative counts
+
+    Args:
+    - series (pd.Series): The column
+
+    Returns:
+    - dict: The dtype, null rate and number of distinct values of the column, and its date range,
+      its quantiles and mean, or its top values
+    """
+    counts = series.value_counts(dropna=True, sort=False)
+    # Categories that do not occur are counted as 0
+    counts = counts[counts > 0]
+    non_null = int(counts.sum())
+    entry = {
+        "name": str(series.name),
+        "dtype": str(series.dtype),
+        "null_rate": 1 - non_null / len(series) if len(series) else 0.0,
+        "distinct": len(counts),
+    }
+    if entry["distinct"] == 0:
+        return entry
+
+    dates = None
+    if pd.api.types.is_datetime64_any_dtype(series):
+        dates = counts.index
+    elif series.dtype == object:
+        dates = _parse_dates(counts.index)
+        if dates is not None:
+            entry["dtype"] += " (dates)"
+    numeric = pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+
+    if dates is not None:
+        entry["range"] = [str(dates.min()), str(dates.max())]
+    elif numeric and entry["distinct"] > PROFILE_MAX_CATEGORIES:
+        counts = counts.sort_index()
+        values = counts.index.to_numpy(dtype="float64")
+        cumulative = counts.to_numpy().cumsum()
+        # Nearest-rank quantiles
+        ranks = np.asarray(PROFILE_QUANTILES) * (non_null - 1)
+        entry["quantiles"] = values[np.searchsorted(cumulative, ranks, side="right")].tolist()
+        entry["mean"] = float(values @ counts.to_numpy() / non_null)
+    else:
+        top = counts.nlargest(PROFILE_TOP_VALUES)
+        entry["top"] = [[str(value), int(count)] for value, count in top.items()]
+    return entry
+
+
+def profile_frame(df: pd.DataFrame) -> dict:
+    """
+    Compute the profile of a dataframe
+
+    Args:
+    - df (pd.DataFrame): The dataset
+
+    Returns:
+    - dict: The number of rows and columns, and the profile of each column, in order
+    """
+    columns = [profile_column(df.iloc[:, position]) for position in range(min(df.shape[1], PROFILE_MAX_COLUMNS))]
+    return {"rows": len(df), "n_columns": df.shape[1], "columns": columns}
+
+
+def _number(value: float) -> str:
+    return f"{value:.4g}"
+
+
+def format_profile(profile: dict) -> str:
+    """
+    Render the profile as compact text, one line per column
+    """
+    rows = profile["rows"]
+    lines = [f"{PROFILE_HEADER}: {rows:,} rows, {profile['n_columns']} columns. "
+             f"Use it instead of exploring the data with head(), info() or value_counts()."]
+    for column in profile["columns"]:
+        line = (f"- {column['name']} ({column['dtype']}): {column['null_rate']:.1%} null, "
+                f"{column['distinct']:,} distinct")
+        if "range" in column:
+            line += f"; from {column['range'][0]} to {column['range'][1]}"
+        elif "quantiles" in column:
+            minimum, p25, median, p75, maximum = (_number(value) for value in column["quantiles"])
+            line += (f"; min {minimum}, p25 {p25}, median {median}, p75 {p75}, max {maximum}, "
+                     f"mean {_number(column['mean'])}")
+        elif "top" in column:
+            top = ", ".join(f"{value[:40]} ({count / rows:.1%})" for value, count in column["top"])
+            line += f"; top: {top}"
+        lines.append(line)
+    if profile["n_columns"] > len(profile["columns"]):
+        lines.append(f"- ... and {profile['n_columns'] - len(profile['columns'])} more columns")
+    return "\n".join(lines)
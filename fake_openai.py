@@ -0,0 +1,595 @@
+"""
+fake_openai.py
+
+Local stand-in for the subset of the OpenAI API the apps use: assistants, threads,
+messages, streamed runs, files and moderations. Runs replay a scripted answer as
+server-sent events, with configurable timing, so that the apps can be exercised and
+benchmarked offline, e.g.
+
+    with FakeOpenAIServer(synthetic_script(n_chars=5_000)) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        ...
+"""
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+from answer_cache import RecordedAnswer
+from dataset_profile import PROFILE_HEADER
+
+
+class FakeTiming:
+    """
+    Delays of the scripted runs
+    """
+    __slots__ = ("first_event_ms", "step_ms", "delta_ms", "delta_chars")
+
+    def __init__(self, first_event_ms: float = 0.0, step_ms: float = 0.0, delta_ms: float = 0.0, delta_chars: int = 4):
+        """
+        Args:
+        - first_event_ms (float): Delay before the first event of a run
+        - step_ms (float): Delay before each message or tool call, e.g. the code execution time
+        - delta_ms (float): Delay between consecutive deltas
+        - delta_chars (int): Number of characters per text or code delta
+        """
+        self.first_event_ms = first_event_ms
+        self.step_ms = step_ms
+        self.delta_ms = delta_ms
+        self.delta_chars = delta_chars
+
+
+def synthetic_script(n_chars: int = 2_000, n_code_steps: int = 1, image: bool = True, attachment: bool = True,
+                     function_calls: bool = False, n_explore_steps: int = 0) -> list:
+    """
+    Build a scripted answer: text, code with its logs, an image and a file to download
+
+    Args:
+    - n_chars (int): Number of characters of each text part
+    - n_code_steps (int): Number of code interpreter calls
+    - image (bool): Whether the answer shows an image
+    - attachment (bool): Whether the answer offers a CSV file for download
+    - function_calls (bool): Whether the code is run by `run_python` function calls, for the local code
+      execution, rather than by the code interpreter; the code then plots the image
+    - n_explore_steps (int): Number of calls exploring the data ahead of the answer, e.g. `df.info()`,
+      skipped when the thread starts with the profile of the dataset
+
+    Returns:
+    - list: `(kind, *payload)` steps, as played by `FakeOpenAIServer`
+    """
+    sentence = ("The conversion rate rose by 4.2% in March, see [the chart](sandbox:/mnt/data/chart.png). "
+                "- Top market: UK\n1. Amazon connections grew\n| month | rate |\n")
+    text = (sentence * (n_chars // len(sentence) + 1))[:n_chars]
+    script = []
+    for step in range(n_explore_steps):
+        code = ["df.info()", "df.head()", "df.nunique()", "df.isna().mean()", "df.describe()"][step % 5]
+        if function_calls:
+            script.append(("explore", ("function", f"{code}  # {step}\n")))
+        else:
+            script.append(("explore", ("code", f"{code}  # {step}\n", "<class 'pandas.core.frame.DataFrame'>\n")))
+    script.append(("text", text))
+    for step in range(n_code_steps):
+        if function_calls:
+            plot = "df.select_dtypes('number').iloc[:, :2].hist(figsize=(6, 3))\n" if image and step == 0 else ""
+            script.append(("function", f"print(df.shape)  # {step}\n{plot}df.describe().T.head()\n"))
+        else:
+            script.append(("code", f"import pandas as pd\ndf = pd.read_csv(files[0])\nprint(df.groupby('month').size())  # {step}\n",
+                           "month\n2024-01    120\n2024-02    131\n"))
+    if image and not function_calls:
+        # A 1x1 PNG
+        script.append(("image", bytes.fromhex(
+            "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+            "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082")))
+    script.append(("text", text))
+    if attachment:
+        script.append(("attachment", "conversion_by_month.csv", b"month,rate\n2024-01,3.1\n2024-02,4.2\n"))
+    return script
+
+
+def script_from_answer(answer: RecordedAnswer) -> list:
+    """
+    Build a script replaying a recorded answer, e.g. one from the answer cache
+    """
+    script = []
+    for kind, payload in answer.events:
+        if kind == "text_delta":
+            script.append(("text", payload))
+        elif kind == "code_input":
+            script.append(("code", payload, ""))
+        elif kind == "logs" and script and script[-1][0] == "code":
+            script[-1] = ("code", script[-1][1], script[-1][2] + payload)
+        elif kind == "image":
+            blob_index, _ = payload
+            script.append(("image", answer.blobs[blob_index]))
+    for blob_index, file_name in answer.downloads:
+        script.append(("attachment", file_name, answer.blobs[blob_index]))
+    return script
+
+
+class FakeOpenAIServer:
+    """
+    Threaded HTTP server answering like the OpenAI API, counting the requests per endpoint
+    """
+    def __init__(self, script: Optional[list] = None, timing: Optional[FakeTiming] = None,
+                 host: str = "127.0.0.1", port: int = 0):
+        """
+        Args:
+        - script (list): The answer played by every run, see `synthetic_script`
+        - timing (FakeTiming): Delays of the runs
+        - host (str): Interface to listen on
+        - port (int): Port to listen on, 0 for any free port
+        """
+        self.script = script if script is not None else synthetic_script()
+        self.timing = timing or FakeTiming()
+        self.requests: Counter = Counter()
+        self.files: dict[str, dict] = {}
+        self.threads: dict[str, list[dict]] = {}
+        self.runs: dict[str, "ScriptedRun"] = {}
+        # assistant id -> tool resources, as last updated
+        self.assistants: dict[str, dict] = {}
+        self.deleted: set[str] = set()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def new_id(self, prefix: str) -> str:
+        with self._lock:
+            return f"{prefix}_{next(self._ids):06d}"
+
+    def add_file(self, filename: str, content: bytes, purpose: str) -> dict:
+        file = {"id": self.new_id("file"), "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+        with self._lock:
+            self.files[file["id"]] = {"object": file, "content": content}
+        return file
+
+    def add_message(self, thread_id: str, role: str, text: str, attachments: Optional[list] = None,
+                    run_id: Optional[str] = None) -> dict:
+        message = {
+            "id": self.new_id("msg"), "object": "thread.message", "created_at": int(time.time()),
+            "thread_id": thread_id, "role": role, "status": "completed", "assistant_id": None, "run_id": run_id,
+            "attachments": attachments or [], "metadata": {},
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}] if text else [],
+        }
+        with self._lock:
+            self.threads.setdefault(thread_id, []).append(message)
+        return message
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._route("GET")
+
+            def do_POST(self):
+                self._route("POST")
+
+            def do_DELETE(self):
+                self._route("DELETE")
+
+            def _route(self, method: str):
+                url = urlparse(self.path)
+                path = url.path.removeprefix("/v1")
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                for pattern, endpoint in ROUTES[method]:
+                    match = re.fullmatch(pattern, path)
+                    if match:
+                        server.requests[f"{method} {endpoint.__name__}"] += 1
+                        endpoint(server, self, body, query, *match.groups())
+                        return
+                self.send_json({"error": {"message": f"Unknown route {method} {path}"}}, status=404)
+
+            def send_json(self, payload, status: int = 200):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_bytes(self, data: bytes):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def start_events(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+
+            def send_event(self, event: str, data):
+                payload = data if isinstance(data, str) else json.dumps(data)
+                self.wfile.write(f"event: {event}\ndata: {payload}\n\n".encode("utf-8"))
+
+        return Handler
+
+
+def _json_body(body: bytes) -> dict:
+    return json.loads(body) if body else {}
+
+
+def _not_found(server, handler, resource_id: str):
+    handler.send_json({"error": {"message": f"No such resource: {resource_id}"}}, status=404)
+
+
+def _deleted(handler, resource_id: str, kind: str):
+    handler.send_json({"id": resource_id, "object": f"{kind}.deleted", "deleted": True})
+
+
+# Assistants
+
+def retrieve_assistant(server, handler, body, query, assistant_id):
+    handler.send_json({"id": assistant_id, "object": "assistant", "created_at": 0, "model": "gpt-4o",
+                       "name": "Fake assistant", "instructions": "", "tools": [{"type": "code_interpreter"}],
+                       "tool_resources": server.assistants.get(assistant_id, {}), "metadata": {}})
+
+
+def update_assistant(server, handler, body, query, assistant_id):
+    params = _json_body(body)
+    if "tool_resources" in params:
+        server.assistants[assistant_id] = params["tool_resources"]
+    retrieve_assistant(server, handler, body, query, assistant_id)
+
+
+# Files
+
+def create_file(server, handler, body, query):
+    # Multipart body: keep the file part, without its headers and the closing boundary
+    filename = re.search(rb'filename="([^"]*)"', body)
+    content = body
+    for part in re.split(rb"\r\n--[^\r\n]+\r\n", b"\r\n" + body):
+        if b"filename=" in part:
+            content = part.split(b"\r\n\r\n", 1)[1].rsplit(b"\r\n--", 1)[0]
+    handler.send_json(server.add_file(filename.group(1).decode() if filename else "upload", content, "assistants"))
+
+
+def retrieve_file(server, handler, body, query, file_id):
+    if file_id not in server.files:
+        return _not_found(server, handler, file_id)
+    handler.send_json(server.files[file_id]["object"])
+
+
+def file_content(server, handler, body, query, file_id):
+    if file_id not in server.files:
+        return _not_found(server, handler, file_id)
+    # Like the API, the files uploaded for the assistants cannot be downloaded, only their outputs
+    if server.files[file_id]["object"]["purpose"] == "assistants":
+        return handler.send_json({"error": {"message": "Not allowed to download files of purpose: assistants"}},
+                                 status=400)
+    handler.send_bytes(server.files[file_id]["content"])
+
+
+def delete_file(server, handler, body, query, file_id):
+    if server.files.pop(file_id, None) is None:
+        return _not_found(server, handler, file_id)
+    server.deleted.add(file_id)
+    _deleted(handler, file_id, "file")
+
+
+# Threads and messages
+
+def _thread(thread_id: str) -> dict:
+    return {"id": thread_id, "object": "thread", "created_at": int(time.time()), "metadata": {}, "tool_resources": {}}
+
+
+def create_thread(server, handler, body, query):
+    thread_id = server.new_id("thread")
+    with server._lock:
+        server.threads[thread_id] = []
+    for message in _json_body(body).get("messages") or []:
+        server.add_message(thread_id, message.get("role", "user"), message.get("content", ""),
+                           message.get("attachments"))
+    handler.send_json(_thread(thread_id))
+
+
+def update_thread(server, handler, body, query, thread_id):
+    if thread_id not in server.threads:
+        return _not_found(server, handler, thread_id)
+    handler.send_json(_thread(thread_id))
+
+
+def delete_thread(server, handler, body, query, thread_id):
+    if server.threads.pop(thread_id, None) is None:
+        return _not_found(server, handler, thread_id)
+    server.deleted.add(thread_id)
+    _deleted(handler, thread_id, "thread")
+
+
+def create_message(server, handler, body, query, thread_id):
+    if thread_id not in server.threads:
+        return _not_found(server, handler, thread_id)
+    params = _json_body(body)
+    content = params.get("content")
+    text = content if isinstance(content, str) else "".join(part.get("text", "") for part in content or [])
+    handler.send_json(server.add_message(thread_id, params.get("role", "user"), text, params.get("attachments")))
+
+
+def list_messages(server, handler, body, query, thread_id):
+    if thread_id not in server.threads:
+        return _not_found(server, handler, thread_id)
+    messages = list(server.threads[thread_id])
+    if query.get("order", "desc") == "desc":
+        messages.reverse()
+    if "after" in query:
+        ids = [message["id"] for message in messages]
+        messages = messages[ids.index(query["after"]) + 1:] if query["after"] in ids else []
+    limit = int(query.get("limit", 20))
+    page = messages[:limit]
+    handler.send_json({"object": "list", "data": page, "has_more": len(messages) > limit,
+                       "first_id": page[0]["id"] if page else None, "last_id": page[-1]["id"] if page else None})
+
+
+def delete_message(server, handler, body, query, thread_id, message_id):
+    messages = server.threads.get(thread_id, [])
+    with server._lock:
+        server.threads[thread_id] = [message for message in messages if message["id"] != message_id]
+    _deleted(handler, message_id, "thread.message")
+
+
+# Runs
+
+class ScriptedRun:
+    """
+    A run playing the script as stream events, pausing at each function call until its output is submitted.
+    The steps exploring the data are skipped when a message of the thread holds the profile of the dataset
+    """
+    def __init__(self, server: FakeOpenAIServer, thread_id: str, params: dict):
+        self.server = server
+        self.timing = server.timing
+        self.thread_id = thread_id
+        self.run = {"id": server.new_id("run"), "object": "thread.run", "created_at": int(time.time()),
+                    "thread_id": thread_id, "assistant_id": params.get("assistant_id"), "status": "queued",
+                    "model": "gpt-4o", "instructions": "", "tools": params.get("tools", [{"type": "code_interpreter"}]),
+                    "metadata": {}, "temperature": params.get("temperature"), "parallel_tool_calls": True,
+                    "tool_choice": params.get("tool_choice", "auto"), "truncation_strategy": {"type": "auto"},
+                    "response_format": "auto", "required_action": None}
+        self.position = 0
+        self.text_parts = []
+        self.attachments = []
+        # The function call step waiting for its output
+        self.pending_step = None
+        self.tool_outputs = []
+        self.profiled = any(part.get("text", {}).get("value", "").startswith(PROFILE_HEADER)
+                            for message in server.threads.get(thread_id, []) for part in message["content"])
+
+    def play(self, handler) -> None:
+        """
+        Stream the events of the script from the current position, until the end or a function call
+        """
+        handler.start_events()
+        try:
+            if self.pending_step is None:
+                self.pause(self.timing.first_event_ms)
+                for status, event in (("queued", "thread.run.created"), ("in_progress", "thread.run.in_progress")):
+                    self.run["status"] = status
+                    handler.send_event(event, self.run)
+            else:
+                # Resume after the function call
+                self.pending_step["status"] = "completed"
+                handler.send_event("thread.run.step.completed", self.pending_step)
+                self.pending_step = None
+                self.run.update(status="in_progress", required_action=None)
+                handler.send_event("thread.run.in_progress", self.run)
+
+            script = self.server.script
+            while self.position < len(script):
+                kind, *payload = script[self.position]
+                self.position += 1
+                if kind == "explore":
+                    if self.profiled:
+                        continue
+                    kind, *payload = payload[0]
+                self.pause(self.timing.step_ms)
+                if kind == "text":
+                    self.text_parts.append(payload[0])
+                    self.message_events(handler, "text", payload[0])
+                elif kind == "code":
+                    self.code_events(handler, *payload)
+                elif kind == "function":
+                    self.function_events(handler, payload[0])
+                    return
+                elif kind == "image":
+                    file = self.server.add_file("image.png", payload[0], "assistants_output")
+                    self.message_events(handler, "image_file", file["id"])
+                elif kind == "attachment":
+                    file_name, content = payload
+                    file = self.server.add_file(f"/mnt/data/{file_name}", content, "assistants_output")
+                    self.attachments.append({"file_id": file["id"], "tools": [{"type": "code_interpreter"}]})
+
+            # The messages of the run, as listed afterwards, carry the created files
+            self.server.add_message(self.thread_id, "assistant", "".join(self.text_parts), self.attachments,
+                                    run_id=self.run["id"])
+            self.run["status"] = "completed"
+            handler.send_event("thread.run.completed", self.run)
+            handler.send_event("done", "[DONE]")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading the stream
+            pass
+
+    def pause(self, ms: float) -> None:
+        if ms > 0:
+            time.sleep(ms / 1e3)
+
+    def chunks(self, text: str):
+        for start in range(0, len(text), self.timing.delta_chars):
+            yield text[start:start + self.timing.delta_chars]
+
+    def message_events(self, handler, content_type: str, value) -> None:
+        message = {"id": self.server.new_id("msg"), "object": "thread.message", "created_at": int(time.time()),
+                   "thread_id": self.thread_id, "role": "assistant", "status": "in_progress",
+                   "run_id": self.run["id"], "assistant_id": self.run["assistant_id"], "attachments": [],
+                   "metadata": {}, "content": []}
+        handler.send_event("thread.message.created", message)
+        if content_type == "text":
+            for chunk in self.chunks(value):
+                self.pause(self.timing.delta_ms)
+                handler.send_event("thread.message.delta", {
+                    "id": message["id"], "object": "thread.message.delta",
+                    "delta": {"content": [{"index": 0, "type": "text", "text": {"value": chunk, "annotations": []}}]}})
+            content = [{"type": "text", "text": {"value": value, "annotations": []}}]
+        else:
+            image_file = {"file_id": value}
+            handler.send_event("thread.message.delta", {
+                "id": message["id"], "object": "thread.message.delta",
+                "delta": {"content": [{"index": 0, "type": "image_file", "image_file": image_file}]}})
+            content = [{"type": "image_file", "image_file": image_file}]
+        message.update(status="completed", content=content)
+        handler.send_event("thread.message.completed", message)
+
+    def tool_call_step(self, handler) -> dict:
+        step = {"id": self.server.new_id("step"), "object": "thread.run.step", "created_at": int(time.time()),
+                "run_id": self.run["id"], "thread_id": self.thread_id, "assistant_id": self.run["assistant_id"],
+                "type": "tool_calls", "status": "in_progress",
+                "step_details": {"type": "tool_calls", "tool_calls": []}}
+        handler.send_event("thread.run.step.created", step)
+        return step
+
+    def step_delta(self, handler, step: dict, tool_call: dict) -> None:
+        handler.send_event("thread.run.step.delta", {
+            "id": step["id"], "object": "thread.run.step.delta",
+            "delta": {"step_details": {"type": "tool_calls", "tool_calls": [{"index": 0, **tool_call}]}}})
+
+    def code_events(self, handler, code: str, logs: str) -> None:
+        step = self.tool_call_step(handler)
+        call_id = self.server.new_id("call")
+        # The first delta opens the tool call, the code follows
+        self.step_delta(handler, step, {"type": "code_interpreter", "id": call_id,
+                                        "code_interpreter": {"input": "", "outputs": []}})
+        for chunk in self.chunks(code):
+            self.pause(self.timing.delta_ms)
+            self.step_delta(handler, step, {"type": "code_interpreter", "code_interpreter": {"input": chunk}})
+        self.pause(self.timing.step_ms)
+        if logs:
+            self.step_delta(handler, step, {"type": "code_interpreter", "code_interpreter": {
+                "outputs": [{"index": 0, "type": "logs", "logs": logs}]}})
+        step.update(status="completed", step_details={"type": "tool_calls", "tool_calls": [
+            {"index": 0, "type": "code_interpreter", "id": call_id,
+             "code_interpreter": {"input": code, "outputs": [{"type": "logs", "logs": logs}] if logs else []}}]})
+        handler.send_event("thread.run.step.completed", step)
+
+    def function_events(self, handler, code: str) -> None:
+        """
+        Stream a `run_python` call, and stop the stream as the run requires its output
+        """
+        step = self.tool_call_step(handler)
+        call_id = self.server.new_id("call")
+        arguments = json.dumps({"code": code})
+        self.step_delta(handler, step, {"type": "function", "id": call_id,
+                                        "function": {"name": "run_python", "arguments": "", "output": None}})
+        for chunk in self.chunks(arguments):
+            self.pause(self.timing.delta_ms)
+            self.step_delta(handler, step, {"type": "function", "function": {"arguments": chunk}})
+        tool_call = {"id": call_id, "type": "function", "function": {"name": "run_python", "arguments": arguments}}
+        step["step_details"] = {"type": "tool_calls", "tool_calls": [
+            {"index": 0, "type": "function", "id": call_id,
+             "function": {"name": "run_python", "arguments": arguments, "output": None}}]}
+        self.pending_step = step
+        self.run.update(status="requires_action", required_action={
+            "type": "submit_tool_outputs", "submit_tool_outputs": {"tool_calls": [tool_call]}})
+        handler.send_event("thread.run.requires_action", self.run)
+        handler.send_event("done", "[DONE]")
+
+
+def create_run(server, handler, body, query, thread_id):
+    """
+    Play the script as the events of a streamed run
+    """
+    if thread_id not in server.threads:
+        return _not_found(server, handler, thread_id)
+    scripted_run = ScriptedRun(server, thread_id, _json_body(body))
+    with server._lock:
+        server.runs[scripted_run.run["id"]] = scripted_run
+    scripted_run.play(handler)
+
+
+def submit_tool_outputs(server, handler, body, query, thread_id, run_id):
+    """
+    Record the outputs of the function calls, and stream the rest of the run
+    """
+    scripted_run = server.runs.get(run_id)
+    if scripted_run is None or scripted_run.run["status"] != "requires_action":
+        return _not_found(server, handler, run_id)
+    scripted_run.tool_outputs.extend(_json_body(body).get("tool_outputs", []))
+    scripted_run.play(handler)
+
+
+# Moderations and chat completions, as used by the guardrails
+
+def create_moderation(server, handler, body, query):
+    handler.send_json({"id": server.new_id("modr"), "model": "text-moderation-latest", "results": [
+        {"flagged": False, "categories": {}, "category_scores": {}}]})
+
+
+def create_chat_completion(server, handler, body, query):
+    # Empty content: the guardrail checks read it as not flagged
+    handler.send_json({"id": server.new_id("chatcmpl"), "object": "chat.completion", "created": int(time.time()),
+                       "model": _json_body(body).get("model", "gpt-4o"), "choices": [
+                           {"index": 0, "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": ""}}],
+                       "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}})
+
+
+def list_models(server, handler, body, query):
+    handler.send_json({"object": "list", "data": []})
+
+
+ROUTES = defaultdict(list)
+for method, pattern, endpoint in [
+    ("GET", r"/assistants/([^/]+)", retrieve_assistant),
+    ("POST", r"/assistants/([^/]+)", update_assistant),
+    ("POST", r"/files", create_file),
+    ("GET", r"/files/([^/]+)", retrieve_file),
+    ("GET", r"/files/([^/]+)/content", file_content),
+    ("DELETE", r"/files/([^/]+)", delete_file),
+    ("POST", r"/threads", create_thread),
+    ("POST", r"/threads/([^/]+)", update_thread),
+    ("DELETE", r"/threads/([^/]+)", delete_thread),
+    ("POST", r"/threads/([^/]+)/messages", create_message),
+    ("GET", r"/threads/([^/]+)/messages", list_messages),
+    ("DELETE", r"/threads/([^/]+)/messages/([^/]+)", delete_message),
+    ("POST", r"/threads/([^/]+)/runs", create_run),
+    ("POST", r"/threads/([^/]+)/runs/([^/]+)/submit_tool_outputs", submit_tool_outputs),
+    ("POST", r"/moderations", create_moderation),
+    ("POST", r"/chat/completions", create_chat_completion),
+    ("GET", r"/models", list_models),
+]:
+    ROUTES[method].append((pattern, endpoint))
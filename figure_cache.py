@@ -0,0 +1,89 @@
+"""
+figure_cache.py
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Callable, Optional
+
+import pandas as pd
+import plotly.io as pio
+
+from upload_cache import frame_fingerprint
+
+# Config
+FIGURE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class FigureCache:
+    """
+    Process-wide LRU cache of serialised Plotly figures, keyed by the fingerprint of the
+    aggregated frame and the chart spec. Bounded by the total size of the stored JSON.
+    """
+    def __init__(self, max_bytes: int = FIGURE_CACHE_MAX_BYTES):
+        """
+        Args:
+        - max_bytes (int): Total size of the stored figures above which the least recently used are evicted
+        """
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.chart_stats: dict[str, dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0})
+        self._figures: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def figure(self,
+               chart: str,
+               builder: Callable,
+               data: pd.DataFrame,
+               layout: Optional[dict] = None,
+               **spec) -> dict:
+        """
+        Return the figure built by `builder(data, **spec)`, building and serialising it only on a cache miss
+
+        Args:
+        - chart (str): Name of the chart, used for the per-chart stats
+        - builder (Callable): Builds the figure from the data, e.g. `px.line`
+        - data (pd.DataFrame): The aggregated frame plotted
+        - layout (dict): Layout updates applied to the built figure
+        - spec: Keyword arguments passed to the builder; must be JSON serialisable
+
+        Returns:
+        - dict: The figure, as passed to `st.plotly_chart`
+        """
+        spec_json = json.dumps({"builder": f"{builder.__module__}.{builder.__qualname__}",
+                                "layout": layout, "spec": spec}, sort_keys=True, default=str)
+        key = hashlib.sha256(f"{chart}\x1f{spec_json}".encode("utf-8")).hexdigest() + frame_fingerprint(data)
+
+        with self._lock:
+            figure_json = self._figures.get(key)
+            if figure_json is not None:
+                self._figures.move_to_end(key)
+                self.chart_stats[chart]["hits"] += 1
+
+        if figure_json is None:
+            figure = builder(data, **spec)
+            if layout:
+                figure.update_layout(**layout)
+            figure_json = pio.to_json(figure, validate=False)
+            with self._lock:
+                self.chart_stats[chart]["misses"] += 1
+                if key not in self._figures:
+                    self._figures[key] = figure_json
+                    self.size_bytes += len(figure_json)
+                while self.size_bytes > self.max_bytes and len(self._figures) > 1:
+                    _, evicted_json = self._figures.popitem(last=False)
+                    self.size_bytes -= len(evicted_json)
+
+        return json.loads(figure_json)
+
+    def stats(self) -> dict:
+        """
+        Return the per-chart hit/miss counters and the size of the cache
+        """
+        with self._lock:
+            return {
+                "charts": {chart: dict(counts) for chart, counts in self.chart_stats.items()},
+                "entries": len(self._figures),
+                "size_bytes": self.size_bytes,
+            }
@@ -0,0 +1,134 @@
+"""
+guardrails.py
+"""
+import contextvars
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Optional
+
+import perf
+
+# Config
+GUARDRAIL_TIMEOUT_SECONDS = 5.0
+# A check which fails or runs past its budget blocks the text, unless failing open
+GUARDRAILS_FAIL_OPEN = os.environ.get("GUARDRAILS_FAIL_OPEN", "0") == "1"
+
+# Shared across sessions, the checks are network-bound
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="guardrail")
+
+
+class GuardrailResult:
+    """
+    Outcome of `run_guardrails`
+    """
+    __slots__ = ("flagged_by", "timings", "timed_out", "failed", "speculative_result", "speculative_error",
+                 "elapsed")
+
+    def __init__(self):
+        self.flagged_by: Optional[str] = None
+        self.timings: dict[str, float] = {}
+        self.timed_out: list[str] = []
+        self.failed: list[str] = []
+        self.speculative_result: Any = None
+        self.speculative_error: Optional[Exception] = None
+        self.elapsed = 0.0
+
+    @property
+    def flagged(self) -> bool:
+        """
+        True if any check flagged the text
+        """
+        return self.flagged_by is not None
+
+    @property
+    def unchecked(self) -> bool:
+        """
+        True if the text was blocked by a check which failed or timed out, rather than flagged by it
+        """
+        return self.flagged_by is not None and self.flagged_by in self.failed + self.timed_out
+
+
+def run_guardrails(text: str,
+                   checks: dict[str, Callable[[str], bool]],
+                   timeout: float = GUARDRAIL_TIMEOUT_SECONDS,
+                   speculative: Optional[Callable[[], Any]] = None,
+                   cancel: Optional[Callable[[Any], None]] = None,
+                   fail_open: bool = GUARDRAILS_FAIL_OPEN) -> GuardrailResult:
+    """
+    Run the checks concurrently, stopping at the first one that flags the text
+
+    Args:
+    - text (str): The text to check
+    - checks (dict): Check functions by name, each returning True if the text is flagged
+    - timeout (float): Time budget of each check
+    - speculative (Callable): Work started while the checks are in flight, e.g. creating the thread
+    - cancel (Callable): Called with the result of `speculative` if a check flags the text
+    - fail_open (bool): Treat a check which fails or runs past its budget as passed, rather than as flagging
+
+    Returns:
+    - GuardrailResult: The flagging check (if any), the timings, and the result of `speculative`, or the
+      exception it raised
+    """
+    result = GuardrailResult()
+    start = time.perf_counter()
+    # The tasks run in copies of the caller's context, so their spans keep its correlation ids
+    speculative_future = None
+    if speculative is not None:
+        speculative_future = _executor.submit(contextvars.copy_context().run, speculative)
+
+    def timed(name: str, check: Callable[[str], bool]) -> bool:
+        check_start = time.perf_counter()
+        with perf.span(f"guardrail.{name}") as span:
+            flagged = check(text)
+            span.set(flagged=flagged)
+        result.timings[name] = time.perf_counter() - check_start
+        return flagged
+
+    futures: dict[Future, str] = {_executor.submit(contextvars.copy_context().run, timed, name, check): name
+                                  for name, check in checks.items()}
+    deadline = start + timeout
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, deadline - time.perf_counter()),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            try:
+                flagged = future.result()
+            except Exception as e:
+                print(f"Guardrail {futures[future]} failed: {e}")
+                result.failed.append(futures[future])
+                flagged = not fail_open
+            if flagged:
+                result.flagged_by = futures[future]
+                break
+        if result.flagged:
+            break
+
+    # Checks still running past their budget
+    for future in pending:
+        if not result.flagged:
+            result.timed_out.append(futures[future])
+        future.cancel()
+    if result.timed_out and not fail_open:
+        result.flagged_by = result.timed_out[0]
+
+    if speculative_future is not None:
+        if result.flagged:
+            # Undo the speculative work once it completes, without waiting for it
+            if cancel is not None:
+                speculative_future.add_done_callback(
+                    lambda future: future.exception() is None and cancel(future.result()))
+            else:
+                speculative_future.cancel()
+        else:
+            try:
+                result.speculative_result = speculative_future.result()
+            except Exception as e:
+                print(f"Speculative work failed: {e}")
+                result.speculative_error = e
+
+    result.elapsed = time.perf_counter() - start
+    return result
@@ -0,0 +1,105 @@
+"""
+kpi_cube.py
+"""
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from schema import MARKETPLACES
+
+
+class KpiCube:
+    """
+    Per-country aggregates of the Overview KPIs, combinable for any subset of countries.
+
+    Distinct client counts cannot simply be summed when a client appears under several
+    countries. Clients appearing under a single country are counted per country, while
+    the ids of clients appearing under several countries are kept per country, and
+    unioned for the selected subset.
+    """
+    # Row filters whose distinct clients are counted
+    CLIENT_KPIS = {
+        "total_clients": lambda df: pd.Series(True, index=df.index),
+        "active_clients": lambda df: df['active'].eq(1).fillna(False),
+        "trial_clients": lambda df: df['trial_date'].notna(),
+        "converted_clients": lambda df: df['trial_date'].notna() & df['paid'].eq(1).fillna(False),
+    }
+
+    def __init__(self, df: pd.DataFrame, marketplaces: list[str] = MARKETPLACES):
+        """
+        Args:
+        - df (pd.DataFrame): The full dataset, with `trial_date` parsed
+        - marketplaces (list[str]): The marketplace connection columns
+        """
+        df = df[df['country'].notna()]
+        countries_per_client = df.groupby('client_id')['country'].nunique()
+        shared_client_ids = countries_per_client.index[countries_per_client > 1]
+        is_shared = df['client_id'].isin(shared_client_ids)
+
+        self.exclusive_counts: dict[str, pd.Series] = {}
+        self.shared_client_ids: dict[str, dict[str, np.ndarray]] = {}
+        for kpi, row_filter in self.CLIENT_KPIS.items():
+            mask = row_filter(df)
+            self.exclusive_counts[kpi] = df[mask & ~is_shared].groupby('country', observed=True)['client_id'].nunique()
+            self.shared_client_ids[kpi] = {
+                country: np.asarray(client_ids)
+                for country, client_ids in df[mask & is_shared].groupby('country', observed=True)['client_id'].unique().items()
+            }
+
+        # Marketplace connections are counted per row, so they add up across countries
+        self.marketplace_connections = df[marketplaces].gt(0).any(axis=1).groupby(df['country'], observed=True).sum()
+        self.countries = sorted(df['country'].unique())
+
+    def _count_clients(self, kpi: str, countries: list) -> int:
+        exclusive = int(self.exclusive_counts[kpi].reindex(countries, fill_value=0).sum())
+        shared = [self.shared_client_ids[kpi][country]
+                  for country in countries if country in self.shared_client_ids[kpi]]
+        if not shared:
+            return exclusive
+        return exclusive + len(np.unique(np.concatenate(shared)))
+
+    def kpis(self, countries: Iterable) -> dict:
+        """
+        Compute the Overview KPIs for a subset of countries
+
+        Args:
+        - countries (Iterable): The selected countries
+
+        Returns:
+        - dict: The KPIs, matching the values computed from the filtered rows
+        """
+        countries = list(countries)
+        kpis = {kpi: self._count_clients(kpi, countries) for kpi in self.CLIENT_KPIS}
+        kpis["inactive_clients"] = kpis["total_clients"] - kpis["active_clients"]
+        if kpis["trial_clients"] > 0:
+            kpis["conversion_rate"] = (kpis["converted_clients"] / kpis["trial_clients"]) * 100
+        else:
+            kpis["conversion_rate"] = 0
+        kpis["marketplace_connections"] = int(self.marketplace_connections.reindex(countries, fill_value=0).sum())
+        if kpis["total_clients"] > 0:
+            kpis["marketplace_percentage"] = (kpis["marketplace_connections"] / kpis["total_clients"]) * 100
+        else:
+            kpis["marketplace_percentage"] = 0
+        return kpis
+
+
+def filtered_kpis(df_filtered: pd.DataFrame, marketplaces: list[str] = MARKETPLACES) -> dict:
+    """
+    Compute the Overview KPIs from the filtered rows, as the dashboard did before the cube
+    """
+    total_clients = df_filtered['client_id'].nunique()
+    active_clients = df_filtered[df_filtered['active'].eq(1).fillna(False)]['client_id'].nunique()
+    converted_clients = df_filtered[(df_filtered['trial_date'].notna()) & df_filtered['paid'].eq(1).fillna(False)]['client_id'].nunique()
+    trial_clients = df_filtered[df_filtered['trial_date'].notna()]['client_id'].nunique()
+    marketplace_connections = df_filtered[marketplaces].gt(0).any(axis=1).sum()
+    return {
+        "total_clients": total_clients,
+        "active_clients": active_clients,
+        "trial_clients": trial_clients,
+        "converted_clients": converted_clients,
+        "inactive_clients": total_clients - active_clients,
+        "conversion_rate": (converted_clients / trial_clients) * 100 if trial_clients > 0 else 0,
+        "marketplace_connections": marketplace_connections,
+        "marketplace_percentage": (marketplace_connections / total_clients) * 100 if total_clients > 0 else 0,
+    }
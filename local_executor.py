@@ -0,0 +1,408 @@
+"""
+local_executor.py
+
+Runs the Python code written by the assistant in local worker processes, in place of the
+hosted code interpreter. The assistant calls the `run_python` function; the workers keep
+pandas and matplotlib imported and the dataset loaded, so that a call only runs the code.
+
+The workers run this file as a script, rather than through `multiprocessing`, whose spawned
+processes re-import the main module: under Streamlit, the app script itself. POSIX only.
+
+The workers get a minimal environment, without the API key and other secrets of the app, and
+run in a temporary directory rather than the app's. This is not a sandbox: besides the time and
+memory limits, the code can read the files the app's user can read, and reach the network.
+"""
+import ast
+import io
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing.connection import Connection
+from typing import Optional
+
+import pandas as pd
+
+# Config: `remote` for the hosted code interpreter, `local` for the worker processes
+CODE_EXECUTION_BACKEND = os.environ.get("CODE_EXECUTION_BACKEND", "remote")
+LOCAL_EXECUTOR_WORKERS = int(os.environ.get("LOCAL_EXECUTOR_WORKERS", 2))
+# Limits of each call: wall time, CPU time, and address space of the worker
+LOCAL_EXECUTOR_TIMEOUT_SECONDS = float(os.environ.get("LOCAL_EXECUTOR_TIMEOUT_SECONDS", 60))
+LOCAL_EXECUTOR_CPU_SECONDS = int(os.environ.get("LOCAL_EXECUTOR_CPU_SECONDS", 60))
+LOCAL_EXECUTOR_MEMORY_MB = int(os.environ.get("LOCAL_EXECUTOR_MEMORY_MB", 2048))
+# Datasets kept loaded in each worker, e.g. the filtered data of concurrent sessions
+LOCAL_EXECUTOR_DATASETS = 2
+# Printed output returned to the assistant beyond this length is cut
+LOCAL_EXECUTOR_MAX_OUTPUT_CHARS = 20_000
+# Environment variables passed on to the workers, the others (e.g. OPENAI_API_KEY) are not
+LOCAL_EXECUTOR_ENV_ALLOWLIST = ("PATH", "LANG", "LANGUAGE", "LC_ALL", "LC_CTYPE", "TZ", "PYTHONPATH", "VIRTUAL_ENV")
+
+RUN_PYTHON_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "run_python",
+        "description": (
+            "Run Python code on the dataset, loaded as the pandas dataframe `df`. pandas (`pd`), "
+            "numpy (`np`) and matplotlib.pyplot (`plt`) are imported. Each call starts from a fresh "
+            "namespace, so define everything the code needs in the same call. Print the results; the "
+            "value of a final expression is printed too. Open matplotlib figures are shown to the user."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "code": {"type": "string", "description": "The Python code to run"},
+            },
+            "required": ["code"],
+        },
+    },
+}
+
+
+def dataset_instructions(df: pd.DataFrame) -> str:
+    """
+    Additional instructions of a run, describing the dataset available to `run_python`
+    """
+    columns = "\n".join(f"- {column}: {dtype}" for column, dtype in df.dtypes.items())
+    return (f"The dataset is loaded as the dataframe `df` in the `run_python` function, with "
+            f"{len(df)} rows and these columns:\n{columns}\n"
+            f"Use `run_python` to analyse it; there are no files to read.")
+
+
+class ExecutionResult:
+    """
+    Outcome of a `run_python` call
+    """
+    __slots__ = ("output", "images", "error", "seconds")
+
+    def __init__(self, output: str = "", images: Optional[list[bytes]] = None, error: Optional[str] = None,
+                 seconds: float = 0.0):
+        """
+        Args:
+        - output (str): Printed output, including the traceback of an exception raised by the code
+        - images (list[bytes]): PNG images of the figures left open by the code
+        - error (str): Why the call failed, e.g. a time or memory limit, or None
+        - seconds (float): Wall time of the call
+        """
+        self.output = output
+        self.images = images if images is not None else []
+        self.error = error
+        self.seconds = seconds
+
+    def tool_output(self) -> str:
+        """
+        The output returned to the assistant
+        """
+        parts = [self.output[-LOCAL_EXECUTOR_MAX_OUTPUT_CHARS:]] if self.output else []
+        if self.error:
+            parts.append(f"Error: {self.error}")
+        if self.images:
+            parts.append(f"[{len(self.images)} figure(s) shown to the user]")
+        return "\n".join(parts) or "[no output]"
+
+
+def _set_limits(memory_mb: int) -> None:
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return
+    memory_bytes = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+
+def _limit_cpu(cpu_seconds: int) -> None:
+    """
+    Allow the next call `cpu_seconds` of CPU time on top of what the worker has used
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    used = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(used.ru_utime + used.ru_stime) + cpu_seconds
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _run_code(code: str, namespace: dict) -> str:
+    """
+    Run the code in the namespace, printing the value of a final expression as a notebook would
+    """
+    output = io.StringIO()
+    with redirect_stdout(output), redirect_stderr(output):
+        try:
+            tree = ast.parse(code, mode="exec")
+            last = tree.body[-1] if tree.body and isinstance(tree.body[-1], ast.Expr) else None
+            if last is not None:
+                tree.body.pop()
+            exec(compile(tree, "<run_python>", "exec"), namespace)
+            if last is not None:
+                value = eval(compile(ast.Expression(last.value), "<run_python>", "eval"), namespace)
+                if value is not None:
+                    print(repr(value))
+        except BaseException:
+            # The traceback is part of the output, for the assistant to fix its code
+            traceback.print_exc(limit=-3)
+    return output.getvalue()
+
+
+def _worker_main(conn, memory_mb: int, cpu_seconds: int, max_datasets: int) -> None:
+    """
+    Loop of a worker process, answering the `load` and `run` requests of the parent
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    # Each call sees a lazy copy of the dataset, so that its changes do not leak to the next calls
+    pd.set_option("mode.copy_on_write", True)
+    _set_limits(memory_mb)
+    datasets: "OrderedDict[str, pd.DataFrame]" = OrderedDict()
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request[0] == "load":
+            _, key, df = request
+            datasets[key] = df
+            datasets.move_to_end(key)
+            while len(datasets) > max_datasets:
+                datasets.popitem(last=False)
+            conn.send(("loaded", key))
+        elif request[0] == "run":
+            _, key, code = request
+            _limit_cpu(cpu_seconds)
+            namespace = {"pd": pd, "np": np, "plt": plt, "df": datasets[key].copy(deep=False)}
+            output = _run_code(code, namespace)
+            images = []
+            for number in plt.get_fignums():
+                buffer = io.BytesIO()
+                plt.figure(number).savefig(buffer, format="png", bbox_inches="tight")
+                images.append(buffer.getvalue())
+            plt.close("all")
+            conn.send(("result", output, images))
+
+
+class _Worker:
+    __slots__ = ("process", "conn", "directory", "datasets")
+
+    def __init__(self, process: subprocess.Popen, conn: Connection, directory: str):
+        self.process = process
+        self.conn = conn
+        # Working directory of the worker, removed with it
+        self.directory = directory
+        # Mirror of the datasets loaded in the worker, in the same order
+        self.datasets: "OrderedDict[str, None]" = OrderedDict()
+
+
+class LocalCodeExecutor:
+    """
+    Pool of worker processes running `run_python` calls against a loaded dataset.
+
+    The datasets are registered with `load`, and sent to each worker ahead of its first call
+    on them. A call exceeding the wall time or CPU time limit, or crashing its worker, gets an
+    error result; the worker is replaced by a fresh one. A dataset dropped from the registry since
+    (e.g. by the loads of other sessions) is registered again from the `df` of the call.
+    """
+    def __init__(self,
+                 workers: int = LOCAL_EXECUTOR_WORKERS,
+                 timeout_seconds: float = LOCAL_EXECUTOR_TIMEOUT_SECONDS,
+                 cpu_seconds: int = LOCAL_EXECUTOR_CPU_SECONDS,
+                 memory_mb: int = LOCAL_EXECUTOR_MEMORY_MB,
+                 max_datasets: int = LOCAL_EXECUTOR_DATASETS):
+        """
+        Args:
+        - workers (int): Number of worker processes, so of concurrent calls
+        - timeout_seconds (float): Wall time limit of a call
+        - cpu_seconds (int): CPU time limit of a call
+        - memory_mb (int): Address space limit of each worker
+        - max_datasets (int): Number of datasets kept loaded in each worker
+        """
+        self.timeout_seconds = timeout_seconds
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.max_datasets = max_datasets
+        self.calls = 0
+        self.failures = 0
+        self.restarts = 0
+        self.loads = 0
+        self._datasets: "OrderedDict[str, pd.DataFrame]" = OrderedDict()
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._workers = [self._spawn() for _ in range(workers)]
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def load(self, key: str, df: pd.DataFrame) -> None:
+        """
+        Register a dataset, and start loading it in the idle workers in the background
+
+        Args:
+        - key (str): Identifies the content of the dataset, e.g. its fingerprint
+        - df (pd.DataFrame): The dataset
+        """
+        with self._lock:
+            if key in self._datasets:
+                self._datasets.move_to_end(key)
+                return
+            self._datasets[key] = df
+            while len(self._datasets) > self.max_datasets:
+                self._datasets.popitem(last=False)
+        threading.Thread(target=self._prewarm, args=(key,), name="executor-prewarm", daemon=True).start()
+
+    def run(self, key: str, code: str, df: Optional[pd.DataFrame] = None) -> ExecutionResult:
+        """
+        Run the code against the dataset, in the next idle worker
+
+        Args:
+        - key (str): The key the dataset was loaded with
+        - code (str): The Python code
+        - df (pd.DataFrame): The dataset, to load it again if it is no longer registered
+
+        Returns:
+        - ExecutionResult: The printed output and the figures, or the error
+        """
+        start = time.perf_counter()
+        worker = self._idle.get()
+        # Only a worker that died or is stuck in the code is replaced
+        healthy = True
+        try:
+            error = self._ensure_loaded(worker, key, df)
+            if error is None:
+                worker.conn.send(("run", key, code))
+                if worker.conn.poll(self.timeout_seconds):
+                    _, output, images = worker.conn.recv()
+                    result = ExecutionResult(output, images)
+                else:
+                    error = f"The code did not finish within {self.timeout_seconds:.0f} seconds"
+                    healthy = False
+        except (EOFError, OSError):
+            # The worker died, e.g. from the CPU time limit or the memory limit
+            error = "The code exceeded the CPU time or memory limits"
+            healthy = False
+        finally:
+            if not healthy:
+                worker = self._replace(worker)
+            self._idle.put(worker)
+        if error is not None:
+            result = ExecutionResult(error=error)
+        result.seconds = time.perf_counter() - start
+        with self._lock:
+            self.calls += 1
+            self.failures += error is not None
+        return result
+
+    def stats(self) -> dict:
+        """
+        Return the call, failure and dataset load counters
+        """
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "calls": self.calls,
+                "failures": self.failures,
+                "restarts": self.restarts,
+                "loads": self.loads,
+                "datasets": len(self._datasets),
+            }
+
+    def close(self) -> None:
+        """
+        Stop the worker processes
+        """
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+        for worker in workers:
+            # The worker exits once its connection is closed
+            worker.conn.close()
+            try:
+                worker.process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+            shutil.rmtree(worker.directory, ignore_errors=True)
+
+    def _spawn(self) -> _Worker:
+        parent_socket, child_socket = socket.socketpair()
+        directory = tempfile.mkdtemp(prefix="executor_")
+        env = {name: os.environ[name] for name in LOCAL_EXECUTOR_ENV_ALLOWLIST if name in os.environ}
+        # e.g. for the matplotlib cache
+        env["HOME"] = directory
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(child_socket.fileno()),
+                                    str(self.memory_mb), str(self.cpu_seconds), str(self.max_datasets)],
+                                   pass_fds=(child_socket.fileno(),), env=env, cwd=directory)
+        child_socket.close()
+        return _Worker(process, Connection(parent_socket.detach()), directory)
+
+    def _replace(self, worker: _Worker) -> _Worker:
+        worker.process.kill()
+        worker.process.wait()
+        worker.conn.close()
+        shutil.rmtree(worker.directory, ignore_errors=True)
+        replacement = self._spawn()
+        with self._lock:
+            self._workers[self._workers.index(worker)] = replacement
+            self.restarts += 1
+        return replacement
+
+    def _ensure_loaded(self, worker: _Worker, key: str, df: Optional[pd.DataFrame] = None) -> Optional[str]:
+        """
+        Send the dataset to the worker if it does not have it, registering `df` again if the dataset is
+        no longer registered, and return an error message if it cannot be loaded
+        """
+        if key in worker.datasets:
+            worker.datasets.move_to_end(key)
+            return None
+        with self._lock:
+            if key not in self._datasets and df is not None:
+                self._datasets[key] = df
+                while len(self._datasets) > self.max_datasets:
+                    self._datasets.popitem(last=False)
+            df = self._datasets.get(key)
+        if df is None:
+            return "The dataset is no longer loaded, ask the question again"
+        worker.conn.send(("load", key, df))
+        # Loading includes unpickling the dataset, not bounded by the time limit of the code
+        worker.conn.recv()
+        worker.datasets[key] = None
+        while len(worker.datasets) > self.max_datasets:
+            worker.datasets.popitem(last=False)
+        with self._lock:
+            self.loads += 1
+        return None
+
+    def _prewarm(self, key: str) -> None:
+        # Only the workers idle right now, the busy ones load the dataset on their next call
+        taken = []
+        while True:
+            try:
+                taken.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for worker in taken:
+            try:
+                if not self._closed:
+                    self._ensure_loaded(worker, key)
+            except (EOFError, OSError):
+                worker = self._replace(worker)
+            self._idle.put(worker)
+
+
+if __name__ == "__main__":
+    # A worker process, started by `LocalCodeExecutor`
+    fd, memory_mb, cpu_seconds, max_datasets = map(int, sys.argv[1:])
+    _worker_main(Connection(fd), memory_mb, cpu_seconds, max_datasets)
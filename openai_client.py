@@ -0,0 +1,67 @@
+"""
+openai_client.py
+"""
+import importlib.util
+import os
+from typing import Optional
+
+import httpx
+import streamlit as st
+from openai import OpenAI
+
+# Config
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 64))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 32))
+# Idle connections are kept open this long, so that the next question skips the TCP and TLS handshakes
+OPENAI_KEEPALIVE_EXPIRY_SECONDS = 120.0
+OPENAI_CONNECT_TIMEOUT_SECONDS = 5.0
+# Read timeout of the REST calls, which answer at once
+OPENAI_READ_TIMEOUT_SECONDS = 120.0
+# Read timeout of the run streams, which can stay silent while the code interpreter is busy
+OPENAI_STREAM_READ_TIMEOUT_SECONDS = float(os.environ.get("OPENAI_STREAM_READ_TIMEOUT_SECONDS", 600))
+OPENAI_MAX_RETRIES = 2
+# Pass as `timeout` to the streaming calls
+OPENAI_STREAM_TIMEOUT = httpx.Timeout(OPENAI_STREAM_READ_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS)
+
+
+def http2_available() -> bool:
+    """
+    True if the `h2` package, needed by httpx for HTTP/2, is installed
+    """
+    return importlib.util.find_spec("h2") is not None
+
+
+def build_openai_client(api_key: str,
+                        base_url: Optional[str] = None,
+                        http2: Optional[bool] = None) -> OpenAI:
+    """
+    Build an OpenAI client on a tuned, keep-alive connection pool
+
+    Args:
+    - api_key (str): The OpenAI API key
+    - base_url (str): Base URL of the API, or None for the default
+    - http2 (bool): Whether to negotiate HTTP/2, by default if `h2` is installed
+
+    Returns:
+    - OpenAI: The client
+    """
+    if http2 is None:
+        http2 = http2_available()
+    http_client = httpx.Client(
+        http2=http2,
+        limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SECONDS),
+        timeout=httpx.Timeout(OPENAI_READ_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+        follow_redirects=True,
+    )
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=OPENAI_MAX_RETRIES)
+
+
+@st.cache_resource
+def get_openai_client() -> OpenAI:
+    """
+    Process-wide OpenAI client, shared by every module and session so that they reuse its connections
+    """
+    api_key = os.environ.get("OPENAI_API_KEY", st.secrets["OPENAI_API_KEY"])
+    return build_openai_client(api_key, base_url=os.environ.get("OPENAI_BASE_URL"))
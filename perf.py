@@ -0,0 +1,250 @@
+"""
+perf.py
+
+Timing spans of the hot paths, e.g.
+
+    with perf.span("dataset_upload") as span:
+        file_id, hit = upload_cache.get_or_upload(df_filtered)
+        span.set(cache_hit=hit)
+
+Spans are recorded only when `PERF_ENABLED=1`; otherwise `span` returns a shared no-op
+object. Each record carries the id of the Streamlit session and of the question being
+answered, and is appended to a JSONL trace and kept in memory for the sidebar panel.
+"""
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+# Config
+PERF_ENABLED = os.environ.get("PERF_ENABLED", "0") == "1"
+PERF_TRACE_PATH = os.environ.get("PERF_TRACE_PATH", "perf_trace.jsonl")
+PERF_PANEL_RECORDS = 200
+PERF_PANEL_SESSIONS = 100
+
+# Correlation ids and enclosing span of the current script run (or of the task copying its context)
+_session_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("perf_session_id", default=None)
+_question: contextvars.ContextVar[Optional[tuple[str, float]]] = contextvars.ContextVar("perf_question", default=None)
+_parent: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("perf_parent", default=None)
+
+
+class TraceRecorder:
+    """
+    Process-wide sink of the span records: an append-only JSONL file, and the latest
+    records of each session, in memory
+    """
+    def __init__(self, trace_path: Optional[str] = PERF_TRACE_PATH,
+                 max_records: int = PERF_PANEL_RECORDS, max_sessions: int = PERF_PANEL_SESSIONS):
+        """
+        Args:
+        - trace_path (str): Path of the JSONL trace, or None to keep the records in memory only
+        - max_records (int): Number of records kept in memory per session
+        - max_sessions (int): Number of sessions kept in memory, the least recently active are dropped
+        """
+        self.trace_path = trace_path
+        self.max_records = max_records
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[Optional[str], deque]" = OrderedDict()
+        self._file = None
+        self._lock = threading.Lock()
+
+    def record(self, record: dict) -> None:
+        line = json.dumps(record, default=str)
+        with self._lock:
+            session_id = record["session"]
+            if session_id not in self._sessions:
+                self._sessions[session_id] = deque(maxlen=self.max_records)
+            self._sessions.move_to_end(session_id)
+            self._sessions[session_id].append(record)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+            if self.trace_path is None:
+                return
+            try:
+                if self._file is None:
+                    self._file = open(self.trace_path, "a", encoding="utf-8")
+                self._file.write(line + "\n")
+                self._file.flush()
+            except OSError as e:
+                print(f"Failed to write perf trace: \t {e}")
+                self.trace_path = None
+
+    def records(self, session_id: Optional[str]) -> list[dict]:
+        """
+        Return the records of a session kept in memory, oldest first
+        """
+        with self._lock:
+            return list(self._sessions.get(session_id, ()))
+
+
+_recorder = TraceRecorder()
+
+
+class Span:
+    """
+    A timed section of code, recorded when it exits
+    """
+    __slots__ = ("name", "attrs", "start", "seconds", "_token")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.start = 0.0
+        self.seconds = 0.0
+        self._token = None
+
+    def set(self, **attrs) -> "Span":
+        """
+        Attach attributes to the record, e.g. whether a cache was hit
+        """
+        self.attrs.update(attrs)
+        return self
+
+    def __enter__(self) -> "Span":
+        self._token = _parent.set(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.seconds = time.perf_counter() - self.start
+        _parent.reset(self._token)
+        parent = _parent.get()
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        _emit(self.name, self.start, self.seconds, parent, self.attrs)
+
+
+class _NullSpan:
+    """
+    Span returned when recording is disabled
+    """
+    __slots__ = ()
+    seconds = 0.0
+
+    def set(self, **attrs) -> "_NullSpan":
+        return self
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _emit(name: str, start: float, seconds: float, parent: Optional[str], attrs: dict) -> None:
+    question = _question.get()
+    question_id, question_start = question if question is not None else (None, None)
+    record = {
+        "ts": time.time(),
+        "session": _session_id.get(),
+        "question": question_id,
+        "name": name,
+        "parent": parent,
+        "seconds": round(seconds, 6),
+        # Time since the question was asked, e.g. the time to first token of the answer
+        "offset": round(start - question_start, 6) if question_start is not None else None,
+        "thread": threading.current_thread().name,
+    }
+    if attrs:
+        record["attrs"] = attrs
+    _recorder.record(record)
+
+
+def span(name: str, **attrs):
+    """
+    Time the enclosed block
+
+    Args:
+    - name (str): Name of the span, e.g. `dataset_upload`
+    - attrs: Attributes of the record
+    """
+    if not PERF_ENABLED:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def event(name: str, **attrs) -> None:
+    """
+    Record an instant, e.g. the first token of an answer, timed from the start of the question
+    """
+    if not PERF_ENABLED:
+        return
+    _emit(name, time.perf_counter(), 0.0, _parent.get(), attrs)
+
+
+def timed(name: Optional[str] = None) -> Callable:
+    """
+    Decorator recording a span around each call of the function
+    """
+    def decorator(fn: Callable) -> Callable:
+        span_name = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PERF_ENABLED:
+                return fn(*args, **kwargs)
+            with Span(span_name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def begin_session(session_state) -> str:
+    """
+    Tag the spans of this script run with the id of the session, created on its first run
+
+    Args:
+    - session_state: `st.session_state`
+    """
+    if "perf_session_id" not in session_state:
+        session_state.perf_session_id = uuid.uuid4().hex[:12]
+    _session_id.set(session_state.perf_session_id)
+    _question.set(None)
+    return session_state.perf_session_id
+
+
+def begin_question() -> str:
+    """
+    Tag the following spans of this script run with a new question id
+    """
+    question_id = uuid.uuid4().hex[:12]
+    _question.set((question_id, time.perf_counter()))
+    return question_id
+
+
+def render_perf_panel(container, session_state) -> None:
+    """
+    Render the spans of the latest question of the session, or its latest spans if no question was asked
+
+    Args:
+    - container: Where to render, e.g. `st.sidebar`
+    - session_state: `st.session_state`
+    """
+    if not PERF_ENABLED:
+        return
+    records = _recorder.records(session_state.get("perf_session_id"))
+    if not records:
+        return
+    latest_question = next((record["question"] for record in reversed(records) if record["question"]), None)
+    records = [record for record in records if record["question"] == latest_question] if latest_question else records[-30:]
+    expander = container.expander("⏱️ Performance", expanded=False)
+    if latest_question:
+        expander.caption(f"Question {latest_question}")
+    expander.dataframe(
+        [{"span": record["name"],
+          "ms": round(record["seconds"] * 1e3, 1),
+          "at (ms)": round(record["offset"] * 1e3, 1) if record["offset"] is not None else None,
+          "attrs": json.dumps(record.get("attrs", {}), default=str)}
+         for record in records],
+        use_container_width=True,
+        hide_index=True,
+    )
@@ -0,0 +1,62 @@
+"""
+schema.py
+"""
+import pandas as pd
+
+# Bump when the schema changes, so that snapshots normalised with an older schema are rebuilt
+SCHEMA_VERSION = 1
+
+MARKETPLACES = ['amazon', 'ebay', 'shopify', 'other_marketplace', 'other_webstore']
+
+# Target dtype of each column of the client sheet
+SCHEMA = {
+    "country": "category",
+    "click_source": "category",
+    "active": "Int8",
+    "paid": "Int8",
+    "connected": "Int8",
+    "mobile_signup": "Int8",
+    "trial_date": "datetime64[ns]",
+    **{marketplace: "float32" for marketplace in MARKETPLACES},
+}
+
+
+def memory_footprint(df: pd.DataFrame) -> int:
+    """
+    Return the memory used by the dataframe, in bytes, including the strings it references
+    """
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def normalize_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Cast the client sheet to the compact dtypes of `SCHEMA`, and precompute `trial_month`
+
+    Args:
+    - df (pd.DataFrame): The client sheet, as read from CSV
+
+    Returns:
+    - pd.DataFrame: The normalised dataframe
+    """
+    before = memory_footprint(df)
+    df = df.copy()
+    for column, dtype in SCHEMA.items():
+        if column not in df.columns:
+            continue
+        if dtype == "datetime64[ns]":
+            df[column] = pd.to_datetime(df[column], errors='coerce')
+        elif dtype == "Int8":
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(dtype)
+        elif dtype == "float32":
+            # Missing marketplace connections count as no connection
+            df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0).astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+
+    # Cohort month of each trial, used by several tabs
+    if "trial_date" in df.columns:
+        df["trial_month"] = df["trial_date"].dt.to_period('M').dt.to_timestamp()
+
+    after = memory_footprint(df)
+    print(f"Memory footprint: \t {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+    return df
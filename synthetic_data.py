@@ -0,0 +1,63 @@
+"""
+synthetic_data.py
+
+Deterministic synthetic client sheets, for benchmarking the dashboard at any size
+"""
+import numpy as np
+import pandas as pd
+
+from schema import MARKETPLACES
+
+COUNTRIES = ["UK", "US", "DE", "FR", "ES", "IT", "NL", "IE", "AU", "CA"]
+COUNTRY_WEIGHTS = [0.30, 0.25, 0.10, 0.08, 0.06, 0.06, 0.05, 0.04, 0.03, 0.03]
+CLICK_SOURCES = ["google", "facebook", "direct", "partner", "newsletter", "bing"]
+
+
+def generate_clients(n_clients: int,
+                     seed: int = 0,
+                     shared_client_fraction: float = 0.0,
+                     missing_trial_fraction: float = 0.05) -> pd.DataFrame:
+    """
+    Generate a client sheet, as read from the Google Sheet CSV export
+
+    Args:
+    - n_clients (int): Number of rows
+    - seed (int): Seed of the random generator; the same seed always gives the same sheet
+    - shared_client_fraction (float): Fraction of rows reusing the id of another client,
+      so that some clients appear under several countries
+    - missing_trial_fraction (float): Fraction of rows without a trial date
+
+    Returns:
+    - pd.DataFrame: The sheet, with `trial_date` as strings and marketplace counts as floats with gaps
+    """
+    rng = np.random.default_rng(seed)
+
+    client_id = np.arange(n_clients)
+    n_shared = int(n_clients * shared_client_fraction)
+    if n_shared:
+        client_id[rng.choice(n_clients, n_shared, replace=False)] = rng.integers(0, n_clients, n_shared)
+
+    trial_date = pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 3 * 365, n_clients), unit="D")
+    trial_date = pd.Series(trial_date.strftime("%Y-%m-%d"), dtype=object)
+    trial_date[rng.random(n_clients) < missing_trial_fraction] = None
+
+    # Activity funnel: connected clients are more likely to be active, active ones to pay
+    connected = rng.random(n_clients) < 0.6
+    active = rng.random(n_clients) < np.where(connected, 0.7, 0.2)
+    paid = rng.random(n_clients) < np.where(active, 0.35, 0.02)
+
+    df = pd.DataFrame({
+        "client_id": client_id,
+        "country": rng.choice(COUNTRIES, n_clients, p=COUNTRY_WEIGHTS),
+        "trial_date": trial_date,
+        "active": active.astype(np.int64),
+        "paid": paid.astype(np.int64),
+        "connected": connected.astype(np.int64),
+        "mobile_signup": (rng.random(n_clients) < 0.3).astype(np.int64),
+        "click_source": rng.choice(CLICK_SOURCES, n_clients),
+    })
+    for marketplace in MARKETPLACES:
+        connections = rng.poisson(0.4, n_clients).astype(float)
+        connections[rng.random(n_clients) < 0.1] = np.nan
+        df[marketplace] = connections
+    return df
@@ -0,0 +1,143 @@
+"""
+tab_registry.py
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+import streamlit as st
+
+import perf
+
+# Config
+TAB_RESULT_CACHE_SIZE = 64
+
+
+class Tab:
+    """
+    A dashboard tab: the inputs it needs, how to compute its results, and how to render them
+    """
+    __slots__ = ("name", "inputs", "compute", "render")
+
+    def __init__(self,
+                 name: str,
+                 render: Callable,
+                 compute: Optional[Callable] = None,
+                 inputs: tuple = ()):
+        """
+        Args:
+        - name (str): The label of the tab
+        - render (Callable): Renders the results of `compute`, or the inputs if there is no `compute`
+        - compute (Callable): Pure function of the inputs returning the results to render,
+          or None for tabs that cannot be memoized
+        - inputs (tuple): The names of the inputs passed to `compute` (or `render`)
+        """
+        self.name = name
+        self.render = render
+        self.compute = compute
+        self.inputs = inputs
+
+
+class TabResultCache:
+    """
+    Process-wide LRU cache of tab results, keyed by tab name and filter state
+    """
+    def __init__(self, max_results: int = TAB_RESULT_CACHE_SIZE):
+        self.max_results = max_results
+        self.hits = 0
+        self.misses = 0
+        self._results: "OrderedDict[tuple, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, tab: Tab, providers: dict[str, Callable[[], Any]], filter_state: tuple) -> tuple[Any, bool]:
+        """
+        Return the results of a tab, computing them only if not cached for the filter state
+
+        Args:
+        - tab (Tab): The tab
+        - providers (dict): Functions returning each input, only called on a cache miss
+        - filter_state (tuple): Hashable key of the data version and the filters
+
+        Returns:
+        - Any: The results of `tab.compute`
+        - bool: True if the results were cached
+        """
+        key = (tab.name, filter_state)
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key], True
+
+        results = tab.compute(**{name: providers[name]() for name in tab.inputs})
+        with self._lock:
+            self.misses += 1
+            self._results[key] = results
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return results, False
+
+
+class TabRegistry:
+    """
+    Renders only the selected tab, serving its results from a `TabResultCache`.
+
+    Unlike `st.tabs`, which runs the body of every tab on every rerun, the other tabs are
+    neither computed nor rendered. Switching back to a tab with the same filters re-renders
+    it from the cached results, without recomputing.
+    """
+    def __init__(self, result_cache: TabResultCache):
+        self.tabs: "OrderedDict[str, Tab]" = OrderedDict()
+        self.result_cache = result_cache
+
+    def register(self, name: str, inputs: tuple = (), compute: Optional[Callable] = None) -> Callable:
+        """
+        Decorator registering the render function of a tab
+
+        Args:
+        - name (str): The label of the tab
+        - inputs (tuple): The names of the inputs passed to `compute` (or to the render function)
+        - compute (Callable): Pure function of the inputs returning the results to render
+        """
+        def decorator(render: Callable) -> Callable:
+            self.tabs[name] = Tab(name, render, compute, inputs)
+            return render
+        return decorator
+
+    def render_selected(self, providers: dict[str, Callable[[], Any]], filter_state: tuple,
+                        key: str = "selected_tab") -> dict:
+        """
+        Render a tab selector and the selected tab
+
+        Args:
+        - providers (dict): Functions returning each input, called lazily
+        - filter_state (tuple): Hashable key of the data version and the filters
+        - key (str): Session state key of the selected tab
+
+        Returns:
+        - dict: Timings of this rerun
+        """
+        selected = st.radio("Tab", list(self.tabs), horizontal=True,
+                            label_visibility="collapsed", key=key)
+        tab = self.tabs[selected]
+
+        start = time.perf_counter()
+        with perf.span("tab", tab=selected) as span:
+            if tab.compute is None:
+                tab.render(**{name: providers[name]() for name in tab.inputs})
+                cached = False
+                compute_seconds = time.perf_counter() - start
+            else:
+                results, cached = self.result_cache.get_or_compute(tab, providers, filter_state)
+                compute_seconds = time.perf_counter() - start
+                tab.render(results)
+            span.set(cached=cached, compute_seconds=compute_seconds)
+        timings = {
+            "tab": selected,
+            "cached": cached,
+            "compute_seconds": compute_seconds,
+            "total_seconds": time.perf_counter() - start,
+        }
+        print(f"Tab rerun: \t {timings}")
+        return timings
@@ -0,0 +1,15 @@
+"""
+Importing `utils` reads the API key from the Streamlit secrets, which Streamlit looks up in the
+working directory it is imported from: provide them, the tests never reach the API
+"""
+import os
+import tempfile
+
+_secrets_dir = tempfile.mkdtemp(prefix="tests_")
+os.makedirs(os.path.join(_secrets_dir, ".streamlit"))
+with open(os.path.join(_secrets_dir, ".streamlit", "secrets.toml"), "w") as _f:
+    _f.write('OPENAI_API_KEY = "sk-test"\n')
+_cwd = os.getcwd()
+os.chdir(_secrets_dir)
+import streamlit  # noqa: E402,F401
+os.chdir(_cwd)
@@ -0,0 +1,83 @@
+"""
+Tests of the API calls made by `retrieve_assistant_created_files`, against a fake messages client
+"""
+from types import SimpleNamespace
+
+import pytest
+
+import utils
+from utils import retrieve_assistant_created_files
+
+
+class FakeMessagesClient:
+    """
+    Stand-in for `client.beta.threads.messages`, counting the API calls; every other message is
+    the assistant's, with a file attached
+    """
+    def __init__(self, n_messages: int):
+        self.calls = {"list": 0, "retrieve": 0}
+        self.messages = [self.message(f"msg_{i:05d}", i % 2 == 1) for i in range(n_messages)]
+        self.beta = SimpleNamespace(threads=SimpleNamespace(messages=self))
+
+    @staticmethod
+    def message(message_id: str, with_file: bool):
+        return SimpleNamespace(id=message_id, role="assistant" if with_file else "user",
+                               attachments=[SimpleNamespace(file_id=f"file_{message_id}")] if with_file else [])
+
+    def list(self, thread_id, order="desc", after=None, limit=20):
+        """
+        Return the first page; iterating it fetches the next pages, like the SDK cursor pages
+        """
+        self.calls["list"] += 1
+        messages = self.messages if order == "asc" else self.messages[::-1]
+        start = 0
+        if after is not None:
+            start = [message.id for message in messages].index(after) + 1
+        page = messages[start:start + limit]
+
+        def iterate():
+            yield from page
+            if start + limit < len(messages) and page:
+                yield from self.list(thread_id, order=order, after=page[-1].id, limit=limit)
+        return iterate()
+
+    def retrieve(self, message_id, thread_id):
+        self.calls["retrieve"] += 1
+        return next(message for message in self.messages if message.id == message_id)
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    def install(n_messages):
+        fake = FakeMessagesClient(n_messages)
+        monkeypatch.setattr(utils, "client", fake)
+        return fake
+    return install
+
+
+@pytest.mark.parametrize("n_messages", [1, 100, 250])
+def test_full_scan_lists_pages_of_100_without_retrieves(fake_client, n_messages):
+    fake = fake_client(n_messages)
+    file_ids, cursor = retrieve_assistant_created_files("thread")
+
+    assert fake.calls == {"list": -(-n_messages // 100), "retrieve": 0}
+    assert file_ids == [f"file_msg_{i:05d}" for i in range(1, n_messages, 2)]
+    assert cursor == fake.messages[-1].id
+
+
+def test_scan_after_the_cursor_lists_only_the_new_messages(fake_client):
+    fake = fake_client(250)
+    _, cursor = retrieve_assistant_created_files("thread")
+    fake.calls = {"list": 0, "retrieve": 0}
+    fake.messages += [fake.message("msg_new_user", False), fake.message("msg_new", True)]
+
+    file_ids, new_cursor = retrieve_assistant_created_files("thread", after=cursor)
+    assert fake.calls == {"list": 1, "retrieve": 0}
+    assert file_ids == ["file_msg_new"]
+    assert new_cursor == "msg_new"
+
+
+def test_scan_without_new_messages_keeps_the_cursor(fake_client):
+    fake = fake_client(10)
+    _, cursor = retrieve_assistant_created_files("thread")
+    assert retrieve_assistant_created_files("thread", after=cursor) == ([], cursor)
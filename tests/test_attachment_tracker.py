@@ -0,0 +1,115 @@
+"""
+Tests of the incremental attachment scans of AttachmentTracker, against stub list and fetch functions
+"""
+from collections import Counter
+
+from attachment_tracker import ArtifactCache, AttachmentTracker
+
+
+class StubThread:
+    """
+    Messages of a thread, with the attachments of the assistant, and the files to download
+    """
+    def __init__(self):
+        self.messages = []
+        self.failing = set()
+        self.fetches = Counter()
+        self.afters = []
+
+    def add_message(self, file_ids=()):
+        message_id = f"msg_{len(self.messages):03d}"
+        self.messages.append((message_id, list(file_ids)))
+        return message_id
+
+    def list_fn(self, thread_id, after):
+        self.afters.append(after)
+        start = 0
+        if after is not None:
+            start = [message_id for message_id, _ in self.messages].index(after) + 1
+        messages = self.messages[start:]
+        file_ids = [file_id for _, attachments in messages for file_id in attachments]
+        return file_ids, messages[-1][0] if messages else after
+
+    def fetch_fn(self, file_id):
+        self.fetches[file_id] += 1
+        if file_id in self.failing:
+            raise IOError("download failed")
+        return f"{file_id}.txt", file_id.encode()
+
+
+def make_tracker(thread):
+    return AttachmentTracker(list_fn=thread.list_fn, fetch_fn=thread.fetch_fn, cache=ArtifactCache())
+
+
+def test_collect_advances_the_cursor():
+    thread = StubThread()
+    tracker = make_tracker(thread)
+    thread.add_message()
+    last = thread.add_message(["file_a", "file_b"])
+
+    assert [artifact.file_id for artifact in tracker.collect("thread")] == ["file_a", "file_b"]
+    assert tracker.cursor("thread") == last
+
+    latest = thread.add_message(["file_c"])
+    assert [artifact.file_id for artifact in tracker.collect("thread")] == ["file_c"]
+    # The second scan starts after the last message of the first one
+    assert thread.afters == [None, last]
+    assert tracker.cursor("thread") == latest
+
+
+def test_collect_keeps_the_cursor_without_new_messages():
+    thread = StubThread()
+    tracker = make_tracker(thread)
+    last = thread.add_message(["file_a"])
+    tracker.collect("thread")
+
+    assert tracker.collect("thread") == []
+    assert tracker.cursor("thread") == last
+
+
+def test_collect_retries_the_failed_downloads():
+    thread = StubThread()
+    tracker = make_tracker(thread)
+    thread.add_message(["file_a", "file_b"])
+    thread.failing.add("file_b")
+
+    assert [artifact.file_id for artifact in tracker.collect("thread")] == ["file_a"]
+    assert tracker.stats()["failed"] == 1
+
+    # The message is not scanned again, but its failed attachment is retried
+    thread.failing.clear()
+    thread.add_message(["file_c"])
+    assert [artifact.file_id for artifact in tracker.collect("thread")] == ["file_b", "file_c"]
+    assert thread.fetches["file_b"] == 2
+
+
+def test_collect_does_not_fetch_handled_files_again():
+    thread = StubThread()
+    tracker = make_tracker(thread)
+    thread.add_message(["file_a"])
+    tracker.collect("thread")
+
+    # The same file attached again, and a file of another thread already in the shared cache
+    thread.add_message(["file_a"])
+    assert tracker.collect("thread") == []
+    other = make_tracker(thread)
+    other.cache = tracker.cache
+    assert [artifact.file_id for artifact in other.collect("thread")] == ["file_a"]
+    assert thread.fetches == Counter({"file_a": 1})
+
+
+def test_resume_and_forget():
+    thread = StubThread()
+    tracker = make_tracker(thread)
+    first = thread.add_message(["file_a"])
+    thread.add_message(["file_b"])
+
+    # A restored session only scans the messages after its transcript
+    tracker.resume("thread", first)
+    assert [artifact.file_id for artifact in tracker.collect("thread")] == ["file_b"]
+
+    # A forgotten thread is scanned from the start, its files decoded from the cache
+    tracker.forget("thread")
+    assert tracker.cursor("thread") is None
+    assert [artifact.file_id for artifact in tracker.collect("thread")] == ["file_a", "file_b"]
+    assert thread.fetches == Counter({"file_a": 1, "file_b": 1})
@@ -0,0 +1,65 @@
+"""
+Tests of SnapshotLoader, with a stub source
+"""
+import hashlib
+import threading
+import time
+
+import pandas as pd
+
+from data_loader import SnapshotLoader
+
+
+class StubSource:
+    """
+    CSV dataset whose content can be changed, counting the fetches
+    """
+    key = "stub"
+
+    def __init__(self, data: bytes, delay: float = 0.0):
+        self.data = data
+        self.delay = delay
+        self.fetches = 0
+
+    def fetch(self, validators):
+        self.fetches += 1
+        time.sleep(self.delay)
+        return self.data, {}
+
+
+def test_concurrent_first_loads_fetch_once(tmp_path):
+    source = StubSource(b"x\n1\n2\n", delay=0.2)
+    loader = SnapshotLoader(source, snapshot_dir=str(tmp_path))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(loader.get())) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert source.fetches == 1
+    assert len(results) == 4
+    assert all(df is results[0][0] for df, _ in results)
+
+
+def test_get_returns_the_frame_with_its_hash(tmp_path):
+    source = StubSource(b"x\n1\n2\n")
+    loader = SnapshotLoader(source, snapshot_dir=str(tmp_path))
+    df, content_hash = loader.get()
+    assert content_hash == hashlib.sha256(source.data).hexdigest()
+
+    source.data = b"x\n1\n2\n3\n"
+    assert loader.refresh()
+    df, content_hash = loader.get()
+    assert len(df) == 3
+    assert content_hash == hashlib.sha256(source.data).hexdigest()
+    assert loader.content_hash == content_hash
+
+
+def test_snapshot_is_served_after_a_restart(tmp_path):
+    source = StubSource(b"x\n1\n2\n")
+    SnapshotLoader(source, snapshot_dir=str(tmp_path)).get()
+    df, content_hash = SnapshotLoader(source, snapshot_dir=str(tmp_path)).get()
+    assert source.fetches == 1
+    pd.testing.assert_frame_equal(df, pd.DataFrame({"x": [1, 2]}))
+    assert content_hash == hashlib.sha256(source.data).hexdigest()
@@ -0,0 +1,60 @@
+"""
+Tests of run_guardrails: a check which fails or times out blocks the text unless failing open
+"""
+import threading
+
+from guardrails import run_guardrails
+
+
+def passing(text):
+    return False
+
+
+def failing(text):
+    raise RuntimeError("moderation unavailable")
+
+
+def test_flagging_check_blocks_and_cancels_the_speculative_work():
+    cancelled = threading.Event()
+    result = run_guardrails("text", {"pass": passing, "flag": lambda text: True},
+                            speculative=lambda: "thread", cancel=lambda prepared: cancelled.set())
+    assert result.flagged_by == "flag" and not result.unchecked
+    assert cancelled.wait(1.0)
+
+
+def test_failing_check_blocks():
+    result = run_guardrails("text", {"pass": passing, "fail": failing})
+    assert result.flagged_by == "fail" and result.unchecked
+    assert result.failed == ["fail"]
+
+
+def test_slow_check_blocks():
+    release = threading.Event()
+    try:
+        result = run_guardrails("text", {"pass": passing, "slow": lambda text: release.wait(5.0)}, timeout=0.05)
+    finally:
+        release.set()
+    assert result.flagged_by == "slow" and result.unchecked
+    assert result.timed_out == ["slow"]
+
+
+def test_fail_open_passes_failing_and_slow_checks():
+    release = threading.Event()
+    try:
+        result = run_guardrails("text", {"fail": failing, "slow": lambda text: release.wait(5.0)}, timeout=0.05,
+                                speculative=lambda: "thread", fail_open=True)
+    finally:
+        release.set()
+    assert not result.flagged
+    assert result.failed == ["fail"] and result.timed_out == ["slow"]
+    assert result.speculative_result == "thread"
+
+
+def test_failing_speculative_work_is_reported():
+    def speculative():
+        raise RuntimeError("thread creation failed")
+
+    result = run_guardrails("text", {"pass": passing}, speculative=speculative)
+    assert not result.flagged
+    assert result.speculative_result is None
+    assert isinstance(result.speculative_error, RuntimeError)
@@ -0,0 +1,71 @@
+"""
+Tests of KpiCube: the KPIs of any subset of countries match a groupby on the filtered rows
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from kpi_cube import KpiCube, filtered_kpis
+from schema import MARKETPLACES, normalize_frame
+from synthetic_data import generate_clients
+
+
+@pytest.fixture(scope="module", params=["raw", "normalized"])
+def clients(request):
+    # Some clients appear under several countries, some rows have no trial date or no country
+    df = generate_clients(5_000, seed=3, shared_client_fraction=0.2, missing_trial_fraction=0.1)
+    df.loc[df.sample(frac=0.02, random_state=3).index, "country"] = None
+    if request.param == "normalized":
+        return normalize_frame(df)
+    df["trial_date"] = pd.to_datetime(df["trial_date"])
+    return df
+
+
+def groupby_kpis(df: pd.DataFrame, countries: list) -> dict:
+    """
+    The client KPIs of the rows of the countries, counted with a groupby per KPI
+    """
+    rows = df[df["country"].isin(countries)]
+    flags = pd.DataFrame({
+        "total_clients": True,
+        "active_clients": rows["active"].eq(1).fillna(False),
+        "trial_clients": rows["trial_date"].notna(),
+        "converted_clients": rows["trial_date"].notna() & rows["paid"].eq(1).fillna(False),
+    }, index=rows.index)
+    # A client counts for a KPI if any of its rows does
+    counts = flags.groupby(rows["client_id"]).any().sum()
+    kpis = {kpi: int(counts.get(kpi, 0)) for kpi in flags.columns}
+    kpis["marketplace_connections"] = int(rows[MARKETPLACES].gt(0).any(axis=1).sum())
+    return kpis
+
+
+def country_subsets(df: pd.DataFrame) -> list:
+    countries = sorted(df["country"].dropna().unique())
+    rng = np.random.default_rng(0)
+    subsets = [[], countries, countries[:1], countries[-2:]]
+    subsets += [list(subset) for subset in itertools.combinations(countries[:4], 2)]
+    subsets += [list(rng.choice(countries, rng.integers(1, len(countries) + 1), replace=False)) for _ in range(10)]
+    return subsets
+
+
+def test_kpis_match_a_groupby_of_the_filtered_rows(clients):
+    assert clients["client_id"].duplicated().any()
+    cube = KpiCube(clients)
+    for countries in country_subsets(clients):
+        kpis = cube.kpis(countries)
+        for kpi, value in groupby_kpis(clients, countries).items():
+            assert kpis[kpi] == value, (countries, kpi)
+
+
+def test_kpis_match_the_dashboard_kpis(clients):
+    cube = KpiCube(clients)
+    for countries in country_subsets(clients):
+        kpis = cube.kpis(countries)
+        for kpi, value in filtered_kpis(clients[clients["country"].isin(countries)]).items():
+            assert np.isclose(kpis[kpi], value), (countries, kpi)
+
+
+def test_countries_exclude_the_rows_without_country(clients):
+    assert KpiCube(clients).countries == sorted(clients["country"].dropna().unique())
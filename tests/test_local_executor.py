@@ -0,0 +1,61 @@
+"""
+Tests of LocalCodeExecutor, with real worker processes
+"""
+import os
+
+import pandas as pd
+import pytest
+
+from local_executor import LocalCodeExecutor
+
+
+@pytest.fixture
+def executor():
+    executor = LocalCodeExecutor(workers=1, timeout_seconds=10, max_datasets=1)
+    yield executor
+    executor.close()
+
+
+def test_workers_run_in_their_own_directory(executor):
+    executor.load("data", pd.DataFrame({"x": [1, 2, 3]}))
+    result = executor.run("data", "import os\nprint(os.getcwd())\nprint(df['x'].sum())")
+    assert result.error is None
+    cwd, total = result.output.splitlines()
+    assert cwd != os.getcwd()
+    assert total == "6"
+
+
+def test_workers_do_not_get_the_secrets(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-secret")
+    executor = LocalCodeExecutor(workers=1, timeout_seconds=10)
+    try:
+        executor.load("data", pd.DataFrame({"x": [1]}))
+        result = executor.run("data", "import os\nprint(os.environ.get('OPENAI_API_KEY'))")
+        assert result.output.strip() == "None"
+    finally:
+        executor.close()
+
+
+def test_dropped_dataset_is_loaded_again_in_the_same_worker(executor):
+    first = pd.DataFrame({"x": [1, 2]})
+    executor.load("first", first)
+    assert executor.run("first", "print(len(df))").output.strip() == "2"
+    # Another session's dataset drops the first one from the registry
+    executor.load("second", pd.DataFrame({"x": [1, 2, 3]}))
+
+    result = executor.run("first", "print(len(df))", first)
+    assert result.error is None and result.output.strip() == "2"
+    missing = executor.run("other", "print(len(df))")
+    assert missing.error is not None
+    assert executor.stats()["restarts"] == 0
+
+
+def test_worker_stuck_in_the_code_is_replaced():
+    executor = LocalCodeExecutor(workers=1, timeout_seconds=0.5)
+    try:
+        executor.load("data", pd.DataFrame({"x": [1]}))
+        assert executor.run("data", "while True: pass").error is not None
+        assert executor.stats()["restarts"] == 1
+        assert executor.run("data", "print(df['x'].sum())").output.strip() == "1"
+    finally:
+        executor.close()
@@ -0,0 +1,107 @@
+"""
+Tests of WarmThreadPool, with stub create and delete functions
+"""
+import itertools
+import threading
+import time
+
+import pytest
+
+from thread_pool import WarmThreadPool
+
+
+class StubThreads:
+    """
+    Threads created and deleted by the pool, by (file id, context)
+    """
+    def __init__(self):
+        self.ids = itertools.count()
+        self.live: dict[str, tuple[str, str]] = {}
+        self.lock = threading.Lock()
+
+    def create(self, file_id, context):
+        with self.lock:
+            thread_id = f"thread_{next(self.ids)}"
+            self.live[thread_id] = (file_id, context)
+            return thread_id
+
+    def delete(self, thread_id):
+        with self.lock:
+            del self.live[thread_id]
+
+
+@pytest.fixture
+def threads():
+    return StubThreads()
+
+
+def make_pool(threads, **kwargs):
+    return WarmThreadPool(create_fn=threads.create, delete_fn=threads.delete, **kwargs)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_acquire_hands_out_a_thread_of_the_key(threads):
+    pool = make_pool(threads, size=2)
+    try:
+        pool.prewarm("file_a", "profile a")
+        wait_for(lambda: pool.stats()["ready"] == 2)
+        thread_id, hit = pool.acquire("file_a", "profile a")
+        assert hit and threads.live[thread_id] == ("file_a", "profile a")
+        wait_for(lambda: pool.stats()["ready"] == 2)
+    finally:
+        pool.close()
+    # Only the acquired thread is left
+    assert list(threads.live) == [thread_id]
+
+
+def test_sessions_of_different_keys_keep_their_threads(threads):
+    pool = make_pool(threads, size=2)
+    try:
+        keys = [("file_a", "profile a"), ("file_b", "profile b")]
+        for key in keys:
+            pool.prewarm(*key)
+        wait_for(lambda: pool.stats()["ready"] == 4)
+
+        # Sessions of both datasets take turns: each finds a ready thread of its own
+        for key in keys * 3:
+            thread_id, hit = pool.acquire(*key)
+            assert hit and threads.live[thread_id] == key
+            wait_for(lambda: pool.stats()["ready"] == 4)
+        assert pool.stats()["keys"] == 2
+    finally:
+        pool.close()
+    # No ready thread was deleted before the pool closed
+    assert len(threads.live) == 6
+
+
+def test_least_recently_requested_keys_are_dropped(threads):
+    pool = make_pool(threads, size=1, max_keys=2)
+    try:
+        for key in [("file_a", ""), ("file_b", ""), ("file_c", "")]:
+            pool.prewarm(*key)
+            wait_for(lambda: pool.stats()["ready"] == min(pool.stats()["keys"], 2))
+        assert pool.stats()["keys"] == 2
+        assert sorted(threads.live.values()) == [("file_b", ""), ("file_c", "")]
+    finally:
+        pool.close()
+
+
+def test_idle_keys_expire(threads):
+    pool = make_pool(threads, size=1, ttl_seconds=0.5)
+    try:
+        pool.prewarm("file_a", "")
+        wait_for(lambda: pool.stats()["ready"] == 1)
+        # Not requested for a TTL: the key and its thread are dropped on the next wake up
+        time.sleep(0.6)
+        pool.prewarm("file_b", "")
+        wait_for(lambda: pool.stats()["ready"] == 1)
+        assert list(threads.live.values()) == [("file_b", "")]
+        assert pool.stats()["keys"] == 1
+    finally:
+        pool.close()
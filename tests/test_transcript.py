@@ -0,0 +1,54 @@
+"""
+Tests of the purge of the blobs of the expired transcripts
+"""
+import os
+import time
+
+from transcript import BlobStore, Transcript, TranscriptDB
+
+
+def age(blob_store, digest, seconds):
+    past = time.time() - seconds
+    os.utime(blob_store.path(digest), (past, past))
+
+
+def saved_transcript(blob_store, db, session_id, image):
+    transcript = Transcript(blob_store, db=db, session_id=session_id, directory=blob_store.directory)
+    transcript.bind(thread_id=f"thread_{session_id}")
+    transcript.begin_turn("assistant")
+    transcript.add("text", "The conversion rate rose")
+    digest = transcript.add_blob("image", image)
+    transcript.save()
+    return digest
+
+
+def test_purge_deletes_only_old_unreferenced_blobs(tmp_path):
+    blob_store = BlobStore(str(tmp_path / "blobs"))
+    db_path = str(tmp_path / "transcripts.sqlite3")
+    db = TranscriptDB(db_path)
+    kept = saved_transcript(blob_store, db, "kept", b"kept image")
+    expired = saved_transcript(blob_store, db, "expired", b"expired image")
+    # A blob of a live session without database, stored long ago, and stored again lately
+    reused = blob_store.put(b"reused image")
+    age(blob_store, reused, 3600)
+    blob_store.put(b"reused image")
+    for digest in (kept, expired):
+        age(blob_store, digest, 3600)
+
+    # The expired session is deleted on start, along with its turns
+    db._db.execute("UPDATE sessions SET updated_at = 0 WHERE session_id = 'expired'")
+    db._db.commit()
+    db = TranscriptDB(db_path, ttl_seconds=60)
+    assert db.blob_digests() == {kept}
+
+    assert blob_store.purge(db.blob_digests(), max_age_seconds=60) == 1
+    assert not os.path.exists(blob_store.path(expired))
+    assert blob_store.get(kept) == b"kept image"
+    assert blob_store.get(reused) == b"reused image"
+
+
+def test_purge_keeps_recent_blobs(tmp_path):
+    blob_store = BlobStore(str(tmp_path / "blobs"))
+    digest = blob_store.put(b"image")
+    assert blob_store.purge(set(), max_age_seconds=60) == 0
+    assert blob_store.get(digest) == b"image"
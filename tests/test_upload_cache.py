@@ -0,0 +1,92 @@
+"""
+Tests of DatasetUploadCache, with stub upload and delete functions
+"""
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from upload_cache import DatasetUploadCache
+
+
+class StubFiles:
+    """
+    Uploads, slow on request, and deletions of the cache
+    """
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.uploads = 0
+        self.deleted = []
+        self.fail = False
+        self.lock = threading.Lock()
+
+    def upload(self, df):
+        time.sleep(self.delay)
+        if self.fail:
+            raise IOError("upload failed")
+        with self.lock:
+            self.uploads += 1
+            return f"file_{self.uploads}"
+
+    def delete(self, file_id):
+        self.deleted.append(file_id)
+
+
+def frame(n):
+    return pd.DataFrame({"x": range(n)})
+
+
+def run_concurrently(*calls):
+    results = [None] * len(calls)
+    threads = [threading.Thread(target=lambda i=i, call=call: results.__setitem__(i, call()))
+               for i, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_misses_of_a_dataset_upload_once():
+    files = StubFiles(delay=0.2)
+    cache = DatasetUploadCache(files.upload, files.delete)
+    results = run_concurrently(*[lambda: cache.get_or_upload(frame(3)) for _ in range(4)])
+    assert files.uploads == 1
+    assert {file_id for file_id, _ in results} == {"file_1"}
+    assert sorted(hit for _, hit in results) == [False, True, True, True]
+
+
+def test_hits_do_not_wait_for_the_upload_of_another_dataset():
+    files = StubFiles()
+    cache = DatasetUploadCache(files.upload, files.delete)
+    cache.get_or_upload(frame(1))
+    files.delay = 0.5
+    upload = threading.Thread(target=cache.get_or_upload, args=(frame(2),))
+    upload.start()
+    time.sleep(0.05)
+    start = time.perf_counter()
+    assert cache.get_or_upload(frame(1)) == ("file_1", True)
+    assert time.perf_counter() - start < 0.2
+    upload.join()
+
+
+def test_failed_upload_is_retried():
+    files = StubFiles()
+    files.fail = True
+    cache = DatasetUploadCache(files.upload, files.delete)
+    with pytest.raises(IOError):
+        cache.get_or_upload(frame(1))
+    files.fail = False
+    assert cache.get_or_upload(frame(1)) == ("file_1", False)
+
+
+def test_evicts_only_the_uploads_no_session_uses():
+    files = StubFiles()
+    cache = DatasetUploadCache(files.upload, files.delete, max_entries=1)
+    cache.get_or_upload(frame(1), owner="session_a")
+    cache.get_or_upload(frame(2), owner="session_b")
+    assert files.deleted == []
+    # Session a moves to another dataset: its previous upload is deleted
+    cache.get_or_upload(frame(3), owner="session_a")
+    assert files.deleted == ["file_1"]
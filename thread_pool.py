@@ -0,0 +1,215 @@
+"""
+thread_pool.py
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Optional, Tuple
+
+# Config
+THREAD_POOL_SIZE = int(os.environ.get("THREAD_POOL_SIZE", 3))
+THREAD_POOL_TTL_SECONDS = float(os.environ.get("THREAD_POOL_TTL_SECONDS", 3600))
+# Files and contexts (e.g. the filters of the sessions) the pool keeps ready threads for at once
+THREAD_POOL_MAX_KEYS = int(os.environ.get("THREAD_POOL_MAX_KEYS", 8))
+# Delay before retrying after a failed thread creation
+THREAD_POOL_RETRY_SECONDS = 5.0
+
+
+class WarmThreadPool:
+    """
+    Pool of assistant threads created ahead of the questions, with a dataset file attached,
+    and optionally a context message, e.g. the profile of the dataset.
+
+    Ready threads are kept per (file id, context) requested, up to `size` each, so that the sessions
+    of different datasets do not flush each other's threads. Each `acquire` hands out a ready thread
+    for its key (or creates one if none is ready), and wakes a daemon thread refilling the pool.
+    Ready threads idle for longer than the TTL are deleted; a key not requested for a TTL is dropped
+    with its threads, as is the least recently requested key beyond `max_keys`.
+    """
+    def __init__(self,
+                 create_fn: Callable[[str, str], str],
+                 delete_fn: Callable[[str], None],
+                 size: int = THREAD_POOL_SIZE,
+                 ttl_seconds: float = THREAD_POOL_TTL_SECONDS,
+                 max_keys: int = THREAD_POOL_MAX_KEYS):
+        """
+        Args:
+        - create_fn (Callable): Creates a thread with the file attached and the context message, and returns the thread id
+        - delete_fn (Callable): Deletes a thread by its id
+        - size (int): Number of ready threads to keep for each file and context
+        - ttl_seconds (float): Idle time after which a ready thread, or a file and context, is dropped
+        - max_keys (int): Number of files and contexts the pool is filled for at once
+        """
+        self.create_fn = create_fn
+        self.delete_fn = delete_fn
+        self.size = size
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.expired = 0
+        self.failures = 0
+        # (file id, context) -> ready threads as (created at, thread id), oldest first;
+        # the keys in the order they were last requested
+        self._ready: "OrderedDict[tuple[str, str], deque[tuple[float, str]]]" = OrderedDict()
+        # (file id, context) -> last time it was requested
+        self._requested: dict[tuple[str, str], float] = {}
+        self._closed = False
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="thread-pool", daemon=True)
+        self._thread.start()
+
+    def acquire(self, file_id: str, context: str = "") -> Tuple[str, bool]:
+        """
+        Hand out a thread with the file attached, removing it from the pool
+
+        Args:
+        - file_id (str): The id of the file attached to the thread
+        - context (str): The text of the first message of the thread, or "" for none
+
+        Returns:
+        - str: The thread id
+        - bool: True if the thread was ready in the pool
+        """
+        thread_id = None
+        hit = False
+        with self._lock:
+            stale = self._request((file_id, context))
+            ready = self._ready[(file_id, context)]
+            if ready:
+                _, thread_id = ready.popleft()
+                hit = True
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._wake.set()
+
+        for stale_id in stale:
+            self.delete_fn(stale_id)
+        if thread_id is None:
+            thread_id = self.create_fn(file_id, context)
+            with self._lock:
+                self.created += 1
+        return thread_id, hit
+
+    def prewarm(self, file_id: str, context: str = "") -> None:
+        """
+        Start filling the pool for the file and context, ahead of the first `acquire`
+        """
+        with self._lock:
+            stale = self._request((file_id, context))
+        self._wake.set()
+        for stale_id in stale:
+            self.delete_fn(stale_id)
+
+    def stats(self) -> dict:
+        """
+        Return the hit/miss counters and the number of ready threads
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "ready": sum(len(ready) for ready in self._ready.values()),
+                "keys": len(self._ready),
+                "created": self.created,
+                "expired": self.expired,
+                "failures": self.failures,
+            }
+
+    def close(self) -> None:
+        """
+        Stop refilling the pool and delete the ready threads
+        """
+        with self._lock:
+            self._closed = True
+            stale = [ready_id for ready in self._ready.values() for _, ready_id in ready]
+            self._ready.clear()
+            self._requested.clear()
+        self._wake.set()
+        for stale_id in stale:
+            self.delete_fn(stale_id)
+
+    def _request(self, key: tuple[str, str]) -> list[str]:
+        """
+        Fill the pool for the file and context, returning the ids of the threads to delete. Needs the lock.
+        """
+        self._ready.setdefault(key, deque())
+        self._ready.move_to_end(key)
+        self._requested[key] = time.monotonic()
+        stale = self._expire()
+        # Threads of the files and contexts least recently requested are of no use anymore
+        while len(self._ready) > self.max_keys:
+            dropped, ready = self._ready.popitem(last=False)
+            del self._requested[dropped]
+            stale += [ready_id for _, ready_id in ready]
+        return stale
+
+    def _expire(self) -> list[str]:
+        """
+        Remove the ready threads idle for longer than the TTL, and the files and contexts not requested
+        for as long, returning the ids of their threads. Needs the lock.
+        """
+        expired = []
+        now = time.monotonic()
+        deadline = now - self.ttl_seconds
+        for key in list(self._ready):
+            ready = self._ready[key]
+            while ready and ready[0][0] < deadline:
+                expired.append(ready.popleft()[1])
+            if self._requested[key] < deadline:
+                expired += [ready_id for _, ready_id in ready]
+                del self._ready[key]
+                del self._requested[key]
+        self.expired += len(expired)
+        return expired
+
+    def _next_key(self) -> Optional[tuple[str, str]]:
+        """
+        Return the most recently requested file and context short of ready threads, or None. Needs the lock.
+        """
+        for key in reversed(self._ready):
+            if len(self._ready[key]) < self.size:
+                return key
+        return None
+
+    def _run(self) -> None:
+        while True:
+            # Also wake up periodically, to expire the idle threads
+            self._wake.wait(timeout=min(self.ttl_seconds, 60.0))
+            self._wake.clear()
+
+            while True:
+                with self._lock:
+                    if self._closed:
+                        return
+                    expired = self._expire()
+                    key = self._next_key()
+                for expired_id in expired:
+                    self.delete_fn(expired_id)
+                if key is None:
+                    break
+
+                try:
+                    thread_id = self.create_fn(*key)
+                except Exception as e:
+                    print(f"Failed to pre-create thread: \t {e}")
+                    with self._lock:
+                        self.failures += 1
+                    time.sleep(THREAD_POOL_RETRY_SECONDS)
+                    continue
+
+                with self._lock:
+                    self.created += 1
+                    # The file and context were dropped while the thread was being created
+                    ready = self._ready.get(key)
+                    keep = ready is not None and len(ready) < self.size and not self._closed
+                    if keep:
+                        ready.append((time.monotonic(), thread_id))
+                if not keep:
+                    self.delete_fn(thread_id)
@@ -0,0 +1,490 @@
+"""
+transcript.py
+
+Transcript of a chat session: the turns of the user and of the assistant, as compact records
+whose binary payloads (images, tables) are stored once, by content hash, in a shared blob store.
+The transcript keeps its latest turns in memory within a budget, and spills the older ones to
+a file of its own, or, when bound to the SQLite transcript database, saves each turn as its
+parts complete, so that the session can be restored from local disk, e.g.
+
+    transcript = Transcript.restore(blob_store, TranscriptDB(), session_id)
+    transcript.begin_turn("assistant")
+    transcript.extend("text", "The conversion rate rose")
+    transcript.add_blob("image", png_bytes)
+    transcript.save()
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from typing import Iterator, Optional
+
+# Config
+TRANSCRIPT_DIR = os.environ.get("TRANSCRIPT_DIR", ".transcripts")
+# Set to an empty string to keep the transcripts in memory only
+TRANSCRIPT_DB_PATH = os.environ.get("TRANSCRIPT_DB_PATH", os.path.join(TRANSCRIPT_DIR, "transcripts.sqlite3"))
+TRANSCRIPT_DB_TTL_SECONDS = 30 * 24 * 3600
+# Turns loaded at once when restoring or rendering a long transcript
+TRANSCRIPT_PAGE_TURNS = 20
+# Size of the text of the turns kept in memory, per transcript, above which the oldest are spilled
+TRANSCRIPT_MEMORY_BYTES = int(os.environ.get("TRANSCRIPT_MEMORY_BYTES", 1024 * 1024))
+# Size of the blobs kept in memory, across transcripts, in front of their files
+BLOB_CACHE_BYTES = int(os.environ.get("BLOB_CACHE_BYTES", 32 * 1024 * 1024))
+# Estimated overhead of a part in memory: its list, and its string headers
+PART_OVERHEAD_BYTES = 160
+# Kinds of the parts whose value is their text, rather than the digest of a blob
+TEXT_PART_KINDS = ("text", "code", "output")
+
+
+class BlobStore:
+    """
+    Content-addressed store of binary payloads, written once to a file named by their SHA-256 digest,
+    with an LRU cache of the latest used in memory, bounded in bytes
+    """
+    def __init__(self, directory: str = os.path.join(TRANSCRIPT_DIR, "blobs"), max_bytes: int = BLOB_CACHE_BYTES):
+        """
+        Args:
+        - directory (str): Directory of the blob files
+        - max_bytes (int): Total size of the blobs kept in memory before evicting
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._bytes = 0
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, data: bytes) -> str:
+        """
+        Store a payload, returning its digest
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        try:
+            # Marks the blob as in use, for `purge`
+            os.utime(path)
+        except FileNotFoundError:
+            # Written under a temporary name, so that a file by its digest is always complete
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            with self._lock:
+                self.writes += 1
+        self._cache(digest, data)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        """
+        Return the payload of the digest
+        """
+        with self._lock:
+            data = self._entries.get(digest)
+            if data is not None:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return data
+            self.misses += 1
+        with open(self.path(digest), "rb") as f:
+            data = f.read()
+        self._cache(digest, data)
+        return data
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    def purge(self, keep: set[str], max_age_seconds: float) -> int:
+        """
+        Delete the blob files not in `keep` and not stored for longer than `max_age_seconds`, which
+        may still be used by the transcripts of the live sessions
+
+        Args:
+        - keep (set[str]): The digests still referenced, e.g. by the turns of the database
+        - max_age_seconds (float): Time since a blob was last stored after which it can be deleted
+
+        Returns:
+        - int: The number of files deleted
+        """
+        expired = time.time() - max_age_seconds
+        removed = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name in keep or entry.name.endswith(".tmp") or not entry.is_file():
+                    continue
+                try:
+                    if entry.stat().st_mtime >= expired:
+                        continue
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                with self._lock:
+                    data = self._entries.pop(entry.name, None)
+                    if data is not None:
+                        self._bytes -= len(data)
+        return removed
+
+    def stats(self) -> dict:
+        """
+        Return the hit rate and the size of the cache
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "writes": self.writes,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def _cache(self, digest: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                return
+            self._entries[digest] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+class Turn:
+    """
+    A turn of the conversation: its role, and its parts in order, as `[kind, value]` pairs. The
+    value of a text part (`TEXT_PART_KINDS`) is the text, the value of any other part (e.g. `image`,
+    `markdown`) is the digest of its blob.
+    """
+    __slots__ = ("role", "parts")
+
+    def __init__(self, role: str, parts: Optional[list] = None):
+        self.role = role
+        self.parts = parts if parts is not None else []
+
+    def text(self, kind: str = "text") -> str:
+        """
+        Return the text of the parts of a kind, joined
+        """
+        return "".join(value for part_kind, value in self.parts if part_kind == kind)
+
+    def blobs(self, kind: str) -> list[str]:
+        """
+        Return the digests of the blobs of a kind
+        """
+        return [value for part_kind, value in self.parts if part_kind == kind]
+
+    @property
+    def size(self) -> int:
+        """
+        Estimated size of the turn in memory, in bytes
+        """
+        return sum(len(value) + PART_OVERHEAD_BYTES for _, value in self.parts)
+
+    def to_json(self) -> str:
+        return json.dumps([self.role, self.parts], ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, line: str) -> "Turn":
+        role, parts = json.loads(line)
+        return cls(role, parts)
+
+
+class TranscriptDB:
+    """
+    SQLite database (in WAL mode) of the transcripts, keyed by session id: the thread of each
+    session, and its turns by position. The blobs the turns refer to stay in the blob store.
+    Sessions not updated for longer than the TTL are deleted; `blob_digests` lists the blobs the
+    remaining turns refer to, for `BlobStore.purge`.
+    """
+    def __init__(self, db_path: str = TRANSCRIPT_DB_PATH, ttl_seconds: float = TRANSCRIPT_DB_TTL_SECONDS):
+        """
+        Args:
+        - db_path (str): Path of the SQLite database, or ":memory:"
+        - ttl_seconds (float): Time after which an inactive session is deleted
+        """
+        self.writes = 0
+        self._lock = threading.Lock()
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        # Readers do not wait for the writes of the other sessions, and the commits do not sync each time
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                         "session_id TEXT PRIMARY KEY, thread_id TEXT, cursor TEXT, updated_at REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS turns ("
+                         "session_id TEXT, position INTEGER, thread_id TEXT, role TEXT, parts TEXT, "
+                         "PRIMARY KEY (session_id, position))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS turns_thread_id ON turns (thread_id)")
+        expired = time.time() - ttl_seconds
+        self._db.execute("DELETE FROM turns WHERE session_id IN "
+                         "(SELECT session_id FROM sessions WHERE updated_at < ?)", (expired,))
+        self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (expired,))
+        self._db.commit()
+
+    def session(self, session_id: str) -> tuple[Optional[str], Optional[str], int]:
+        """
+        Return the thread id of the session, its cursor, and its number of turns
+        """
+        with self._lock:
+            row = self._db.execute("SELECT thread_id, cursor FROM sessions WHERE session_id = ?",
+                                   (session_id,)).fetchone()
+            count = self._db.execute("SELECT COUNT(*) FROM turns WHERE session_id = ?", (session_id,)).fetchone()[0]
+        thread_id, cursor = row if row is not None else (None, None)
+        return thread_id, cursor, count
+
+    def save_session(self, session_id: str, thread_id: Optional[str], cursor: Optional[str]) -> None:
+        """
+        Store the thread of the session, and its cursor, e.g. the id of the last message handled
+        """
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                             (session_id, thread_id, cursor, time.time()))
+            self._db.commit()
+            self.writes += 1
+
+    def save_turn(self, session_id: str, thread_id: Optional[str], position: int, turn: Turn) -> None:
+        """
+        Store a turn of the session, replacing its previous state
+        """
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO turns VALUES (?, ?, ?, ?, ?)",
+                             (session_id, position, thread_id, turn.role, json.dumps(turn.parts, ensure_ascii=False)))
+            self._db.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?", (time.time(), session_id))
+            self._db.commit()
+            self.writes += 1
+
+    def load_turns(self, session_id: str, start: int, stop: int) -> list[Turn]:
+        """
+        Return the turns of the session from position `start` to `stop` (excluded)
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT role, parts FROM turns WHERE session_id = ? AND position >= ? "
+                                    "AND position < ? ORDER BY position", (session_id, start, stop)).fetchall()
+        return [Turn(role, json.loads(parts)) for role, parts in rows]
+
+    def blob_digests(self) -> set[str]:
+        """
+        Return the digests of the blobs the stored turns refer to
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT parts FROM turns").fetchall()
+        return {value for (parts,) in rows for kind, value in json.loads(parts) if kind not in TEXT_PART_KINDS}
+
+    def stats(self) -> dict:
+        """
+        Return the number of sessions and turns stored, and of writes
+        """
+        with self._lock:
+            sessions = self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            turns = self._db.execute("SELECT COUNT(*) FROM turns").fetchone()[0]
+        return {"sessions": sessions, "turns": turns, "writes": self.writes}
+
+
+class Transcript:
+    """
+    Turns of a chat session, the latest within the memory budget. Without a database, the older
+    turns are spilled to a file deleted with the transcript. With a database, each turn is saved
+    when a part is added and when the next turn begins, and the older turns are read back from it.
+    """
+    def __init__(self, blob_store: BlobStore, memory_bytes: int = TRANSCRIPT_MEMORY_BYTES,
+                 directory: str = TRANSCRIPT_DIR, db: Optional[TranscriptDB] = None,
+                 session_id: Optional[str] = None):
+        """
+        Args:
+        - blob_store (BlobStore): Stores the binary payloads of the turns
+        - memory_bytes (int): Size of the turns kept in memory, above which the oldest are spilled
+        - directory (str): Directory of the spill file
+        - db (TranscriptDB): Saves the turns, or None to keep them for the session only
+        - session_id (str): Key of the transcript in the database
+        """
+        self.blob_store = blob_store
+        self.memory_bytes = memory_bytes
+        self.db = db
+        self.session_id = session_id
+        # The thread of the conversation, and the id of its last message handled
+        self.thread_id: Optional[str] = None
+        self.cursor: Optional[str] = None
+        self.spill_path = os.path.join(directory, f"{uuid.uuid4().hex}.jsonl")
+        self.spilled = 0
+        self._turns: "deque[Turn]" = deque()
+        self._bytes = 0
+        # The spill file goes with the transcript, e.g. when the session ends
+        self._finalizer = weakref.finalize(self, _remove, self.spill_path)
+
+    @classmethod
+    def restore(cls, blob_store: BlobStore, db: TranscriptDB, session_id: str,
+                page_turns: int = TRANSCRIPT_PAGE_TURNS, **kwargs) -> "Transcript":
+        """
+        Restore the transcript of a session from the database, loading only its latest turns;
+        a new session starts empty
+
+        Args:
+        - blob_store (BlobStore): Stores the binary payloads of the turns
+        - db (TranscriptDB): The database of the transcripts
+        - session_id (str): Key of the transcript in the database
+        - page_turns (int): Number of latest turns loaded in memory
+        - kwargs: The other arguments of the transcript
+        """
+        transcript = cls(blob_store, db=db, session_id=session_id, **kwargs)
+        transcript.thread_id, transcript.cursor, count = db.session(session_id)
+        transcript.spilled = max(0, count - page_turns)
+        transcript._turns.extend(db.load_turns(session_id, transcript.spilled, count))
+        transcript._bytes = sum(turn.size for turn in list(transcript._turns)[:-1])
+        return transcript
+
+    @property
+    def current(self) -> Optional[Turn]:
+        """
+        The latest turn, or None
+        """
+        return self._turns[-1] if self._turns else None
+
+    def __len__(self) -> int:
+        return self.spilled + len(self._turns)
+
+    def bind(self, thread_id: Optional[str] = None, cursor: Optional[str] = None) -> None:
+        """
+        Record the thread of the conversation, and the id of its last message handled
+        """
+        if thread_id is not None:
+            self.thread_id = thread_id
+        if cursor is not None:
+            self.cursor = cursor
+        if self.db is not None:
+            self.db.save_session(self.session_id, self.thread_id, self.cursor)
+
+    def begin_turn(self, role: str) -> Turn:
+        """
+        Start a new turn, saving the previous one, and spilling the oldest turns if the memory budget is exceeded
+        """
+        if self._turns:
+            self.save()
+            self._bytes += self._turns[-1].size
+        self._spill()
+        turn = Turn(role)
+        self._turns.append(turn)
+        return turn
+
+    def add(self, kind: str, value: str) -> None:
+        """
+        Add a new part to the current turn, saving the turn with the previous parts complete
+        """
+        self.current.parts.append([kind, value])
+        self.save()
+
+    def extend(self, kind: str, value: str) -> str:
+        """
+        Append text to the last part of the current turn if it is of the same kind, or add a new part
+
+        Returns:
+        - str: The text of the part
+        """
+        parts = self.current.parts
+        if parts and parts[-1][0] == kind:
+            parts[-1][1] += value
+        else:
+            self.add(kind, value)
+        return parts[-1][1]
+
+    def replace(self, kind: str, value: str) -> None:
+        """
+        Replace the text of the last part of the current turn if it is of the same kind, or add a new part
+        """
+        parts = self.current.parts
+        if parts and parts[-1][0] == kind:
+            parts[-1][1] = value
+        else:
+            self.add(kind, value)
+
+    def add_blob(self, kind: str, data: bytes) -> str:
+        """
+        Store a binary payload, and add a part referring to it to the current turn
+
+        Returns:
+        - str: The digest of the payload
+        """
+        digest = self.blob_store.put(data)
+        self.add(kind, digest)
+        return digest
+
+    def save(self) -> None:
+        """
+        Save the current turn to the database, e.g. once the answer is complete
+        """
+        if self.db is not None and self._turns:
+            self.db.save_turn(self.session_id, self.thread_id, len(self) - 1, self._turns[-1])
+
+    def turns(self, start: int = 0) -> Iterator[Turn]:
+        """
+        Iterate over the turns from the position `start`, reading the spilled ones from the database
+        a page at a time, or from their file one at a time
+        """
+        position = start
+        if self.db is not None:
+            while position < self.spilled:
+                stop = min(position + TRANSCRIPT_PAGE_TURNS, self.spilled)
+                yield from self.db.load_turns(self.session_id, position, stop)
+                position = stop
+        elif position < self.spilled:
+            with open(self.spill_path, encoding="utf-8") as f:
+                for line_number, line in enumerate(f):
+                    if line_number >= position:
+                        yield Turn.from_json(line)
+            position = self.spilled
+        yield from list(self._turns)[position - self.spilled:]
+
+    def stats(self) -> dict:
+        """
+        Return the number of turns, in memory and spilled, and the memory they use
+        """
+        return {
+            "turns": len(self),
+            "in_memory": len(self._turns),
+            "spilled": self.spilled,
+            "memory_bytes": self._bytes + (self._turns[-1].size if self._turns else 0),
+            "blob_store": self.blob_store.stats(),
+        }
+
+    def close(self) -> None:
+        """
+        Delete the spill file
+        """
+        self._finalizer()
+
+    def _spill(self) -> None:
+        """
+        Drop the oldest turns from memory until the others fit in the budget, appending them to the
+        spill file unless they are saved in the database
+        """
+        if self._bytes <= self.memory_bytes:
+            return
+        spilled = []
+        while self._turns and self._bytes > self.memory_bytes:
+            turn = self._turns.popleft()
+            self._bytes -= turn.size
+            spilled.append(turn)
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                f.writelines(turn.to_json() + "\n" for turn in spilled)
+        self.spilled += len(spilled)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,169 @@
+"""
+upload_cache.py
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional, Tuple
+
+import pandas as pd
+
+# Config
+UPLOAD_CACHE_MAX_ENTRIES = 4
+# A session idle for longer than this no longer keeps its upload from being evicted
+UPLOAD_REFERENCE_TTL_SECONDS = 3600
+
+
+def frame_fingerprint(df: pd.DataFrame, *extra: str) -> str:
+    """
+    Compute a stable hash of a dataframe's content and schema
+
+    Args:
+    - df (pd.DataFrame): The dataframe to hash
+    - extra (str): Additional strings mixed into the hash (e.g. the export format)
+
+    Returns:
+    - str: Hex digest identifying the dataframe
+    """
+    hasher = hashlib.sha256()
+    # Schema: column names and dtypes, in order
+    for column, dtype in df.dtypes.items():
+        hasher.update(f"{column}:{dtype}\x1f".encode("utf-8"))
+    hasher.update(f"rows:{len(df)}\x1e".encode("utf-8"))
+    # Content: one 64-bit hash per row, independent of the index
+    if len(df) > 0:
+        hasher.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    for value in extra:
+        hasher.update(f"\x1d{value}".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class DatasetUploadCache:
+    """
+    Process-wide cache of uploaded datasets, keyed by the dataframe fingerprint.
+
+    Uploads are only performed when the fingerprint is not cached, outside the lock, and once for
+    concurrent misses of the same fingerprint. Each session using an upload
+    holds a reference to it, until it moves to another dataset or stays idle for longer than the
+    reference TTL. When the cache is full, the least recently used upload no session references
+    is evicted and deleted remotely; referenced uploads are kept, even above the bound.
+    """
+    def __init__(self,
+                 upload_fn: Callable[[pd.DataFrame], str],
+                 delete_fn: Callable[[str], None],
+                 max_entries: int = UPLOAD_CACHE_MAX_ENTRIES,
+                 reference_ttl_seconds: float = UPLOAD_REFERENCE_TTL_SECONDS):
+        """
+        Args:
+        - upload_fn (Callable): Uploads the dataframe and returns the file id
+        - delete_fn (Callable): Deletes an uploaded file by its id
+        - max_entries (int): Number of uploads to keep before evicting the unreferenced ones
+        - reference_ttl_seconds (float): Time after which the reference of an idle session is dropped
+        """
+        self.upload_fn = upload_fn
+        self.delete_fn = delete_fn
+        self.max_entries = max(1, max_entries)
+        self.reference_ttl_seconds = reference_ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        # owner -> (key of the upload it uses, time of its last use)
+        self._owners: dict[str, tuple[str, float]] = {}
+        # key -> file id of the upload in flight, for the concurrent misses of the same key
+        self._uploads: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def get_or_upload(self, df: pd.DataFrame, *extra: str, owner: Optional[str] = None) -> Tuple[str, bool]:
+        """
+        Return the file id for the dataframe, uploading it if it is not cached
+
+        Args:
+        - df (pd.DataFrame): The dataframe to upload
+        - extra (str): Additional strings mixed into the cache key
+        - owner (str): The session using the upload, e.g. its id, whose previous upload it replaces
+
+        Returns:
+        - str: The file id of the uploaded dataset
+        - bool: True if the file id was served from the cache
+        """
+        key = frame_fingerprint(df, *extra)
+        with self._lock:
+            if owner is not None:
+                self._owners[owner] = (key, time.monotonic())
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key], True
+            upload = self._uploads.get(key)
+            leader = upload is None
+            if leader:
+                upload = self._uploads[key] = Future()
+            else:
+                self.hits += 1
+
+        if not leader:
+            # Another session is uploading the same dataset; its failure is raised here too
+            return upload.result(), True
+
+        try:
+            file_id = self.upload_fn(df)
+        except Exception as e:
+            # An upload which fails is not cached, and is tried again on the next call
+            with self._lock:
+                del self._uploads[key]
+            upload.set_exception(e)
+            raise
+        with self._lock:
+            del self._uploads[key]
+            self.misses += 1
+            self._entries[key] = file_id
+            stale_file_ids = self._evict()
+        upload.set_result(file_id)
+        print(f"Uploaded dataset: \t {file_id}")
+
+        for stale_file_id in stale_file_ids:
+            try:
+                self.delete_fn(stale_file_id)
+                print(f"Evicted stale dataset: \t {stale_file_id}")
+            except Exception as e:
+                print(f"Failed to delete stale dataset {stale_file_id}: {e}")
+        return file_id, False
+
+    def stats(self) -> dict:
+        """
+        Return the cache hit/miss counters
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "owners": len(self._owners),
+            }
+
+    def _evict(self) -> list[str]:
+        """
+        Remove the least recently used uploads no session references, above the bound, returning their
+        file ids to delete. Needs the lock.
+        """
+        expired = time.monotonic() - self.reference_ttl_seconds
+        for owner, (_, used_at) in list(self._owners.items()):
+            if used_at < expired:
+                del self._owners[owner]
+        referenced = {key for key, _ in self._owners.values()}
+
+        stale_file_ids = []
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_entries:
+                break
+            if key in referenced:
+                continue
+            stale_file_ids.append(self._entries.pop(key))
+            self.evictions += 1
+        return stale_file_ids
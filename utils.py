@@ -2,29 +2,47 @@
 utils.py
 """
 import os
+import atexit
 import base64
+import contextvars
+import copy
 import hmac
+import json
 import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+import pandas as pd
 from PIL import ImageFile
-from typing import Tuple
+from typing import Optional, Tuple
 from typing_extensions import override
+import perf
+from answer_cache import AnswerCache, RecordedAnswer
+from cleanup import CleanupWorker
+from dataset_profile import DATASET_PROFILE_ENABLED, format_profile, profile_frame
+from local_executor import LocalCodeExecutor
+from openai_client import OPENAI_STREAM_TIMEOUT, get_openai_client
+from thread_pool import WarmThreadPool
+from transcript import TRANSCRIPT_DB_PATH, TRANSCRIPT_DB_TTL_SECONDS, BlobStore, Transcript, TranscriptDB
+from upload_cache import frame_fingerprint
+from verdict_cache import cached_verdict
 
 import streamlit as st
-from openai import (
-    OpenAI,
-    AssistantEventHandler
-    )
+from openai import AssistantEventHandler
 from openai.types.beta.threads import Text, TextDelta
 from openai.types.beta.threads.runs import ToolCall, ToolCallDelta
 
-# Get secrets
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", st.secrets["OPENAI_API_KEY"])
-
 # Config
 LAST_UPDATE_DATE = "2024-04-08"
+# Streamed deltas are rendered at most once per interval, or once this many characters are pending
+RENDER_INTERVAL_MS = int(os.environ.get("RENDER_INTERVAL_MS", 50))
+RENDER_MAX_CHARS = int(os.environ.get("RENDER_MAX_CHARS", 400))
+# Maximum number of concurrent requests when downloading assistant-created files
+DOWNLOAD_WORKERS = 8
 
-# Initialise the OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+# The process-wide OpenAI client
+client = get_openai_client()
 
 def render_custom_css() -> None:
     """
@@ -51,17 +69,11 @@ def initialise_session_state():
     if "file" not in st.session_state:
         st.session_state.file = None
 
-    if "assistant_text" not in st.session_state:
-        st.session_state.assistant_text = [""]
-
     for session_state_var in ["file_uploaded", "read_terms"]:
         if session_state_var not in st.session_state:
             st.session_state[session_state_var] = False
 
-    for session_state_var in ["code_input", "code_output"]:
-        if session_state_var not in st.session_state:
-            st.session_state[session_state_var] = []
-
+@cached_verdict("moderation")
 def moderation_endpoint(text) -> bool:
     """
     Checks if the text is triggers the moderation endpoint
@@ -75,6 +87,7 @@ def moderation_endpoint(text) -> bool:
     response = client.moderations.create(input=text)
     return response.results[0].flagged
 
+@cached_verdict("nsfw")
 def is_nsfw(text) -> bool:
     """
     Checks if the text is nsfw.
@@ -98,6 +111,7 @@ def is_nsfw(text) -> bool:
     output = response.choices[0].message.content
     return bool(output)
 
+@cached_verdict("not_question")
 def is_not_question(text) -> bool:
     """
     Checks if the text is not a question
@@ -121,26 +135,157 @@ def is_not_question(text) -> bool:
     output = response.choices[0].message.content
     return bool(output)
 
+@st.cache_resource
+def get_cleanup_worker() -> CleanupWorker:
+    """
+    Process-wide background worker deleting files and threads
+    """
+    return CleanupWorker(deleters={"file": client.files.delete,
+                                   "thread": client.beta.threads.delete})
+
+@st.cache_resource
+def get_thread_pool() -> WarmThreadPool:
+    """
+    Process-wide pool of threads created ahead of the questions, with the dataset file attached and its profile
+    """
+    def create_thread(file_id: str, context: str) -> str:
+        params = {}
+        # An empty file id, for the local code execution, attaches no file
+        if file_id:
+            params["tool_resources"] = {"code_interpreter": {"file_ids": [file_id]}}
+        if context:
+            params["messages"] = [{"role": "user", "content": context}]
+        return client.beta.threads.create(**params).id
+
+    thread_pool = WarmThreadPool(create_fn=create_thread, delete_fn=delete_thread)
+    # Hand the ready threads to the cleanup ledger on shutdown, so they are deleted on the next start
+    atexit.register(thread_pool.close)
+    return thread_pool
+
+@st.cache_resource
+def get_answer_cache(dataset_hash: str) -> AnswerCache:
+    """
+    Process-wide cache of the recorded answers about the dataset
+
+    Args:
+    - dataset_hash (str): Identifies the content of the dataset; the answers about other datasets are deleted
+    """
+    answer_cache = AnswerCache()
+    answer_cache.invalidate(keep_dataset_hash=dataset_hash)
+    return answer_cache
+
+@st.cache_resource
+def get_code_executor() -> LocalCodeExecutor:
+    """
+    Process-wide pool of worker processes running the assistant's code, for the local code execution
+    """
+    code_executor = LocalCodeExecutor()
+    atexit.register(code_executor.close)
+    return code_executor
+
+@st.cache_resource
+def get_blob_store() -> BlobStore:
+    """
+    Process-wide store of the images and tables of the transcripts, by content hash
+    """
+    return BlobStore()
+
+@st.cache_resource
+def get_transcript_db() -> TranscriptDB:
+    """
+    Process-wide database of the transcripts, shared by the sessions. The blobs of the expired
+    sessions, which no saved turn refers to anymore, are deleted on start
+    """
+    transcript_db = TranscriptDB()
+    removed = get_blob_store().purge(transcript_db.blob_digests(), TRANSCRIPT_DB_TTL_SECONDS)
+    print(f"Purged transcript blobs: \t {removed}")
+    return transcript_db
+
+def session_key() -> str:
+    """
+    Id of the conversation, kept in the URL so that a reconnected or reloaded page finds it, even after a restart
+    """
+    if "session" not in st.query_params:
+        st.query_params["session"] = uuid.uuid4().hex
+    return st.query_params["session"]
+
+def get_session_transcript() -> Transcript:
+    """
+    Transcript of the conversation of this session, restored from the transcript database on first use
+    """
+    if "transcript" not in st.session_state:
+        if TRANSCRIPT_DB_PATH:
+            with perf.span("transcript_restore") as span:
+                st.session_state.transcript = Transcript.restore(get_blob_store(), get_transcript_db(), session_key())
+                span.set(turns=len(st.session_state.transcript))
+        else:
+            st.session_state.transcript = Transcript(get_blob_store())
+    return st.session_state.transcript
+
+@st.cache_resource(max_entries=8)
+def get_dataset_profile(dataset_key: str, _df: pd.DataFrame) -> str:
+    """
+    Profile of the dataset, computed once per dataset, to start the threads with; "" if disabled
+
+    Args:
+    - dataset_key (str): Identifies the content of the dataset, e.g. its fingerprint or its file id
+    - _df (pd.DataFrame): The dataset, not hashed by Streamlit
+    """
+    if not DATASET_PROFILE_ENABLED:
+        return ""
+    with perf.span("dataset_profile", rows=len(_df)):
+        return format_profile(profile_frame(_df))
+
+@st.cache_resource
+def get_local_frame(path: str) -> pd.DataFrame:
+    """
+    Process-wide copy of a CSV dataset read from local disk, e.g. of the file uploaded for the assistant,
+    which the API does not allow to download
+
+    Args:
+    - path (str): The path of the CSV file
+    """
+    return pd.read_csv(path)
+
+@st.cache_resource
+def get_local_frame_fingerprint(path: str) -> str:
+    """
+    Hash of the content of the local CSV dataset, computed once per process
+
+    Args:
+    - path (str): The path of the CSV file
+    """
+    return frame_fingerprint(get_local_frame(path))
+
 def delete_files(file_id_list: list[str]) -> None:
     """
-    Delete the file(s) uploaded
+    Queue the deletion of the file(s) uploaded, without waiting for it
     
     Args:
     - file_id_list (list[str]): List of file ids to delete
     """
+    cleanup_worker = get_cleanup_worker()
     for file_id in file_id_list:
-        client.files.delete(file_id)
-        print(f"Deleted file: \t {file_id}")
+        cleanup_worker.enqueue("file", file_id)
 
 def delete_thread(thread_id) -> None:
     """
-    Delete the thread
+    Queue the deletion of the thread, without waiting for it
     
     Args:
     - thread_id (str): The id of the thread to delete
     """
-    client.beta.threads.delete(thread_id)
-    print(f"Deleted thread: \t {thread_id}")
+    get_cleanup_worker().enqueue("thread", thread_id)
+
+# Pattern to match Markdown links: [Link text](URL)
+LINK_PATTERN = r'\[.*?\]\(.*?\)'
+# Pattern to match lines starting with list item indicators (unordered or ordered)
+LIST_ITEM_PATTERN = r'^(\s*(\*|-|\d+\.)\s).*'
+# Combine both patterns to identify list items containing links
+# The MULTILINE flag is used to allow ^ to match the start of each line
+LINK_REGEX = re.compile(rf'({LIST_ITEM_PATTERN}.*?{LINK_PATTERN}.*?$)|{LINK_PATTERN}', flags=re.MULTILINE)
+# Lines that a list item match can continue past: blank lines, or a bare list marker
+OPEN_LINE_REGEX = re.compile(r'\s*(\*|-|\d+\.)?')
 
 def remove_links(text: str) -> str:
     """
@@ -152,68 +297,187 @@ def remove_links(text: str) -> str:
     Returns:
     - str: The text with the links removed
     """
-    # Pattern to match Markdown links: [Link text](URL)
-    link_pattern = r'\[.*?\]\(.*?\)'
-    # Pattern to match lines starting with list item indicators (unordered or ordered)
-    list_item_pattern = r'^(\s*(\*|-|\d+\.)\s).*'
-    # Combine both patterns to identify list items containing links
-    combined_pattern = rf'({list_item_pattern}.*?{link_pattern}.*?$)|{link_pattern}'
     # Replace the matching content with an empty string
-    # The MULTILINE flag is used to allow ^ to match the start of each line
-    cleaned_text = re.sub(combined_pattern, '', text, flags=re.MULTILINE)
+    cleaned_text = LINK_REGEX.sub('', text)
     return cleaned_text
 
-def retrieve_messages_from_thread(thread_id: str) -> list[str]:
+class StreamingLinkStripper:
+    """
+    Incremental version of `remove_links` for streamed text.
+
+    Matches of `LINK_REGEX` never cross a newline, except when the line before it
+    is blank or a bare list marker. Text up to the last newline that is not preceded
+    by such a line is therefore final, and is cleaned once and committed; only the
+    remaining tail is re-scanned as new characters arrive. The tail is displayed up
+    to its first unmatched `[`, which may still open a link.
+    Once `flush` is called, `text` is identical to `remove_links` on the full text.
+    """
+    def __init__(self):
+        self._committed = ""
+        self._tail = ""
+
+    def feed(self, text: str) -> None:
+        """
+        Add streamed text
+
+        Args:
+        - text (str): The new characters
+        """
+        scan_start = len(self._tail)
+        self._tail += text
+        # Look for the last safe cut, among the newlines in the new characters only
+        newline = self._tail.rfind("\n", scan_start)
+        while newline != -1:
+            line_start = self._tail.rfind("\n", 0, newline) + 1
+            if not OPEN_LINE_REGEX.fullmatch(self._tail, line_start, newline):
+                self._committed += remove_links(self._tail[:newline + 1])
+                self._tail = self._tail[newline + 1:]
+                return
+            newline = self._tail.rfind("\n", scan_start, newline)
+
+    def flush(self) -> None:
+        """
+        Commit the remaining tail, once the stream is complete
+        """
+        self._committed += remove_links(self._tail)
+        self._tail = ""
+
+    @property
+    def text(self) -> str:
+        """
+        The cleaned text, holding back the ambiguous tail
+        """
+        preview = remove_links(self._tail)
+        open_bracket = preview.find("[")
+        if open_bracket != -1:
+            preview = preview[:open_bracket]
+        return self._committed + preview
+
+@perf.timed("attachment_scan")
+def retrieve_assistant_created_files(thread_id: str, after: Optional[str] = None) -> Tuple[list[str], Optional[str]]:
     """
-    Retrieve messages from the thread
+    Retrieve the assistant-created files, in a single paginated scan of the thread messages
 
     Args:
     - thread_id (str): The id of the thread
+    - after (str): Only scan the messages created after this message id
 
     Returns:
-    - list[str]: List of assistant messages
+    - list[str]: List of assistant-created file ids
+    - str: The id of the last message scanned, to pass as `after` on the next scan
     """
-    thread_messages = client.beta.threads.messages.list(thread_id)
-    assistant_messages = []
-    for message in thread_messages.data:
+    list_params = {"order": "asc", "limit": 100}
+    if after is not None:
+        list_params["after"] = after
+
+    assistant_created_file_ids = []
+    last_message_id = after
+    # Iterating the page fetches the following pages as needed
+    for message in client.beta.threads.messages.list(thread_id, **list_params):
+        last_message_id = message.id
         if message.role == "assistant":
-            assistant_messages.append(message.id)
-    return assistant_messages
+            # The attachments are part of the listed message, no need to retrieve it
+            for attachment in message.attachments or []:
+                assistant_created_file_ids.append(attachment.file_id)
 
-def retrieve_assistant_created_files(message_list: list[str]) -> list[str]:
+    return assistant_created_file_ids, last_message_id
+
+class RenderScheduler:
     """
-    Retrieve the assistant-created files
+    Coalesces streamed deltas into placeholder updates at a bounded rate.
+
+    Each update re-renders the full content of a placeholder, so only the latest
+    pending update needs to be sent. Pending updates are flushed when the interval
+    has elapsed, when enough characters are pending, or when another placeholder
+    is updated.
+    """
+    def __init__(self, interval_ms: int = RENDER_INTERVAL_MS, max_chars: int = RENDER_MAX_CHARS):
+        """
+        Args:
+        - interval_ms (int): Minimum time between two renders
+        - max_chars (int): Number of pending characters which forces a render
+        """
+        self.interval = interval_ms / 1000
+        self.max_chars = max_chars
+        self.deltas = 0
+        self.flushes = 0
+        self._pending = None
+        self._pending_chars = 0
+        self._last_flush = 0.0
+
+    def update(self, placeholder, method: str, content: str, n_chars: int = 1) -> None:
+        """
+        Schedule `placeholder.<method>(content)`, replacing the pending update for the placeholder
+
+        Args:
+        - placeholder: The Streamlit placeholder to render into
+        - method (str): The placeholder method used to render, e.g. `info` or `code`
+        - content (str): The full content to render
+        - n_chars (int): The number of new characters in this update
+        """
+        self.deltas += 1
+        if self._pending is not None and self._pending[0] is not placeholder:
+            self.flush()
+        self._pending = (placeholder, method, content)
+        self._pending_chars += n_chars
+        if (time.monotonic() - self._last_flush >= self.interval
+                or self._pending_chars >= self.max_chars):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Render the pending update, if any
+        """
+        if self._pending is None:
+            return
+        placeholder, method, content = self._pending
+        self._pending = None
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+        self.flushes += 1
+        getattr(placeholder, method)(content)
+
+    def stats(self) -> dict:
+        """
+        Return the number of deltas received and renders sent
+        """
+        return {
+            "deltas": self.deltas,
+            "flushes": self.flushes,
+            "coalescing_ratio": self.deltas / self.flushes if self.flushes else 0.0,
+        }
+
+@perf.timed("download.content")
+def read_file_content(file_id: str) -> bytes:
+    """
+    Download the content of a file
 
     Args:
-    - message_list (list[str]): List of assistant messages
+    - file_id (str): The id of the file
 
     Returns:
-    - list[str]: List of assistant-created file ids
+    - bytes: The content of the file
     """
-    assistant_created_file_ids = []
-    for message_id in message_list:
-        message = client.beta.threads.messages.retrieve(
-            message_id=message_id,
-            thread_id=st.session_state.thread_id,
-        )
+    return client.files.content(file_id).read()
 
-        # Retrieve the attachments from the message, and the file ids from the attachments
-        created_file_id = [file.file_id for file in message.attachments]
-        for file_id in created_file_id:
-            assistant_created_file_ids.append(file_id)        
+@perf.timed("download.name")
+def retrieve_file_name(file_id: str) -> str:
+    """
+    Retrieve the name of a file
 
-        # message_files = client.beta.threads.messages.files.list(
-        #     thread_id=st.session_state.thread_id,
-        #     message_id=message_id)
-        # for file in message_files.data:
-        #     assistant_created_file_ids.append(file.id)
+    Args:
+    - file_id (str): The id of the file
 
-    return assistant_created_file_ids
+    Returns:
+    - str: The base name of the file
+    """
+    return os.path.basename(client.files.retrieve(file_id).filename)
 
 @st.experimental_fragment
 def render_download_files(file_id_list: list[str]) -> Tuple[list[bytes], list[str]]:
     """
-    Download the files, renders a download button for each file, and returns the downloaded files
+    Download the files concurrently, renders a download button for each file as it completes,
+    and returns the downloaded files
 
     Args:
     - file_id_list (list[str]): List of file ids to download
@@ -226,109 +490,233 @@ def render_download_files(file_id_list: list[str]) -> Tuple[list[bytes], list[st
     file_names = []
     if len(file_id_list) > 0:
         st.markdown("### 📂  **Downloadable Files**")
-        for file_id_num, file_id in enumerate(file_id_list):
-            try: 
-                file_data = client.files.content(file_id)
-                file = file_data.read()
-                file_name = client.files.retrieve(file_id).filename
-                file_name = os.path.basename(file_name)
-
-                # # if file_name is `.csv`
-                # if file_name.endswith(".csv"):
-                #     try:
-                #         with open(f"static/{file_name}", "wb") as f:
-                #             f.write(file)
-                #     except:
-                #         # Convert bytes to string
-                #         csv_str = file.decode('utf-8')
-                #         csv_file = io.StringIO(csv_str)            
-                #         df = pd.read_csv(csv_file)
-                #         df.to_csv(f"static/{file_name}", index=False)
-                # elif file_name.endswith(".png"):
-                #     with open(f"static/{file_name}", "wb") as f:
-                #         f.write(file)
-                # st.write(f"- [{file_name}](static/{file_name})")
-
-                # Store the downloaded file and its name
-                downloaded_files.append(file)
-                file_names.append(file_name)
+        # Reserve a slot per file, so the buttons keep their order whichever download finishes first
+        button_slots = [st.empty() for _ in file_id_list]
+        results = [{} for _ in file_id_list]
+        failed = set()
+
+        # Fetch the content and the name of every file at once, in copies of this context for the spans
+        with perf.span("downloads", files=len(file_id_list)), ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            futures = {}
+            for file_id_num, file_id in enumerate(file_id_list):
+                futures[executor.submit(contextvars.copy_context().run, read_file_content, file_id)] = (file_id_num, "file")
+                futures[executor.submit(contextvars.copy_context().run, retrieve_file_name, file_id)] = (file_id_num, "file_name")
+
+            for future in as_completed(futures):
+                file_id_num, part = futures[future]
+                try:
+                    results[file_id_num][part] = future.result()
+                except Exception as e:
+                    print(f"Failed to download file: \t {file_id_list[file_id_num]} ({e})")
+                    failed.add(file_id_num)
+                    results[file_id_num][part] = None
+                if len(results[file_id_num]) < 2:
+                    continue
+
+                if file_id_num in failed:
+                    # Fall back to the files downloaded on the previous run
+                    file = st.session_state.download_files[file_id_num]
+                    file_name = st.session_state.download_file_names[file_id_num]
+                else:
+                    file = results[file_id_num]["file"]
+                    file_name = results[file_id_num]["file_name"]
 
                 # Display the download button
-                st.download_button(label=f"{file_name}",
-                                    data=file,
-                                    file_name=file_name,
-                                    mime="text/csv")
-                                    
-            except: 
-                # Display the download button
-                file = st.session_state.download_files[file_id_num]
-                file_name = st.session_state.download_file_names[file_id_num]
-                st.download_button(label=f"{file_name}",
-                                    data=file,
-                                    file_name=file_name,
-                                    mime="text/csv")
-    
+                button_slots[file_id_num].download_button(label=f"{file_name}",
+                                                          data=file,
+                                                          file_name=file_name,
+                                                          mime="text/csv")
+
+        # Store the downloaded files and their names, in the original order
+        for file_id_num, result in enumerate(results):
+            if file_id_num not in failed:
+                downloaded_files.append(result["file"])
+                file_names.append(result["file_name"])
+
     return downloaded_files, file_names
-    
+
+
+def code_interpreter_delta(code_input: Optional[str] = None, logs: Optional[str] = None) -> SimpleNamespace:
+    """
+    Tool call delta carrying code or logs, as streamed by the code interpreter, to render them through an event handler
+    """
+    outputs = [SimpleNamespace(type="logs", logs=logs)] if logs is not None else None
+    return SimpleNamespace(type="code_interpreter", code_interpreter=SimpleNamespace(input=code_input, outputs=outputs))
+
+def run_function_call(event_handler: AssistantEventHandler,
+                      tool_call: ToolCall,
+                      code_executor: Optional[LocalCodeExecutor],
+                      dataset_key: Optional[str],
+                      dataset: Optional[pd.DataFrame] = None) -> dict:
+    """
+    Run a `run_python` call of the assistant in the local code executor, rendering its code, output
+    and figures through the event handler as if they came from the code interpreter
+
+    Args:
+    - event_handler (AssistantEventHandler): Renders the call, through `on_tool_call_delta` and `render_image`
+    - tool_call (ToolCall): The function call, with its complete arguments
+    - code_executor (LocalCodeExecutor): The executor, or None if the local code execution is off
+    - dataset_key (str): The key of the dataset in the executor
+    - dataset (pd.DataFrame): The dataset, loaded again in the executor if it was dropped meanwhile
+
+    Returns:
+    - dict: The tool output to submit for the call
+    """
+    if code_executor is None or tool_call.function.name != "run_python":
+        return {"tool_call_id": tool_call.id, "output": f"Error: unknown function {tool_call.function.name}"}
+    try:
+        code = json.loads(tool_call.function.arguments)["code"]
+    except (ValueError, KeyError, TypeError) as e:
+        return {"tool_call_id": tool_call.id, "output": f"Error: invalid arguments: {e}"}
+
+    event_handler.on_tool_call_delta(code_interpreter_delta(code_input=code), None)
+    with perf.span("local_execution") as span:
+        result = code_executor.run(dataset_key, code, dataset)
+        span.set(error=result.error, images=len(result.images))
+    logs = "\n".join(part for part in (result.output, result.error) if part)
+    if logs:
+        event_handler.on_tool_call_delta(code_interpreter_delta(logs=logs), None)
+    for image_num, image_data_bytes in enumerate(result.images):
+        event_handler.render_image(image_data_bytes, f"{tool_call.id}_{image_num}")
+    return {"tool_call_id": tool_call.id, "output": result.tool_output()}
+
+def continue_event_handler(event_handler: AssistantEventHandler) -> AssistantEventHandler:
+    """
+    A new event handler for the stream submitting the tool outputs, carrying on the rendering
+    state of the given one, as the SDK requires an event handler per stream
+    """
+    continuation = copy.copy(event_handler)
+    # Reset the state of the stream only
+    AssistantEventHandler.__init__(continuation)
+    continuation.tool_outputs = []
+    return continuation
+
+def submit_tool_outputs(event_handler: AssistantEventHandler) -> AssistantEventHandler:
+    """
+    Submit the outputs of the functions run locally for as long as the run requires them,
+    streaming the rest of the run
+
+    Args:
+    - event_handler (AssistantEventHandler): The event handler of the run stream, once done
+
+    Returns:
+    - AssistantEventHandler: The event handler of the last stream, whose `current_run` is final
+    """
+    while event_handler.current_run is not None and event_handler.current_run.status == "requires_action":
+        run = event_handler.current_run
+        tool_outputs = event_handler.tool_outputs
+        event_handler = continue_event_handler(event_handler)
+        with client.beta.threads.runs.submit_tool_outputs_stream(thread_id=run.thread_id,
+                                                                 run_id=run.id,
+                                                                 tool_outputs=tool_outputs,
+                                                                 event_handler=event_handler,
+                                                                 timeout=OPENAI_STREAM_TIMEOUT) as stream:
+            stream.until_done()
+    return event_handler
+
 
 class EventHandler(AssistantEventHandler):
     """
-    Event handler for the assistant stream
+    Event handler for the assistant stream, rendering the answer and writing it to the transcript of the session
     """
+    def __init__(self, code_executor: Optional[LocalCodeExecutor] = None, dataset_key: Optional[str] = None,
+                 dataset: Optional[pd.DataFrame] = None):
+        """
+        Args:
+        - code_executor (LocalCodeExecutor): Runs the `run_python` calls, for the local code execution
+        - dataset_key (str): The key of the dataset in the code executor
+        - dataset (pd.DataFrame): The dataset, loaded again in the code executor if it was dropped meanwhile
+        """
+        super().__init__()
+        self.link_stripper = StreamingLinkStripper()
+        self.render_scheduler = RenderScheduler()
+        self.first_token = True
+        self.code_executor = code_executor
+        self.dataset_key = dataset_key
+        self.dataset = dataset
+        # Outputs of the functions run locally, submitted once the run requires them
+        self.tool_outputs = []
+        # The answer, in the current turn of the transcript
+        self.transcript = get_session_transcript()
+        # The latest text box, and the code status and box of the current tool call, if any
+        self.text_box = None
+        self.code_status = None
+        self.code_box = None
+
+    def new_text_box(self) -> None:
+        """
+        Create a new text box for the next operation; the code of the next tool call goes in a new code box
+        """
+        self.text_box = st.empty()
+        self.code_box = None
+
+    def complete_code(self) -> None:
+        """
+        Collapse the code status of the latest tool call, once its code is done
+        """
+        if self.code_status is not None:
+            self.code_status.update(state="complete", expanded=False)
+            self.code_status = None
+
     @override
     def on_text_created(self, text: Text) -> None:
         """
         Handler for when a text is created
         """
-        # This try-except block will update the earlier expander for code to complete.
-        # Note the indexing. We are updating the x-1 textbox where x is the current textbox.
-        # Note how `on_tool_call_done` creates a new textbook (which is the x_th textbox, so we want to access the x-1_th)
-        # This is to address an edge case where code is executed, but there is no output textbox (e.g. a graph is created)
-        try:
-            st.session_state[f"code_expander_{len(st.session_state.text_boxes) - 1}"].update(state="complete", expanded=False)
-        except KeyError:
-            pass
+        # The code of the previous tool call is done, collapse it. This addresses an edge case
+        # where code is executed, but there is no output (e.g. a graph is created)
+        self.render_scheduler.flush()
+        self.complete_code()
 
         # Create a new text box
-        st.session_state.text_boxes.append(st.empty())
-        # Insert the text into the last element in assistant text list
-        st.session_state.assistant_text[-1] += "**> 🕵️ DAVE:** \n\n "
-        # Remove links from the text
-        st.session_state.assistant_text[-1] = remove_links(st.session_state.assistant_text[-1])
+        self.new_text_box()
+        # Start a link stripper for this text
+        self.link_stripper = StreamingLinkStripper()
+        self.link_stripper.feed("**> 🕵️ DAVE:** \n\n ")
+        # Store the text, with the links removed
+        self.transcript.add("text", self.link_stripper.text)
         # Display the text in the newly created text box
-        st.session_state.text_boxes[-1].info("".join(st.session_state["assistant_text"][-1]))
+        self.text_box.info(self.link_stripper.text)
       
     @override
     def on_text_delta(self, delta: TextDelta, snapshot: Text):
         """
         Handler for when a text delta is created
         """
-        # Clear the latest text box
-        st.session_state.text_boxes[-1].empty()
-        # If there is text written, add it to latest element in the assistant text list
+        if self.first_token:
+            perf.event("first_token")
+            self.first_token = False
+        # If there is text written, feed it to the link stripper, which only scans the new characters
         if delta.value:
-            st.session_state.assistant_text[-1] += delta.value
-        # Remove links from the text
-        st.session_state.assistant_text[-1] = remove_links(st.session_state.assistant_text[-1])
-        # Re-display the full text in the latest text box
-        st.session_state.text_boxes[-1].info("".join(st.session_state["assistant_text"][-1]))
+            self.link_stripper.feed(delta.value)
+        # Update the text of the transcript, with the links removed
+        text = self.link_stripper.text
+        self.transcript.replace("text", text)
+        # Schedule a re-display of the full text in the latest text box
+        self.render_scheduler.update(self.text_box, "info", text, len(delta.value or ""))
 
     def on_text_done(self, text: Text):
         """
         Handler for when text is done
         """
-        # Create new text box and element in the assistant text list
-        st.session_state.text_boxes.append(st.empty())
-        st.session_state.assistant_text.append("")
+        # Release the held-back tail and display the final text
+        self.render_scheduler.flush()
+        self.link_stripper.flush()
+        text = self.link_stripper.text
+        self.transcript.replace("text", text)
+        self.text_box.info(text)
+        # Create new text box
+        self.new_text_box()
 
     def on_tool_call_created(self, tool_call: ToolCall):
         """
         Handler for when a tool call is created
         """
+        self.render_scheduler.flush()
         # Create new text box, which will contain code
-        st.session_state.text_boxes.append(st.empty())
-        # Create a new element in the code input list
-        st.session_state.code_input.append("")
+        self.new_text_box()
+        # Start the code of this tool call in the transcript
+        self.transcript.add("code", "")
           
     def on_tool_call_delta(self, delta: ToolCallDelta, snapshot: ToolCallDelta):
         """
@@ -338,97 +726,99 @@ class EventHandler(AssistantEventHandler):
 
             # Code writen by the assistant to be executed
             if delta.code_interpreter.input:
-                # Go to the last text box
-                with st.session_state.text_boxes[-1]:
-                    # Check if a code box for this accompanying text box index exists
-                    if f"code_box_{len(st.session_state.text_boxes)}" not in st.session_state:
+                if self.code_box is None:
+                    # Render the pending text before the code box goes below it; after that, the
+                    # scheduler flushes on its own when the updates switch placeholders
+                    self.render_scheduler.flush()
+                    with self.text_box:
                         # Nest the code in an expander
-                        st.session_state[f"code_expander_{len(st.session_state.text_boxes)}"] = st.status("**💻 Code**", expanded=True)
+                        self.code_status = st.status("**💻 Code**", expanded=True)
                         # Create an empty container which is the placeholder for the code box
-                        st.session_state[f"code_box_{len(st.session_state.text_boxes)}"] = st.session_state[f"code_expander_{len(st.session_state.text_boxes)}"].empty()
+                        self.code_box = self.code_status.empty()
 
-                # Clear the code box
-                st.session_state[f"code_box_{len(st.session_state.text_boxes)}"].empty()
-                # If there is code written, add it to the code input
-                if delta.code_interpreter.input:
-                    st.session_state.code_input[-1] += delta.code_interpreter.input
-                # Re-display the full code in the code box
-                st.session_state[f"code_box_{len(st.session_state.text_boxes)}"].code(st.session_state.code_input[-1])
+                # Add the code to the transcript
+                code_input = self.transcript.extend("code", delta.code_interpreter.input)
+                # Schedule a re-display of the full code in the code box
+                self.render_scheduler.update(self.code_box, "code", code_input, len(delta.code_interpreter.input))
 
             # Output from the code executed by code interpreter
             if delta.code_interpreter.outputs:
+                self.render_scheduler.flush()
                 for output in delta.code_interpreter.outputs:
                     if output.type == "logs":
-                        # This try-except block will update the earlier expander for code to complete.
-                        # Note the indexing, as we have not yet created a new text box for the code output.
-                        try:
-                            st.session_state[f"code_expander_{len(st.session_state.text_boxes)}"].update(state="complete", expanded=False)
-                        except KeyError:
-                            pass
-                        # Create a new element in the code input list, which is for the next code input
-                        st.session_state.code_input.append("")
-                        # Create a new text box, which is for the code output
-                        st.session_state.text_boxes.append(st.empty())
-                        # Nest the code output in an expander
-                        st.session_state.text_boxes[-1] = st.expander(label="**🔎 Output**")
-                        # Create a new element in the code output list
-                        st.session_state.code_output.append("")
-                        # Clear the latest text box which is for the code output
-                        st.session_state.text_boxes[-1].empty()
-                        # Add the logs to the code output
-                        st.session_state.code_output[-1] += f"\n\n{output.logs}"
+                        # The code is done, collapse it
+                        self.complete_code()
+                        # Create a new text box, which is for the code output, nested in an expander
+                        self.new_text_box()
+                        self.text_box = st.expander(label="**🔎 Output**")
+                        # Add the logs to the transcript, the next code input follows in a new part
+                        code_output = f"\n\n{output.logs}"
+                        self.transcript.add("output", code_output)
                         # Display the code output
-                        st.session_state.text_boxes[-1].code(st.session_state.code_output[-1])
+                        self.text_box.code(code_output)
 
     def on_tool_call_done(self, tool_call: ToolCall):
         """
         Handler for when a tool call is done
         """
-        # Create a new element in the code input list
-        st.session_state.code_input.append("")
-        # Create a new element in the code output list
-        st.session_state.code_output.append("")
-        # Create a new element in the assistant text list
-        st.session_state.assistant_text.append("")
+        # The arguments of a function call are complete, run it locally
+        if tool_call is not None and tool_call.type == "function":
+            self.tool_outputs.append(run_function_call(self, tool_call, self.code_executor, self.dataset_key,
+                                                       self.dataset))
+        self.render_scheduler.flush()
         # Create a new text box for the next operation
-        st.session_state.text_boxes.append(st.empty())
+        self.new_text_box()
 
     def on_image_file_done(self, image_file: ImageFile):
         """
         Handler for when an image file is done
         """
+        self.render_scheduler.flush()
         # Download file from OpenAI
-        image_data = client.files.content(image_file.file_id)
-        img_name = image_file.file_id
+        with perf.span("image_download"):
+            image_data = client.files.content(image_file.file_id)
+            image_data_bytes = image_data.read()
 
-        # Save file
-        image_data_bytes = image_data.read()
-        with open(f"images/{img_name}.png", "wb") as file:
-            file.write(image_data_bytes)
+        self.render_image(image_data_bytes, image_file.file_id)
 
-        # Open file and encode as data
-        file_ = open(f"images/{img_name}.png", "rb")
-        contents = file_.read()
-        data_url = base64.b64encode(contents).decode("utf-8")
-        file_.close()
+        # Delete file from OpenAI, in the background
+        delete_files([image_file.file_id])
 
-        # Create new text box
-        st.session_state.text_boxes.append(st.empty())
-        st.session_state.assistant_text.append("")
-        
-        # # Display image in textbox
-        image_html = f'<p align="center"><img src="data:image/png;base64,{data_url}" width=600></p>'
-        st.session_state.text_boxes[-1].html(image_html)
+    def render_image(self, image_data_bytes: bytes, img_name: str):
+        """
+        Store and display an image of the answer
+        """
+        # Store the image in the transcript, by reference
+        self.transcript.add_blob("image", image_data_bytes)
+        data_url = base64.b64encode(image_data_bytes).decode("utf-8")
 
-        # st.session_state.text_boxes[-1].image(f"images/{img_name}.png", width=600)
+        # Display image in a new text box
+        self.new_text_box()
+        image_html = f'<p align="center"><img src="data:image/png;base64,{data_url}" width=600></p>'
+        self.text_box.html(image_html)
 
         # Create new text box
-        st.session_state.assistant_text.append("")
-        st.session_state.text_boxes.append(st.empty())
-        
-        # Delete file from OpenAI
-        client.files.delete(image_file.file_id)
+        self.new_text_box()
       
+    def on_end(self):
+        """
+        Handler for when the stream ends
+        """
+        self.render_scheduler.flush()
+        if self.run_continues:
+            return
+        # Save the complete answer
+        self.transcript.save()
+        print(f"Render scheduler: \t {self.render_scheduler.stats()}")
+        perf.event("stream_end", **self.render_scheduler.stats())
+
+    @property
+    def run_continues(self) -> bool:
+        """
+        True if the run waits for the tool outputs, to be streamed on by `submit_tool_outputs`
+        """
+        return self.current_run is not None and self.current_run.status == "requires_action"
+
     def on_timeout(self):
         """
         Handler for when the api call times out
@@ -441,4 +831,115 @@ class EventHandler(AssistantEventHandler):
     #     Handler for when an exception occurs
     #     """
     #     st.error(f"An error occurred: {exception}")
-    #     st.stop()
\ No newline at end of file
+    #     st.stop()
+
+
+class RecordingEventHandler(EventHandler):
+    """
+    Event handler recording the events it renders, to replay them with `replay_answer`
+    """
+    def __init__(self, code_executor: Optional[LocalCodeExecutor] = None, dataset_key: Optional[str] = None,
+                 dataset: Optional[pd.DataFrame] = None):
+        super().__init__(code_executor, dataset_key, dataset)
+        self.answer = RecordedAnswer()
+
+    def _record(self, kind: str, payload=None) -> None:
+        events = self.answer.events
+        # Consecutive deltas are merged, the replay renders them at once
+        if kind in ("text_delta", "code_input") and events and events[-1][0] == kind:
+            events[-1][1] += payload
+        else:
+            events.append([kind, payload])
+
+    def on_text_created(self, text: Text) -> None:
+        self._record("text_created")
+        super().on_text_created(text)
+
+    def on_text_delta(self, delta: TextDelta, snapshot: Text):
+        if delta.value:
+            self._record("text_delta", delta.value)
+        super().on_text_delta(delta, snapshot)
+
+    def on_text_done(self, text: Text):
+        self._record("text_done")
+        super().on_text_done(text)
+
+    def on_tool_call_created(self, tool_call: ToolCall):
+        self._record("tool_call_created")
+        super().on_tool_call_created(tool_call)
+
+    def on_tool_call_delta(self, delta: ToolCallDelta, snapshot: ToolCallDelta):
+        if delta.type == "code_interpreter" and delta.code_interpreter:
+            if delta.code_interpreter.input:
+                self._record("code_input", delta.code_interpreter.input)
+            for output in delta.code_interpreter.outputs or []:
+                if output.type == "logs":
+                    self._record("logs", output.logs)
+        super().on_tool_call_delta(delta, snapshot)
+
+    def on_tool_call_done(self, tool_call: ToolCall):
+        # Recorded after a function call ran, which renders its code and output
+        super().on_tool_call_done(tool_call)
+        self._record("tool_call_done")
+
+    def render_image(self, image_data_bytes: bytes, img_name: str):
+        self._record("image", [self.answer.add_blob(image_data_bytes), img_name])
+        super().render_image(image_data_bytes, img_name)
+
+    def on_end(self):
+        if not self.run_continues:
+            self._record("end")
+        super().on_end()
+
+
+def replay_answer(answer: RecordedAnswer, event_handler: EventHandler) -> None:
+    """
+    Render a recorded answer through the event handler, as if it were streamed
+
+    Args:
+    - answer (RecordedAnswer): The recorded answer
+    - event_handler (EventHandler): The event handler rendering it
+    """
+    for kind, payload in answer.events:
+        if kind == "text_created":
+            event_handler.on_text_created(None)
+        elif kind == "text_delta":
+            event_handler.on_text_delta(SimpleNamespace(value=payload), None)
+        elif kind == "text_done":
+            event_handler.on_text_done(None)
+        elif kind == "tool_call_created":
+            event_handler.on_tool_call_created(None)
+        elif kind == "code_input":
+            event_handler.on_tool_call_delta(code_interpreter_delta(code_input=payload), None)
+        elif kind == "logs":
+            event_handler.on_tool_call_delta(code_interpreter_delta(logs=payload), None)
+        elif kind == "tool_call_done":
+            event_handler.on_tool_call_done(None)
+        elif kind == "image":
+            blob_index, img_name = payload
+            event_handler.render_image(answer.blobs[blob_index], img_name)
+        elif kind == "end":
+            event_handler.on_end()
+
+
+def render_recorded_download_files(answer: RecordedAnswer) -> Tuple[list[bytes], list[str]]:
+    """
+    Render a download button for each file of a recorded answer, and return the files
+
+    Args:
+    - answer (RecordedAnswer): The recorded answer
+
+    Returns:
+    - downloaded_files (list[object]): List of recorded files
+    - file_names (list[str]): List of file names
+    """
+    downloaded_files = [answer.blobs[blob_index] for blob_index, _ in answer.downloads]
+    file_names = [file_name for _, file_name in answer.downloads]
+    if len(downloaded_files) > 0:
+        st.markdown("### 📂  **Downloadable Files**")
+        for file, file_name in zip(downloaded_files, file_names):
+            st.download_button(label=f"{file_name}",
+                               data=file,
+                               file_name=file_name,
+                               mime="text/csv")
+    return downloaded_files, file_names
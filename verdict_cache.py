@@ -0,0 +1,174 @@
+"""
+verdict_cache.py
+"""
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+# Config
+VERDICT_CACHE_TTL_SECONDS = 7 * 24 * 3600
+VERDICT_CACHE_MAX_ENTRIES = 10_000
+# Set to a file path to keep the verdicts across restarts
+VERDICT_CACHE_PATH = os.environ.get("VERDICT_CACHE_PATH")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalise the text so that trivially different inputs share a verdict
+
+    Args:
+    - text (str): The text to normalise
+
+    Returns:
+    - str: The case-folded text, with whitespace collapsed
+    """
+    return " ".join(text.split()).casefold()
+
+
+class VerdictCache:
+    """
+    Cache of check verdicts keyed by check name and normalised text hash, with TTL
+    and LRU eviction. Optionally backed by a SQLite database.
+    """
+    def __init__(self,
+                 ttl_seconds: float = VERDICT_CACHE_TTL_SECONDS,
+                 max_entries: int = VERDICT_CACHE_MAX_ENTRIES,
+                 db_path: Optional[str] = VERDICT_CACHE_PATH):
+        """
+        Args:
+        - ttl_seconds (float): Time after which a verdict is checked again
+        - max_entries (int): Number of verdicts kept in memory
+        - db_path (str): Path of the SQLite database, or None to keep the verdicts in memory only
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        # key -> (verdict, latency of the original check, expiry timestamp)
+        self._entries: "OrderedDict[str, tuple[bool, float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS verdicts ("
+                             "key TEXT PRIMARY KEY, verdict INTEGER, latency REAL, expires_at REAL)")
+            self._db.execute("DELETE FROM verdicts WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+    @staticmethod
+    def key(check_name: str, text: str) -> str:
+        """
+        Cache key of a check applied to a text
+        """
+        digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+        return f"{check_name}:{digest}"
+
+    def get_or_compute(self, check_name: str, text: str, check: Callable[[str], bool]) -> bool:
+        """
+        Return the cached verdict, or run the check and cache its verdict
+
+        Args:
+        - check_name (str): The name of the check
+        - text (str): The text to check
+        - check (Callable): The check, returning True if the text is flagged
+
+        Returns:
+        - bool: The verdict
+        """
+        key = self.key(check_name, text)
+        entry = self._get(key)
+        if entry is not None:
+            verdict, latency, _ = entry
+            with self._lock:
+                self.hits += 1
+                self.saved_seconds += latency
+            return verdict
+
+        start = time.perf_counter()
+        verdict = bool(check(text))
+        latency = time.perf_counter() - start
+        self._put(key, (verdict, latency, time.time() + self.ttl_seconds))
+        with self._lock:
+            self.misses += 1
+        return verdict
+
+    def stats(self) -> dict:
+        """
+        Return the hit rate and the latency saved by the cache
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "saved_seconds": self.saved_seconds,
+            "entries": len(self._entries),
+        }
+
+    def _get(self, key: str) -> Optional[tuple[bool, float, float]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT verdict, latency, expires_at FROM verdicts WHERE key = ?",
+                                       (key,)).fetchone()
+                if row is not None:
+                    entry = (bool(row[0]), row[1], row[2])
+                    self._entries[key] = entry
+            if entry is None:
+                return None
+            if entry[2] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self._evict()
+            return entry
+
+    def _put(self, key: str, entry: tuple[bool, float, float]) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict()
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)",
+                                 (key, int(entry[0]), entry[1], entry[2]))
+                self._db.commit()
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+_verdict_cache: Optional[VerdictCache] = None
+_verdict_cache_lock = threading.Lock()
+
+
+def get_verdict_cache() -> VerdictCache:
+    """
+    Return the verdict cache shared by all sessions of the process
+    """
+    global _verdict_cache
+    with _verdict_cache_lock:
+        if _verdict_cache is None:
+            _verdict_cache = VerdictCache()
+        return _verdict_cache
+
+
+def cached_verdict(check_name: str) -> Callable:
+    """
+    Decorator caching the verdicts of a check in the shared verdict cache
+
+    Args:
+    - check_name (str): The name the verdicts are cached under
+    """
+    def decorator(check: Callable[[str], bool]) -> Callable[[str], bool]:
+        @functools.wraps(check)
+        def cached_check(text: str) -> bool:
+            return get_verdict_cache().get_or_compute(check_name, text, check)
+        return cached_check
+    return decorator